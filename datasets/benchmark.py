@@ -0,0 +1,359 @@
+import argparse
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+from socketserver import ThreadingMixIn
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs
+
+import flickrapi
+
+from download_dataset import download_dataset
+from extract_subset import extract
+from fetch_urls import Fetcher
+from rate_limit import Backoff, Retrier, TokenBucket
+from split_dataset import Splitter
+
+STAGES = ('fetch', 'download', 'split', 'extract')
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """Answers after `latency` seconds, or fails with `error_rate`.
+
+    Failures are drawn from the `random` generator of the server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    latency = 0.
+    error_rate = 0.
+
+    def respond(self):
+        with self.server.lock:
+            self.server.calls += 1
+            failed = self.server.random.random() < self.error_rate
+        time.sleep(self.latency)
+        if failed:
+            self.send(503, b'Service unavailable', 'text/plain')
+            return
+        self.send(200, *self.body())
+
+    def send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeFlickrHandler(FakeHandler):
+    """Flickr search endpoint with `available` photos of every tag."""
+
+    available = 1000
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.params = parse_qs(self.rfile.read(length).decode('utf-8'))
+        self.respond()
+
+    def body(self):
+        tags = self.params['tags'][0]
+        per_page = int(self.params['per_page'][0])
+        page = int(self.params['page'][0])
+        pages = -(-self.available // per_page)
+        first = (page - 1) * per_page
+        photos = [{'id': str(i + 1), 'secret': '{:010x}'.format(i),
+                   'server': '1', 'farm': 1, 'owner': tags}
+                  for i in range(first, min(first + per_page,
+                                            self.available))]
+        response = {'photos': {'page': page, 'pages': pages,
+                               'perpage': per_page,
+                               'total': self.available, 'photo': photos},
+                    'stat': 'ok'}
+        return json.dumps(response).encode('utf-8'), 'application/json'
+
+
+class FakeImageHandler(FakeHandler):
+    """Static image server answering every path with `payload`."""
+
+    payload = b''
+
+    def do_GET(self):
+        self.respond()
+
+    def body(self):
+        return self.payload, 'image/jpeg'
+
+
+@contextmanager
+def fake_servers(latency=0., error_rate=0., image_size=20 << 10,
+                 available=1000, seed=0):
+    """Starts a fake Flickr search endpoint and an image server.
+
+    Yields their base urls and the servers, whose `calls` count
+    the requests they answered. Every server fails requests with
+    its own generator seeded with `seed`, so runs are repeatable.
+    """
+    settings = {'latency': latency, 'error_rate': error_rate}
+    handlers = [
+        type('FlickrHandler', (FakeFlickrHandler,),
+             dict(settings, available=available)),
+        type('ImageHandler', (FakeImageHandler,),
+             dict(settings, payload=os.urandom(image_size)))]
+    servers = []
+    try:
+        for handler in handlers:
+            server = ThreadingServer(('127.0.0.1', 0), handler)
+            server.calls = 0
+            server.lock = threading.Lock()
+            server.random = random.Random(seed)
+            threading.Thread(target=server.serve_forever,
+                             daemon=True).start()
+            servers.append(server)
+        yield ['http://127.0.0.1:{}'.format(server.server_address[1])
+               for server in servers], servers
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+def __class_names(classes):
+    return ['class{}'.format(i) for i in range(classes)]
+
+
+def __class_file_names(images, classes):
+    digits = len(str(images))
+    return {class_name: ['{}.jpg'.format(str(i).zfill(digits))
+                         for i in range(i_class, images, classes)]
+            for i_class, class_name in enumerate(__class_names(classes))}
+
+
+def __fetch(api_url, images, classes, workers):
+    flickr = flickrapi.FlickrAPI('key', 'secret', format='parsed-json',
+                                 store_token=False)
+    flickr.REST_URL = api_url + '/services/rest/'
+    retrier = Retrier(5, Backoff(base_delay=0.01), TokenBucket(1e6, 1e6))
+    fetcher = Fetcher(flickr, workers, retrier=retrier)
+    class_count = images // classes
+    started = time.monotonic()
+    urls = fetcher.fetch([{'name': class_name, 'count': class_count}
+                          for class_name in __class_names(classes)])
+    return time.monotonic() - started, \
+        sum(len(class_urls or []) for class_urls in urls.values()), {}
+
+
+def __download(image_url, images, classes, workers):
+    urls_data = {class_name: ['{}/{}/{}.jpg'.format(image_url, class_name, i)
+                              for i in range(len(file_names))]
+                 for class_name, file_names in
+                 __class_file_names(images, classes).items()}
+    retrier = Retrier(3, Backoff(base_delay=0.01))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        started = time.monotonic()
+        download_dataset(urls_data, temp_dir, workers, retrier=retrier)
+        seconds = time.monotonic() - started
+        stored = sum(len(os.listdir(os.path.join(temp_dir, class_name)))
+                     for class_name in urls_data)
+    return seconds, stored, {}
+
+
+def __split(images, classes, workers):
+    file_names = __class_file_names(images, classes)
+    splitter = Splitter(0.2, 'proportional', 42, workers=workers)
+    started = time.monotonic()
+    train_test_split = splitter.split_dataset('', sorted(file_names),
+                                              file_names=file_names)
+    return time.monotonic() - started, \
+        sum(map(len, train_test_split.values())), {}
+
+
+def __extract(images, classes, workers):
+    file_names = __class_file_names(images, classes)
+    train_test_split = Splitter(0.2, 'proportional', 42, workers=workers) \
+        .split_dataset('', sorted(file_names), file_names=file_names)
+    started = time.monotonic()
+    subset = extract(train_test_split, 10, 42)
+    return time.monotonic() - started, \
+        sum(map(len, train_test_split.values())), \
+        {'extracted': sum(map(len, subset.values()))}
+
+
+def __measure(function, args):
+    # Runs in a fresh process, so the peak RSS is the stage's own
+    seconds, items, extra = function(*args)
+    result = {'seconds': seconds,
+              'items': items,
+              'items_per_second': items / seconds if seconds else 0.,
+              'peak_rss_mb':
+                  resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+    result.update(extra)
+    return result
+
+
+def __run_stage(function, args):
+    with multiprocessing.Pool(1) as pool:
+        return pool.apply(__measure, (function, args))
+
+
+def run_benchmarks(stages=STAGES, images=10000, classes=10, workers=16,
+                   latency=0., error_rate=0., image_size=20 << 10,
+                   seed=0) -> dict:
+    """Runs benchmark stages against local stand-ins of Flickr.
+
+    Every stage runs in its own process and reports its time, items
+    per second and peak RSS. Network stages also report requests
+    per item, retries included.
+    """
+    results = {}
+    with fake_servers(latency, error_rate, image_size,
+                      images // classes, seed) as (urls, servers):
+        api_url, image_url = urls
+        api_server, image_server = servers
+        stage_runs = {
+            'fetch': (__fetch, (api_url, images, classes, workers),
+                      api_server, 'api_calls'),
+            'download': (__download, (image_url, images, classes, workers),
+                         image_server, 'image_requests'),
+            'split': (__split, (images, classes, workers), None, None),
+            'extract': (__extract, (images, classes, workers), None, None)}
+
+        for stage in stages:
+            function, args, server, calls_name = stage_runs[stage]
+            calls = server.calls if server is not None else 0
+            logging.info('Running the {} benchmark'.format(stage))
+            result = __run_stage(function, args)
+            if server is not None:
+                result[calls_name] = server.calls - calls
+                result[calls_name + '_per_item'] = \
+                    result[calls_name] / result['items'] \
+                    if result['items'] else None
+            results[stage] = result
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance=0.1) -> list:
+    """Returns regressions of `results` against a `baseline` report.
+
+    Stages slower or taking more memory than the baseline
+    by more than `tolerance` are regressions.
+    """
+    regressions = []
+    for stage, result in results.items():
+        previous = baseline.get('stages', {}).get(stage)
+        if previous is None:
+            continue
+
+        if result['items_per_second'] < \
+                previous['items_per_second'] * (1 - tolerance):
+            regressions.append(
+                '{}: {:.1f} items/s, was {:.1f}'.format(
+                    stage, result['items_per_second'],
+                    previous['items_per_second']))
+        if result['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(
+                '{}: {:.1f} MB peak RSS, was {:.1f}'.format(
+                    stage, result['peak_rss_mb'], previous['peak_rss_mb']))
+
+    return regressions
+
+
+def __commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))) \
+            .decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', required=True,
+                        help="Path to the directory for storing results")
+    parser.add_argument('--output_file_name', default='benchmark.json')
+    parser.add_argument('--baseline_file_name', default=None,
+                        help="Results of a previous commit to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Relative slowdown or memory growth "
+                             "reported as a regression")
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+                        default=list(STAGES))
+    parser.add_argument('--images', type=int, default=10000,
+                        help="Number of images of all classes")
+    parser.add_argument('--classes', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=16,
+                        help="Number of concurrent requests or classes")
+    parser.add_argument('--latency', type=float, default=0.,
+                        help="Seconds the fake servers take to answer")
+    parser.add_argument('--error_rate', type=float, default=0.,
+                        help="Fraction of requests failed with HTTP 503")
+    parser.add_argument('--image_size', type=int, default=20 << 10,
+                        help="Size of served images in bytes")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of failures of the fake servers")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    # Every search call is logged otherwise
+    logging.getLogger('flickrapi').setLevel(logging.WARNING)
+
+    results = run_benchmarks(args.stages, args.images, args.classes,
+                             args.workers, args.latency, args.error_rate,
+                             args.image_size, args.seed)
+    report = {'commit': __commit(),
+              'python': sys.version.split()[0],
+              'parameters': {'images': args.images,
+                             'classes': args.classes,
+                             'workers': args.workers,
+                             'latency': args.latency,
+                             'error_rate': args.error_rate,
+                             'image_size': args.image_size,
+                             'seed': args.seed},
+              'stages': results}
+
+    regressions = []
+    if args.baseline_file_name:
+        with open(os.path.join(args.output_dir,
+                               args.baseline_file_name), 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            logging.warning('Regression of {}'.format(regression))
+        report['regressions'] = regressions
+
+    with open(os.path.join(args.output_dir, args.output_file_name), 'w') as f:
+        json.dump(report, f, indent=4)
+
+    for stage, result in results.items():
+        print('{}: {} items in {:.1f}s ({:.1f} items/s), peak RSS {:.1f} MB'
+              .format(stage, result['items'], result['seconds'],
+                      result['items_per_second'], result['peak_rss_mb']))
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
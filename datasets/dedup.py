@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import re
+import threading
+
+
+class DedupIndex:
+    """Persistent index of downloaded images by content and photo id.
+
+    Images are looked up by the sha1 of their content and by the Flickr
+    photo id parsed from the url, both in O(1) dict lookups. Claims are
+    kept in memory while downloads are in flight, so concurrent workers
+    never store the same image twice. A claim of an image in flight
+    waits until it is added or released, so only stored images are
+    returned as duplicates. Only stored images are appended to the
+    JSON Lines file backing the index.
+    Paths are stored relative to the index's directory.
+    """
+
+    __photo_id_pattern = re.compile(r'/(\d+)_[0-9a-zA-Z]+(?:_\w)?\.\w+$')
+
+    def __init__(self, path):
+        self.__path = path
+        self.__root = os.path.dirname(os.path.abspath(path))
+        self.__checksums = {}
+        self.__photo_ids = {}
+        # Paths of downloads in flight, by photo id or checksum
+        self.__photo_claims = {}
+        self.__content_claims = {}
+        self.__changed = threading.Condition()
+        self.__load()
+        self.__file = open(path, 'a')
+
+    def __load(self):
+        if not os.path.exists(self.__path):
+            return
+
+        with open(self.__path, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                    path = os.path.join(self.__root, entry['path'])
+                    self.__checksums[entry['checksum']] = path
+                    if entry['photo_id']:
+                        self.__photo_ids[entry['photo_id']] = path
+                except (ValueError, KeyError):
+                    logging.warning('Skipping invalid dedup index line {}'
+                                    .format(line_number))
+
+    @classmethod
+    def photo_id(cls, url):
+        match = cls.__photo_id_pattern.search(url or '')
+        return match.group(1) if match else None
+
+    def __claim(self, stored, claims, key, path):
+        path = os.path.abspath(path)
+        with self.__changed:
+            while True:
+                existing_path = stored.get(key)
+                if existing_path is not None:
+                    return existing_path if existing_path != path else None
+                if claims.setdefault(key, path) == path:
+                    return None
+                # Known only once the download in flight is finished
+                self.__changed.wait()
+
+    def __release(self, claims, key, path):
+        with self.__changed:
+            if claims.get(key) == os.path.abspath(path):
+                del claims[key]
+                self.__changed.notify_all()
+
+    def claim_photo(self, url, path):
+        """Returns the path already holding the url's photo or None.
+
+        Waits for a download of the photo in flight.
+        """
+        photo_id = self.photo_id(url)
+        if photo_id is None:
+            return None
+        return self.__claim(self.__photo_ids, self.__photo_claims,
+                            photo_id, path)
+
+    def release_photo(self, url, path):
+        """Drops the claim of a photo that could not be downloaded."""
+        self.__release(self.__photo_claims, self.photo_id(url), path)
+
+    def claim_content(self, checksum, path):
+        """Returns the path already holding the content or None.
+
+        Waits for a download of the content in flight.
+        """
+        return self.__claim(self.__checksums, self.__content_claims,
+                            checksum, path)
+
+    def release_content(self, checksum, path):
+        """Drops the claim of content that could not be stored."""
+        self.__release(self.__content_claims, checksum, path)
+
+    def add(self, url, checksum, path):
+        entry = {'checksum': checksum,
+                 'photo_id': self.photo_id(url),
+                 'path': os.path.relpath(path, self.__root)}
+        path = os.path.abspath(path)
+        with self.__changed:
+            self.__checksums[checksum] = path
+            self.__content_claims.pop(checksum, None)
+            if entry['photo_id']:
+                self.__photo_ids[entry['photo_id']] = path
+                self.__photo_claims.pop(entry['photo_id'], None)
+            self.__file.write(json.dumps(entry) + '\n')
+            self.__file.flush()
+            self.__changed.notify_all()
+
+    def __len__(self):
+        return len(self.__checksums)
+
+    def close(self):
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
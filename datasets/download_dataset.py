@@ -1,38 +1,191 @@
 import argparse
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+from http.client import HTTPException
+import io
 import json
 from math import floor, log10
 import logging
 import os
+import socket
+import tempfile
+import time
+from urllib.parse import urlparse
 from urllib.request import urlopen
 from urllib.error import HTTPError
+import zlib
 
 from tqdm import tqdm
 import yaml
 
+from dedup import DedupIndex
+from http_pool import ConnectionPool
+from inventory import Inventory
+import manifest as mf
+from metrics import Metrics, close_metrics, open_metrics
+from package_dataset import Packager
+from photo_columns import PhotoColumns
+from rate_limit import Retrier, RetryableError, TokenBucket, \
+    is_retryable_status, parse_retry_after
+from shards import ShardWriter
+from work_queue import WorkQueue
 
-def download_image(url, save_path):
+download_job = namedtuple('download_job', 'class_name url save_path')
+download_limits = namedtuple('download_limits',
+                             'max_size timeout chunk_size')
+# Flickr's small images take tens of kilobytes
+download_limits.__new__.__defaults__ = (20 << 20, 60., 64 << 10)
+
+
+def __read_body(resp, f, limits: download_limits):
+    """Copies the response to `f` in chunks and returns its size and sha1.
+
+    Chunks are read into one preallocated buffer, so memory stays
+    the same whatever the size of the image.
+    """
+    length = resp.headers.get('Content-Length') \
+        if hasattr(resp, 'headers') else None
+    if length is not None and length.isdigit() and \
+            int(length) > limits.max_size:
+        raise IOError('Image larger than {} bytes'.format(limits.max_size))
+
+    deadline = time.monotonic() + limits.timeout
+    buffer = bytearray(limits.chunk_size)
+    view = memoryview(buffer)
+    checksum = hashlib.sha1()
+    size = 0
+    while True:
+        if time.monotonic() > deadline:
+            raise socket.timeout('Download took more than {}s'
+                                 .format(limits.timeout))
+        count = resp.readinto(buffer)
+        if not count:
+            break
+        size += count
+        if size > limits.max_size:
+            raise IOError('Image larger than {} bytes'
+                          .format(limits.max_size))
+        checksum.update(view[:count])
+        f.write(view[:count])
+
+    return size, checksum.hexdigest()
+
+
+def __fetch_image_once(url, save_path, pool: ConnectionPool = None,
+                       dedup: DedupIndex = None, writer: ShardWriter = None,
+                       limits: download_limits = None,
+                       metrics: Metrics = None):
+    image_info = namedtuple('image_info', 'size checksum duplicate_of')
+    limits = limits or download_limits()
+    # Images are written to a temporary file renamed once complete,
+    # or buffered for a shard
+    if writer is not None:
+        f = io.BytesIO()
+    else:
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(save_path) or '.', prefix='.',
+            suffix='.part')
+        f = os.fdopen(fd, 'wb')
+
+    started = time.monotonic()
     try:
-        resp = urlopen(url)
-        with open(save_path, 'wb') as f:
-            f.write(resp.read())
-            return True
+        try:
+            request = pool.request(url) if pool else \
+                urlopen(url, timeout=limits.timeout)
+            with request as resp, f:
+                size, checksum = __read_body(resp, f, limits)
+                data = f.getvalue() if writer is not None else None
+            if metrics is not None:
+                metrics.inc('bytes', size, stage='download')
+
+        except HTTPError as err:
+            if is_retryable_status(err.code):
+                raise RetryableError(
+                    'Connection error: {}'.format(err),
+                    parse_retry_after(err.headers.get('Retry-After')))
+            raise
+
+        except (ConnectionError, socket.timeout, HTTPException) as err:
+            raise RetryableError('Connection error: {}'.format(err))
+
+        # Content already stored under a different url
+        # is not written again
+        duplicate_of = dedup.claim_content(checksum, save_path) \
+            if dedup is not None else None
+        if duplicate_of is None:
+            try:
+                if writer is not None:
+                    writer.write(save_path, data)
+                else:
+                    os.replace(temp_path, save_path)
+            except BaseException:
+                if dedup is not None:
+                    dedup.release_content(checksum, save_path)
+                raise
+
+    finally:
+        f.close()
+        if writer is None and os.path.exists(temp_path):
+            os.remove(temp_path)
+        if metrics is not None:
+            metrics.observe('download_seconds', time.monotonic() - started,
+                            stage='download')
+
+    return image_info(size=size, checksum=checksum,
+                      duplicate_of=duplicate_of)
+
+
+def fetch_image(url, save_path, pool: ConnectionPool = None,
+                retrier: Retrier = None, dedup: DedupIndex = None,
+                writer: ShardWriter = None, limits: download_limits = None,
+                metrics: Metrics = None):
+    try:
+        if retrier:
+            return retrier.call(__fetch_image_once, url, save_path, pool,
+                                dedup, writer, limits, metrics)
+        return __fetch_image_once(url, save_path, pool, dedup, writer,
+                                  limits, metrics)
+
+    except RetryableError as err:
+        logging.error(err)
+        error = 'connection'
 
     except HTTPError as err:
         logging.error('Connection error: {}'.format(err))
+        error = 'http'
 
     except IOError as err:
         logging.error('File error: {}'.format(err))
+        error = 'file'
+
+    if metrics is not None:
+        metrics.inc('errors', stage='download', kind=error,
+                    host=urlparse(url).netloc or 'local')
+    return None
 
-    return False
 
+def download_image(url, save_path, pool: ConnectionPool = None,
+                   retrier: Retrier = None):
+    return fetch_image(url, save_path, pool, retrier) is not None
 
-def __collect_download_info(urls: list, dir_name):
+
+def __collect_download_info(expected_files_count: int, dir_name,
+                            writer: ShardWriter = None,
+                            inventory: Inventory = None,
+                            downloaded_files_count=None):
     download_info = \
         namedtuple('download_info', 'downloaded expected')
 
-    downloaded_files_count = len(os.listdir(dir_name))
-    expected_files_count = len(urls)
+    # Counted by the caller when only a part of the class is expected
+    if downloaded_files_count is None and writer is not None:
+        downloaded_files_count = \
+            writer.class_count(os.path.basename(dir_name))
+    elif downloaded_files_count is None and inventory is not None:
+        downloaded_files_count = \
+            inventory.count(os.path.basename(dir_name))
+    elif downloaded_files_count is None:
+        downloaded_files_count = len(os.listdir(dir_name))
 
     if expected_files_count != downloaded_files_count:
         logging.warning('Downloaded {} files while {} was expected'.format(
@@ -42,44 +195,490 @@ def __collect_download_info(urls: list, dir_name):
                          expected=expected_files_count)
 
 
-def download_single_class_images(urls: list, output_dir):
-    digits = floor(log10(len(urls))) + 1
+def __image_jobs(urls: list, output_dir, manifest: mf.Manifest = None,
+                 taken_paths=None, offset=0, count=None):
+    # File names are padded to the size of the whole class,
+    # so pages of urls get the same names as the complete list
+    count = len(urls) if count is None else count
+    digits = floor(log10(max(count, 1))) + 1
+    taken_paths = taken_paths if taken_paths is not None else set()
+    class_name = os.path.basename(os.path.normpath(output_dir))
+
+    for i, url in enumerate(urls, offset):
+        # Urls already known to the manifest keep their file names
+        previous_path = manifest.path(url) if manifest else None
+        if previous_path:
+            yield download_job(class_name, url, previous_path)
+            continue
 
-    for i, url in enumerate(tqdm(urls)):
-        image_name = '{}.jpg'.format(str(i).zfill(digits))
-        save_path = os.path.join(output_dir, image_name)
+        image_name = str(i).zfill(digits)
+        save_path = os.path.join(output_dir, image_name + '.jpg')
+        suffix = 0
+        while os.path.abspath(save_path) in taken_paths:
+            # File name is owned by a different url from a previous run
+            suffix += 1
+            save_path = os.path.join(
+                output_dir, '{}_{}.jpg'.format(image_name, suffix))
+        taken_paths.add(os.path.abspath(save_path))
 
-        if not download_image(url, save_path):
+        yield download_job(class_name, url, save_path)
+
+
+def __store_duplicate(duplicate_of, save_path, link_duplicates) -> bool:
+    """Links a duplicate, returns whether its file exists."""
+    if not link_duplicates or os.path.exists(save_path):
+        return os.path.exists(save_path)
+
+    try:
+        os.link(duplicate_of, save_path)
+    except OSError as err:
+        logging.error('File error: {}'.format(err))
+        return False
+    return True
+
+
+def __download_job(job, pool=None, manifest: mf.Manifest = None,
+                   retrier=None, dedup: DedupIndex = None,
+                   link_duplicates=False, writer: ShardWriter = None,
+                   limits: download_limits = None, metrics: Metrics = None):
+    _, url, save_path = job
+    if manifest and manifest.is_done(url):
+        state = manifest.get(url)['state']
+        # Shards hold only images, duplicates may be linked files
+        return job, state, writer is not None and state == mf.DONE or \
+            writer is None and os.path.exists(save_path)
+
+    # Photo may be already stored for a different url or class
+    duplicate_of = dedup.claim_photo(url, save_path) \
+        if dedup is not None else None
+    image_info = None
+    if duplicate_of is None:
+        try:
+            image_info = fetch_image(url, save_path, pool, retrier, dedup,
+                                     writer, limits, metrics)
+        finally:
+            # Claims not stored are dropped, so waiting jobs go on
+            if dedup is not None and (image_info is None or
+                                      image_info.duplicate_of):
+                dedup.release_photo(url, save_path)
+        if image_info is None:
             logging.warning('Could not download image from {}'.format(url))
+        elif image_info.duplicate_of:
+            duplicate_of = image_info.duplicate_of
+        elif dedup is not None:
+            dedup.add(url, image_info.checksum, save_path)
 
-    return __collect_download_info(urls, output_dir)
+    if duplicate_of:
+        state = mf.DUPLICATE
+        stored = __store_duplicate(duplicate_of, save_path,
+                                   link_duplicates and writer is None)
+    else:
+        state = mf.FAILED if image_info is None else mf.DONE
+        stored = image_info is not None
 
+    if manifest:
+        if image_info is None:
+            manifest.record(url, save_path, state)
+        else:
+            manifest.record(url, save_path, state,
+                            image_info.size, image_info.checksum)
 
-def download_dataset(urls_data: dict, output_dir) -> list:
-    download_summary = []
+    return job, state, stored
+
+
+def download_images(jobs, workers=1, total=None, pool=None, manifest=None,
+                    retrier=None, on_done=None, dedup=None,
+                    link_duplicates=False, writer=None, limits=None,
+                    metrics=None):
+    """Downloads `download_job`s on a pool of `workers` threads.
+
+    `on_done` is called with every finished job, its manifest state
+    and whether its image is stored, from the calling thread.
+    """
+    # Keep a bounded number of jobs in flight so that
+    # the jobs iterator is consumed lazily
+    max_in_flight = workers * 4
+    in_flight = set()
+
+    def finish(done):
+        progress.update(len(done))
+        if on_done:
+            for future in done:
+                on_done(*future.result())
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            tqdm(total=total) as progress:
+        for job in jobs:
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                finish(done)
+            in_flight.add(
+                executor.submit(__download_job, job, pool, manifest, retrier,
+                                dedup, link_duplicates, writer, limits,
+                                metrics))
+
+        finish(wait(in_flight).done)
+
+
+def download_single_class_images(urls: list, output_dir, workers=1,
+                                 pool=None):
+    download_images(__image_jobs(urls, output_dir), workers, len(urls), pool)
+
+    return __collect_download_info(len(urls), output_dir)
+
+
+def urls_data_to_records(urls_data: dict):
     for class_name, urls in urls_data.items():
-        logging.info('Downloading images for the "{}" class'
-                     .format(class_name))
-        class_subdir = os.path.join(output_dir, class_name)
-        if not os.path.exists(class_subdir):
-            os.makedirs(class_subdir)
-
-        download_info = download_single_class_images(urls, class_subdir)
-        download_summary.append('Class {}: Downloaded: {} Expected: {}\n'
-                                .format(class_name,
-                                        download_info.downloaded,
-                                        download_info.expected))
+        yield {'class': class_name,
+               'count': None if urls is None else len(urls),
+               'offset': 0,
+               'urls': urls}
+
+
+def read_urls_records(path, follow=False, poll_interval=1.,
+                      idle_timeout=600.):
+    """Yields records of a JSON Lines file written by fetch_urls.py.
+
+    With `follow` the file is read while it is still being written,
+    until the end marker is found. TimeoutError is raised when nothing
+    is written for `idle_timeout` seconds, e.g. when fetching failed.
+    """
+    with open(path, 'r') as f:
+        line = ''
+        last_read = time.monotonic()
+        while True:
+            read = f.readline()
+            if read:
+                last_read = time.monotonic()
+            line += read
+            if not line.endswith('\n'):
+                if follow and \
+                        time.monotonic() - last_read > idle_timeout:
+                    raise TimeoutError(
+                        'Nothing was written to {} for {}s and no end '
+                        'marker was found, did fetching urls fail?'
+                        .format(path, idle_timeout))
+                if follow:
+                    time.sleep(poll_interval)
+                    continue
+                if line:
+                    logging.warning('Skipping incomplete line of {}'
+                                    .format(path))
+                logging.warning('No end marker found in {}, urls fetching '
+                                'may not be finished'.format(path))
+                return
+
+            record = json.loads(line)
+            line = ''
+            if record.get('done'):
+                return
+            if 'photos' in record:
+                record['urls'] = PhotoColumns.from_record(
+                    record.pop('photos'))
+            yield record
+
+
+def load_urls_records(path, follow=False, idle_timeout=600.):
+    if path.endswith('.jsonl'):
+        return read_urls_records(path, follow, idle_timeout=idle_timeout)
+
+    with open(path, 'r') as f:
+        return urls_data_to_records(json.load(f))
+
+
+def record_key(record) -> str:
+    return '{}/{}'.format(record['class'], record['offset'])
+
+
+def chunk_records(records, chunk_size=1000):
+    """Splits url records into records of at most `chunk_size` urls.
+
+    Chunks of a record are the units of work of sharded downloads.
+    """
+    for record in records:
+        urls = record['urls']
+        if not urls or len(urls) <= chunk_size:
+            yield record
+            continue
+
+        for start in range(0, len(urls), chunk_size):
+            yield dict(record, offset=record['offset'] + start,
+                       urls=urls[start:start + chunk_size])
+
+
+def shard_records(records, shard_index, num_shards):
+    """Yields records of one of `num_shards` shards of the urls.
+
+    Records go to shards by a stable hash of their keys, so every
+    worker given the same input takes its own part of it.
+    """
+    for record in records:
+        if zlib.crc32(record_key(record).encode('utf-8')) % num_shards == \
+                shard_index:
+            yield record
+
+
+def download_records(records, output_dir, workers=1,
+                     pool=None, manifest: mf.Manifest = None,
+                     retrier: Retrier = None, total=None,
+                     on_class_done=None, dedup: DedupIndex = None,
+                     link_duplicates=False,
+                     writer: ShardWriter = None,
+                     inventory: Inventory = None,
+                     limits: download_limits = None,
+                     metrics: Metrics = None,
+                     on_record_done=None, on_record_failed=None,
+                     partial=False) -> list:
+    """Downloads images of url records as they come from `records`.
+
+    A record holds the `class` name, its total url `count` and
+    a page of `urls` starting at `offset` within the class.
+    `on_class_done` is called with the class name as soon as
+    all urls of the class are processed.
+    With a `dedup` index, images already stored are skipped,
+    or hard-linked with `link_duplicates`.
+    With a shard `writer`, images are packed into its shards
+    instead of separate files in class directories.
+    Stored files are recorded in the `inventory`, which counts them
+    for the summary. Images breaking size or time `limits` are dropped.
+    Downloaded images, bytes, latencies and errors are counted
+    in `metrics`. `on_record_done` is called with every record whose
+    urls are all processed, records with failed urls are passed to
+    `on_record_failed` instead, when given.
+    With `partial` records, e.g. chunks of a sharded worker, a class is
+    expected to hold only the urls of its records and the summary
+    counts images stored for them, classes are done once all records
+    are processed.
+    """
+    # All downloads share one pool of keep-alive connections
+    if pool is None:
+        pool = ConnectionPool(pool_size=workers)
+
+    class_subdirs = {}
+    expected_counts = {}
+    finished_counts = defaultdict(int)
+    stored_counts = defaultdict(int)
+    duplicate_counts = defaultdict(int)
+    done_classes = set()
+    taken_paths = manifest.paths() if manifest else set()
+    # Records in progress, their jobs left and whether any of them
+    # failed, by numbers of records
+    open_records = {}
+    job_records = {}
+
+    def class_done(class_name):
+        done_classes.add(class_name)
+        if on_class_done:
+            on_class_done(class_name)
+
+    def record_finished(record_number):
+        record, _, failed = open_records.pop(record_number)
+        if failed and on_record_failed is not None:
+            on_record_failed(record)
+        else:
+            on_record_done(record)
+
+    def record_job_done(job, state):
+        record_number = job_records.pop(job.save_path, None)
+        if record_number not in open_records:
+            return
+        open_records[record_number][1] -= 1
+        if state == mf.FAILED:
+            open_records[record_number][2] = True
+        if open_records[record_number][1] == 0:
+            record_finished(record_number)
+
+    def job_done(job, state, stored):
+        if on_record_done is not None:
+            record_job_done(job, state)
+        if stored:
+            stored_counts[job.class_name] += 1
+            if inventory is not None:
+                inventory.add(job.save_path)
+        finished_counts[job.class_name] += 1
+        if metrics is not None:
+            metrics.inc('images', stage='download', state=state)
+        if state == mf.DUPLICATE:
+            duplicate_counts[job.class_name] += 1
+        if not partial and finished_counts[job.class_name] == \
+                expected_counts[job.class_name]:
+            class_done(job.class_name)
+
+    def record_jobs(record_number, record, class_subdir):
+        open_records[record_number] = [record, len(record['urls']), False]
+        for job in __image_jobs(record['urls'], class_subdir, manifest,
+                                taken_paths, record['offset'],
+                                record['count']):
+            job_records[job.save_path] = record_number
+            yield job
+        if not record['urls']:
+            record_finished(record_number)
+
+    def jobs():
+        for record_number, record in enumerate(records):
+            class_name = record['class']
+            if record['urls'] is None:
+                logging.error('No urls for the "{}" class'
+                              .format(class_name))
+                if on_record_done is not None:
+                    on_record_done(record)
+                continue
+
+            if class_name not in class_subdirs:
+                logging.info('Queueing images for the "{}" class'
+                             .format(class_name))
+                class_subdir = os.path.join(output_dir, class_name)
+                if writer is None and not os.path.exists(class_subdir):
+                    os.makedirs(class_subdir)
+                if inventory is not None:
+                    # Brings the listing up to date before adding files
+                    inventory.count(class_name)
+                class_subdirs[class_name] = class_subdir
+                expected_counts[class_name] = 0 if partial else record['count']
+            if partial:
+                expected_counts[class_name] += len(record['urls'])
+
+            if on_record_done is not None:
+                yield from record_jobs(record_number, record,
+                                       class_subdirs[class_name])
+                continue
+            yield from __image_jobs(record['urls'], class_subdirs[class_name],
+                                    manifest, taken_paths,
+                                    record['offset'], record['count'])
+
+    try:
+        download_images(jobs(), workers, total, pool, manifest, retrier,
+                        job_done, dedup, link_duplicates, writer, limits,
+                        metrics)
+    finally:
+        pool.close()
+
+    # Records with repeated urls are complete only now
+    for record_number in list(open_records):
+        record_finished(record_number)
+    # Classes with missing pages of urls are complete only now
+    for class_name in class_subdirs:
+        if class_name not in done_classes:
+            class_done(class_name)
+
+    download_summary = []
+    for class_name, class_subdir in class_subdirs.items():
+        download_info = \
+            __collect_download_info(expected_counts[class_name], class_subdir,
+                                    writer, inventory,
+                                    stored_counts[class_name]
+                                    if partial else None)
+        class_summary = 'Class {}: Downloaded: {} Expected: {}'.format(
+            class_name, download_info.downloaded, download_info.expected)
+        if dedup is not None:
+            class_summary += ' Duplicates: {}'.format(
+                duplicate_counts[class_name])
+        download_summary.append(class_summary + '\n')
     return download_summary
 
 
+def download_dataset(urls_data: dict, output_dir, workers=1,
+                     pool=None, manifest: mf.Manifest = None,
+                     retrier: Retrier = None, dedup: DedupIndex = None,
+                     link_duplicates=False,
+                     writer: ShardWriter = None,
+                     inventory: Inventory = None,
+                     limits: download_limits = None,
+                     metrics: Metrics = None) -> list:
+    total = sum(len(urls) for urls in urls_data.values() if urls is not None)
+    return download_records(urls_data_to_records(urls_data), output_dir,
+                            workers, pool, manifest, retrier, total,
+                            dedup=dedup, link_duplicates=link_duplicates,
+                            writer=writer, inventory=inventory,
+                            limits=limits, metrics=metrics)
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('--output_dir', required=True,
                         help="Path to the directory for storing results")
     parser.add_argument('--input_file_name', required=True)
     parser.add_argument('--output_file_name', required=True)
+    parser.add_argument('--workers', type=int, default=16,
+                        help="Number of concurrent downloads")
+    parser.add_argument('--pool_size', type=int, default=None,
+                        help="Idle connections kept per host, "
+                             "defaults to the number of workers")
+    parser.add_argument('--timeout', type=float, default=10.,
+                        help="Connection timeout in seconds")
+    parser.add_argument('--retries', type=int, default=3,
+                        help="Attempts per image on transient errors")
+    parser.add_argument('--requests_per_second', type=float, default=None,
+                        help="Download rate shared by all workers, "
+                             "unlimited by default")
+    parser.add_argument('--dedup_index_file_name',
+                        default='dedup_index.jsonl',
+                        help="Index of stored images used to skip "
+                             "duplicates across classes and runs")
+    parser.add_argument('--link_duplicates', action='store_true',
+                        help="Hard-link duplicates instead of skipping them")
+    parser.add_argument('--max_image_size', type=int, default=20 << 20,
+                        help="Images larger than this many bytes are "
+                             "dropped")
+    parser.add_argument('--download_timeout', type=float, default=60.,
+                        help="Seconds a single image may take to download")
+    parser.add_argument('--inventory_file_name', default='inventory.json',
+                        help="Cached listing of class directories")
+    parser.add_argument('--output_format', default='files',
+                        choices=['files', 'shards'],
+                        help="Store images as separate files in class "
+                             "directories or pack them into tar shards")
+    parser.add_argument('--shards_dir_name', default='shards')
+    parser.add_argument('--max_shard_size', type=int, default=1 << 30,
+                        help="Size of a shard in bytes")
+    parser.add_argument('--follow', action='store_true',
+                        help="Download urls of a JSON Lines input file "
+                             "while it is still being fetched")
+    parser.add_argument('--follow_timeout', type=float, default=600.,
+                        help="Seconds without new urls after which "
+                             "following the input fails")
+    parser.add_argument('--manifest_file_name',
+                        default='download_manifest.jsonl',
+                        help="Log of download states used to resume "
+                             "interrupted runs")
+    parser.add_argument('--package_dir_name', default=None,
+                        help="Pack classes into tar parts in this "
+                             "directory as soon as their downloads "
+                             "complete")
+    parser.add_argument('--max_part_size', type=int, default=1 << 30,
+                        help="Size of members of a part in bytes")
+    parser.add_argument('--metrics_file_name', default=None,
+                        help="JSON report of metrics shared by all scripts")
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help="Port serving metrics in Prometheus text "
+                             "format while running")
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help="Number of workers the urls are split "
+                             "between by a stable hash")
+    parser.add_argument('--shard_index', type=int, default=0,
+                        help="Shard of the urls downloaded by this worker")
+    parser.add_argument('--queue_file_name', default=None,
+                        help="SQLite queue shared by workers, which lease "
+                             "chunks of urls from it")
+    parser.add_argument('--worker_name', default=None,
+                        help="Directory of the worker's outputs, defaults "
+                             "to the shard or the host and process id")
+    parser.add_argument('--workers_dir_name', default='workers',
+                        help="Directory of outputs of sharded workers, "
+                             "combined by merge_workers.py")
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help="Urls of a unit of work of sharded workers")
+    parser.add_argument('--lease_seconds', type=float, default=300.,
+                        help="Seconds after which chunks of a worker that "
+                             "stopped renewing its leases are taken over")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error('--shard_index must be within --num_shards')
+    if (args.num_shards > 1 or args.queue_file_name) and \
+            args.output_format != 'files':
+        parser.error('Sharded workers store images as files')
+    return args
 
 
 def load_config(path):
@@ -95,11 +694,100 @@ def main():
     args = parse_arguments()
     logging.basicConfig(level=logging.INFO)
 
-    with open(os.path.join(args.output_dir, args.input_file_name), 'r') as f:
-        urls_data = json.load(f)
+    records = load_urls_records(
+        os.path.join(args.output_dir, args.input_file_name), args.follow,
+        args.follow_timeout)
 
-    summary = download_dataset(urls_data, args.output_dir)
-    with open(os.path.join(args.output_dir, args.output_file_name), 'w') as f:
+    # Sharded workers keep their outputs apart until they are merged
+    root_dir = args.output_dir
+    queue = None
+    on_record_done = None
+    on_record_failed = None
+    failed_keys = []
+    if args.num_shards > 1 or args.queue_file_name:
+        worker_name = args.worker_name or (
+            '{}-{}'.format(socket.gethostname(), os.getpid())
+            if args.queue_file_name else
+            'shard-{:04d}'.format(args.shard_index))
+        root_dir = os.path.join(args.output_dir, args.workers_dir_name,
+                                worker_name)
+        if not os.path.exists(root_dir):
+            os.makedirs(root_dir)
+        records = chunk_records(records, args.chunk_size)
+        if args.num_shards > 1:
+            records = shard_records(records, args.shard_index,
+                                    args.num_shards)
+        if args.queue_file_name:
+            queue = WorkQueue(os.path.join(args.output_dir,
+                                           args.queue_file_name),
+                              worker_name, args.lease_seconds)
+            records = queue.leased_records(
+                {record_key(record): record for record in records})
+
+            def complete_record(record):
+                queue.complete(record_key(record))
+
+            def hold_record(record):
+                # Released once done, so failed urls are not retried
+                # by this run over and over
+                failed_keys.append(record_key(record))
+
+            on_record_done = complete_record
+            on_record_failed = hold_record
+
+    pool = ConnectionPool(args.pool_size or args.workers, args.timeout)
+    manifest_path = os.path.join(root_dir, args.manifest_file_name)
+    rate_limiter = TokenBucket(args.requests_per_second, args.workers) \
+        if args.requests_per_second else None
+    metrics = open_metrics('download', args.metrics_file_name,
+                           args.metrics_port)
+    retrier = Retrier(args.retries, rate_limiter=rate_limiter,
+                      metrics=metrics, stage='download')
+    dedup_path = os.path.join(root_dir, args.dedup_index_file_name)
+    writer = ShardWriter(args.output_dir, args.shards_dir_name,
+                         args.max_shard_size) \
+        if args.output_format == 'shards' else None
+    inventory = Inventory(root_dir,
+                          os.path.join(root_dir, args.inventory_file_name)) \
+        if writer is None else None
+    limits = download_limits(args.max_image_size, args.download_timeout)
+    # Images in shards are packed already
+    packager = Packager(args.output_dir, args.package_dir_name,
+                        max_part_size=args.max_part_size) \
+        if args.package_dir_name and writer is None and \
+        root_dir == args.output_dir else None
+    try:
+        with mf.Manifest(manifest_path,
+                         check_files=writer is None) as manifest, \
+                DedupIndex(dedup_path) as dedup:
+            summary = download_records(records, root_dir,
+                                       args.workers, pool, manifest, retrier,
+                                       dedup=dedup,
+                                       on_class_done=packager.add_directory
+                                       if packager is not None else None,
+                                       link_duplicates=args.link_duplicates,
+                                       writer=writer, inventory=inventory,
+                                       limits=limits, metrics=metrics,
+                                       on_record_done=on_record_done,
+                                       on_record_failed=on_record_failed,
+                                       partial=root_dir != args.output_dir)
+    finally:
+        if queue is not None:
+            for key in failed_keys:
+                queue.release(key)
+            if failed_keys:
+                logging.warning('{} work units with failed downloads are '
+                                'left to other runs'.format(len(failed_keys)))
+            logging.info('Work units by state: {}'.format(queue.counts()))
+            queue.close()
+        if writer is not None:
+            writer.close()
+        if inventory is not None:
+            inventory.save()
+        if packager is not None:
+            packager.close()
+        close_metrics(metrics, root_dir, args.metrics_file_name)
+    with open(os.path.join(root_dir, args.output_file_name), 'w') as f:
         f.writelines(summary)
 
 
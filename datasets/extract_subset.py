@@ -1,25 +1,37 @@
 import argparse
-from collections import defaultdict
+from collections import OrderedDict
 import json
 import logging
 import os
 import random
+import re
 
-from jsonschema import validate
+from jsonschema import ValidationError, validate
+import numpy as np
 import yaml
 
+from metrics import close_metrics, count_images, open_metrics, stage_timer
+from split_index import SplitIndex, is_split_index, load_split, \
+    save_split
+
 
 def __get_schema():
+    # Entries are relative paths or shard locations of images
+    entry = {"anyOf": [{"type": "string"},
+                       {"type": "object",
+                        "properties": {"path": {"type": "string"}},
+                        "required": ["path"]}]}
     schema = {
         "type": "object",
         "properties": {
             "train": {"type": "array",
-                      "items":
-                          {"type": "string"}
+                      "items": entry
                       },
+            "val": {"type": "array",
+                    "items": entry
+                    },
             "test": {"type": "array",
-                     "items":
-                         {"type": "string"}
+                     "items": entry
                      }
         },
         "additionalProperties": False
@@ -27,80 +39,179 @@ def __get_schema():
     return schema
 
 
-def __paths_to_classes(paths: dict) -> dict:
-
-    classes = defaultdict(list)
-    for entry in paths:
-        class_ = os.path.dirname(entry)
-        file_name = os.path.basename(entry)
-        classes[class_].append(file_name)
-
-    return classes
-
-
-def __extract_subset(classes: dict, percentage: float, seed=42) -> dict:
-
-    if percentage > 100 or percentage < 0:
-        raise ValueError('Percentage should be between 0 and 100')
-    elif percentage > 1:
-        percentage /= 100.
-
-    subset = {}
-    for class_, file_names in classes.items():
-        random.seed(seed)
-        random.shuffle(file_names)
-
-        subset_size = int(len(file_names) * percentage)
-        logging.info('Extracting {} samples from the "{}" class'
-                     .format(subset_size, class_))
-        subset[class_] = file_names[:subset_size]
-
-    return subset
-
-
-def __classes_to_paths(classes: dict) -> list:
-
-    paths = []
-    for class_, file_names in classes.items():
-        paths.extend(
-            list(map(lambda x: os.path.join(class_, x), file_names))
-        )
-
-    return paths
-
-
-def __process_split(split: list, percentage, seed):
-    classes = __paths_to_classes(split)
-    subset = __extract_subset(classes, percentage, seed)
-    paths = __classes_to_paths(subset)
-
-    return paths
+def __is_valid_entry(entry):
+    # Mirrors items of the schema, checked while the split is streamed
+    if isinstance(entry, dict):
+        return isinstance(entry.get('path'), str)
+    return isinstance(entry, str)
+
+
+def __validated_entries(key, entries):
+    for entry in entries:
+        if not __is_valid_entry(entry):
+            logging.error('Input file is not formatted correctly: '
+                          'skipping {!r} in the "{}" set'.format(entry, key))
+            continue
+        yield entry
+
+
+def iter_split_sets(f, chunk_size=1 << 16):
+    """Yields keys and iterators of entries of a split JSON file.
+
+    Only the current chunk of the file is kept in memory, entries are
+    decoded one by one. Sets are read in order, the entries of a set
+    can't be iterated once the next set is taken.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'\s*')
+    buffer = ''
+    position = 0
+
+    def read_more():
+        nonlocal buffer, position
+        chunk = f.read(chunk_size)
+        if not chunk:
+            raise ValueError('Unexpected end of the split file')
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def peek():
+        nonlocal position
+        while True:
+            position = whitespace.match(buffer, position).end()
+            if position < len(buffer):
+                return buffer[position]
+            read_more()
+
+    def expect(characters):
+        nonlocal position
+        character = peek()
+        if character not in characters:
+            raise ValueError('Expected one of {!r} instead of {!r}'
+                             .format(characters, character))
+        position += 1
+        return character
+
+    def decode():
+        nonlocal position
+        peek()
+        while True:
+            try:
+                value, position = decoder.raw_decode(buffer, position)
+                return value
+            except ValueError:
+                # The value may continue in the next chunk
+                read_more()
+
+    def entries():
+        nonlocal position
+        expect('[')
+        if peek() == ']':
+            position += 1
+            return
+        while True:
+            yield decode()
+            if expect(',]') == ']':
+                return
+
+    expect('{')
+    if peek() == '}':
+        return
+    while True:
+        key = decode()
+        expect(':')
+        set_entries = entries()
+        yield key, set_entries
+        # Skip entries left unread
+        for _ in set_entries:
+            pass
+        if expect(',}') == '}':
+            return
+
+
+def extract_subsets(sets, percentages: list, seed=42) -> list:
+    """Extracts subsets of a split for every one of `percentages`.
+
+    `sets` are pairs of keys and entries, e.g. from `iter_split_sets`,
+    and are read once.
+    Every subset holds the same images as `extract` with the same seed:
+    a permutation of positions is shuffled once per class size,
+    subsets of all percentages are its leading positions.
+    """
+    fractions = []
+    for percentage in percentages:
+        if percentage > 100 or percentage < 0:
+            raise ValueError('Percentage should be between 0 and 100')
+        fractions.append(percentage / 100. if percentage > 1 else percentage)
+
+    schema = __get_schema()
+    permutations = {}
+    subsets = [OrderedDict() for _ in fractions]
+    for key, entries in sets:
+        try:
+            validate({key: []}, schema)
+        except ValidationError:
+            logging.error('Input file is not formatted correctly: '
+                          'unexpected "{}" set'.format(key))
+
+        classes = OrderedDict()
+        for entry in __validated_entries(key, entries):
+            path = entry['path'] if isinstance(entry, dict) else entry
+            classes.setdefault(path.rpartition(os.sep)[0], []).append(entry)
+
+        for subset in subsets:
+            subset[key] = []
+        for class_, class_entries in classes.items():
+            count = len(class_entries)
+            if count not in permutations:
+                permutation = list(range(count))
+                random.seed(seed)
+                random.shuffle(permutation)
+                permutations[count] = np.array(permutation, dtype=np.int64)
+
+            values = np.empty(count, dtype=object)
+            values[:] = class_entries
+            for subset, fraction in zip(subsets, fractions):
+                subset_size = int(count * fraction)
+                logging.info('Extracting {} samples from the "{}" class'
+                             .format(subset_size, class_))
+                subset[key].extend(
+                    values[permutations[count][:subset_size]].tolist())
+
+    return [dict(subset) for subset in subsets]
 
 
 def extract(train_test_split, percentage, seed):
-    try:
-        validate(train_test_split, __get_schema())
-    except ValueError:
-        logging.error('Input file is not formatted correctly')
-
-    dataset = {}
-    for key in train_test_split.keys():
-        dataset[key] = \
-            __process_split(train_test_split[key],
-                            percentage, seed)
-    return dataset
+    return extract_subsets(train_test_split.items(), [percentage], seed)[0]
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', required=True,
                         help="Path to the configuration file.")
-    parser.add_argument('--input_file_name', required=True)
+    parser.add_argument('--input_file_name', required=True,
+                        help="Split index when ending with .idx, "
+                             "JSON split otherwise")
     parser.add_argument('--output_dir', required=True,
                         help="Path to the directory for storing results")
-    parser.add_argument('--output_file_name', required=True)
-
-    return parser.parse_args()
+    parser.add_argument('--output_file_name', required=True, nargs='+',
+                        help="An output file for each percentage")
+    parser.add_argument('--percentages', type=float, nargs='+',
+                        default=None,
+                        help="Percentages of subsets extracted in one pass, "
+                             "defaults to the one in the config")
+    parser.add_argument('--metrics_file_name', default=None,
+                        help="JSON report of metrics shared by all scripts")
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help="Port serving metrics in Prometheus text "
+                             "format while running")
+
+    args = parser.parse_args()
+    # Without percentages the one of the config is extracted
+    if len(args.output_file_name) != len(args.percentages or [None]):
+        parser.error('expected an output file for each of {} percentages'
+                     .format(len(args.percentages or [None])))
+    return args
 
 
 def load_config(path):
@@ -118,14 +229,35 @@ def main():
     config = load_config(args.config)
     logging.basicConfig(level=logging.INFO)
 
-    with open(os.path.join(args.output_dir, args.input_file_name), 'r') as f:
-        dataset = json.load(f)
-
-    subset = extract(dataset, config['subset']['percentage'],
-                     config['subset']['seed'])
-
-    with open(os.path.join(args.output_dir, args.output_file_name), 'w') as f:
-        json.dump(subset, f, indent=4)
+    percentages = args.percentages or [config['subset']['percentage']]
+    metrics = open_metrics('extract', args.metrics_file_name,
+                           args.metrics_port)
+    input_path = os.path.join(args.output_dir, args.input_file_name)
+    output_paths = [os.path.join(args.output_dir, file_name)
+                    for file_name in args.output_file_name]
+    with stage_timer(metrics, 'extract'):
+        if is_split_index(input_path):
+            index = load_split(input_path)
+            subsets = [index.subset(percentage, config['subset']['seed'])
+                       for percentage in percentages]
+            for subset, output_path in zip(subsets, output_paths):
+                save_split(subset, output_path)
+            subsets = [subset.sets for subset in subsets]
+        else:
+            with open(input_path, 'r') as f:
+                subsets = extract_subsets(iter_split_sets(f), percentages,
+                                          config['subset']['seed'])
+
+            for subset, output_path in zip(subsets, output_paths):
+                if is_split_index(output_path):
+                    SplitIndex.from_json(subset).save(output_path)
+                    continue
+                with open(output_path, 'w') as f:
+                    json.dump(subset, f, indent=4)
+
+    for percentage, subset in zip(percentages, subsets):
+        count_images(metrics, 'extract', subset, percentage=percentage)
+    close_metrics(metrics, args.output_dir, args.metrics_file_name)
 
 
 if __name__ == "__main__":
@@ -1,42 +1,49 @@
 import argparse
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import json
 from math import ceil
 import logging
 import os
+import re
 import sys
 import time
+from urllib.parse import urlparse
 
 import flickrapi
+import requests
 from tqdm import tqdm
 import yaml
 
+from download_dataset import load_urls_records
+from metrics import Metrics, close_metrics, open_metrics
+from photo_columns import PhotoColumns, concatenate_urls
+from rate_limit import Retrier, RetryableError, TokenBucket, \
+    is_retryable_status
+from search_cache import SearchCache
 
-def retry(count: int):
-    def retry_decorator(func):
-        def func_wrapper(*args, **kwargs):
-            for _ in range(count):
-                result = func(*args, **kwargs)
-                if result:
-                    return result
-                time.sleep(2)
-        return func_wrapper
-    return retry_decorator
+fetched_page = namedtuple('fetched_page', 'class_name count offset urls')
 
 
 class Fetcher:
-    def __init__(self, flickrapi_object: flickrapi.FlickrAPI):
-        self.__flickrapi_object = flickrapi_object
+    # Flickr API error codes of temporarily unavailable service
+    __retryable_error_codes = (0, 105)
 
-    @staticmethod
-    def __build_url(photo_info):
-        try:
-            url = 'https://farm{farm}.staticflickr.com/'\
-                  '{server}/{id}_{secret}_m.jpg'.format(**photo_info)
-            return url
-        except KeyError as err:
-            logging.error('Key not found: {}'.format(err))
-        return None
+    def __init__(self, flickrapi_object: flickrapi.FlickrAPI,
+                 workers=1, requests_per_second=0.5,
+                 retrier: Retrier = None, cache: SearchCache = None,
+                 metrics: Metrics = None, prefetch=None):
+        self.__flickrapi_object = flickrapi_object
+        self.__workers = workers
+        # Pages of a class searched at once, all workers by default
+        self.__prefetch = prefetch or workers
+        self.__cache = cache
+        self.__metrics = metrics
+        # Single budget shared by all search workers
+        self.__retrier = retrier or \
+            Retrier(attempts=5,
+                    rate_limiter=TokenBucket(requests_per_second),
+                    metrics=metrics, stage='search')
 
     @staticmethod
     def __get_results_info(flickrapi_search_results):
@@ -49,39 +56,86 @@ class Fetcher:
                 pages_count * flickrapi_search_results['photos']['perpage']
             return search_results_info(pages_count=pages_count,
                                        photos_count=photos_count)
-        except KeyError as err:
+        except (KeyError, TypeError) as err:
             logging.error('Key not found: {}'.format(err))
 
         return None
 
-    @retry(5)
-    def __flickrapi_search(self, name, per_page, page):
-        if type(name) is str:
-            name = [name]
+    def __is_transient(self, err: flickrapi.exceptions.FlickrError):
+        if err.code in self.__retryable_error_codes:
+            return True
+
+        # HTTP errors are reported only in the message
+        status = re.search(r'Status code (\d+)', str(err))
+        return status is not None and \
+            is_retryable_status(int(status.group(1)))
+
+    def __count_error(self, kind):
+        if self.__metrics is not None:
+            self.__metrics.inc('errors', stage='search', kind=kind,
+                               host=urlparse(flickrapi.FlickrAPI.REST_URL)
+                               .netloc)
+
+    def __search_page(self, name, per_page, page):
+        started = time.monotonic()
         try:
             return self.__flickrapi_object.photos\
                 .search(tags=name, per_page=str(per_page), page=page)
         except flickrapi.exceptions.FlickrError as err:
+            self.__count_error('api')
+            if self.__is_transient(err):
+                raise RetryableError(err)
+            raise
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as err:
+            self.__count_error('connection')
+            raise RetryableError(err)
+        finally:
+            if self.__metrics is not None:
+                self.__metrics.observe('api_call_seconds',
+                                       time.monotonic() - started,
+                                       stage='search')
+
+    def __flickrapi_search(self, name, per_page, page):
+        if type(name) is str:
+            name = [name]
+
+        if self.__cache is not None:
+            results = self.__cache.get(name, per_page, page)
+            if self.__metrics is not None:
+                self.__metrics.inc('search_cache', stage='search',
+                                   result='miss' if results is None
+                                   else 'hit')
+            if results is not None:
+                return results
+
+        try:
+            results = self.__retrier.call(self.__search_page,
+                                          name, per_page, page)
+        except (flickrapi.exceptions.FlickrError, RetryableError) as err:
             logging.error(err)
+            return None
 
-        return None
+        # Only complete responses are reused
+        if self.__cache is not None and self.__get_results_info(results):
+            self.__cache.put(name, per_page, page, results)
+        return results
 
-    def __search_results_to_urls(self, flickrapi_search_results: dict)\
-            -> list:
+    @staticmethod
+    def __search_results_to_urls(flickrapi_search_results: dict) \
+            -> PhotoColumns:
         try:
-            return list(map(lambda x: self.__build_url(x),
-                            flickrapi_search_results['photos']['photo']))
-        except KeyError as err:
+            return PhotoColumns.from_photos(
+                flickrapi_search_results['photos']['photo'])
+        except (KeyError, TypeError) as err:
             logging.error(err)
 
         return None
 
-    def __fetch_class(self, name, count):
+    def __plan_class(self, name, count, flickrapi_search_results):
+        class_plan = namedtuple('class_plan', 'count per_page pages')
         per_page = min(500, count)
 
-        flickrapi_search_results =\
-            self.__flickrapi_search(name, per_page, page=1)
-
         search_results_info = self.__get_results_info(flickrapi_search_results)
         if not search_results_info:
             logging.error('Invalid API reponse')
@@ -97,37 +151,150 @@ class Fetcher:
         count = min(search_results_info.photos_count, count)
         pages_to_search = ceil(count / per_page)
 
-        urls = self.__search_results_to_urls(flickrapi_search_results)
-        # Return results from the first page
-        # if it has enough elements
-        if pages_to_search == 1:
-            return urls[:count]
-
-        # Iterate through next available pages
-        # if the first page is not enough
-        for page in tqdm(range(2, pages_to_search+2)):
-            flickrapi_search_results = \
-                self.__flickrapi_search(name, per_page, page=page)
-            urls.extend(self.__search_results_to_urls(flickrapi_search_results))
-
-            # Pause to not exceed API quota
-            time.sleep(2)
+        return class_plan(count=count, per_page=per_page,
+                          pages=pages_to_search)
 
-        return urls[:count]
+    def __page_urls(self, tag, page, results):
+        offset = (page - 1) * tag['per_page']
+        urls = self.__search_results_to_urls(results)
+        if urls is None:
+            logging.error('Missing urls of the {} class starting at {}'
+                          .format(tag['name'], offset))
+            return None
 
-    def fetch(self, classes: list) -> dict:
-        classes_urls = {}
+        # Urls fetched before are left out
+        skipped = max(0, tag['fetched'] - offset)
+        page_urls = urls[skipped:tag['count'] - offset]
+        if self.__metrics is not None:
+            self.__metrics.inc('pages', stage='search')
+            self.__metrics.inc('urls', len(page_urls), stage='search')
+        return fetched_page(tag['name'], tag['count'], offset + skipped,
+                            page_urls)
+
+    def iter_fetch(self, classes: list, fetched_counts: dict = None):
+        """Yields `fetched_page` tuples as soon as pages are searched.
+
+        Pages of different classes are interleaved and may come out of
+        order, `offset` is the position of the first url in the class.
+        A class with an invalid API response is reported once
+        with `count` and `urls` set to None.
+        With `fetched_counts` of classes, only urls after those
+        already fetched are searched.
+        Up to `prefetch` pages of every class are searched at once,
+        starting with the pages the requested count needs before the
+        first one tells how many there are. Pages past the available
+        photos are cancelled, or dropped when already searched.
+        """
+        fetched_counts = fetched_counts or {}
+        tags = []
+        for class_info in classes:
+            fetched_count = fetched_counts.get(class_info['name'], 0)
+            if fetched_count >= class_info['count']:
+                continue
+
+            per_page = min(500, class_info['count'])
+            first_page = fetched_count // per_page + 1
+            tags.append({'name': class_info['name'],
+                         'count': class_info['count'],
+                         'fetched': fetched_count,
+                         'per_page': per_page,
+                         'first_page': first_page,
+                         'next_page': first_page,
+                         'last_page': ceil(class_info['count'] / per_page),
+                         'in_flight': 0,
+                         'planned': False,
+                         'failed': False,
+                         'waiting': []})
+
+        with ThreadPoolExecutor(max_workers=self.__workers) as executor, \
+                tqdm(unit='page') as progress:
+            pages = {}
+            pending = set()
+
+            def search_next_pages(tag):
+                while tag['in_flight'] < self.__prefetch and \
+                        tag['next_page'] <= tag['last_page']:
+                    future = executor.submit(
+                        self.__flickrapi_search, tag['name'],
+                        tag['per_page'], page=tag['next_page'])
+                    pages[future] = (tag, tag['next_page'])
+                    pending.add(future)
+                    tag['in_flight'] += 1
+                    tag['next_page'] += 1
+
+            def cancel_pages(tag):
+                for future in list(pending):
+                    page_tag, page = pages[future]
+                    if page_tag is tag and \
+                            (tag['failed'] or page > tag['last_page']) and \
+                            future.cancel():
+                        pending.discard(future)
+                        pages.pop(future)
+                        tag['in_flight'] -= 1
+
+            # First pages of all classes are searched at once,
+            # they tell how many pages each class needs
+            for tag in tags:
+                search_next_pages(tag)
+
+            try:
+                while pending:
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    for future in done:
+                        progress.update(1)
+                        tag, page = pages.pop(future)
+                        tag['in_flight'] -= 1
+                        if tag['failed'] or page > tag['last_page']:
+                            continue
+
+                        if not tag['planned'] and page != tag['first_page']:
+                            # Prefetched before the first page came back
+                            tag['waiting'].append((page, future.result()))
+                            continue
+
+                        searched = [(page, future.result())]
+                        if page == tag['first_page']:
+                            plan = self.__plan_class(tag['name'],
+                                                     tag['count'],
+                                                     future.result())
+                            if plan is None:
+                                tag['failed'] = True
+                                cancel_pages(tag)
+                                yield fetched_page(tag['name'], None, 0,
+                                                   None)
+                                continue
+
+                            tag['planned'] = True
+                            tag['count'] = plan.count
+                            tag['last_page'] = plan.pages
+                            cancel_pages(tag)
+                            searched.extend(
+                                (waiting_page, results) for waiting_page,
+                                results in tag['waiting']
+                                if waiting_page <= tag['last_page'])
+                            tag['waiting'] = []
+
+                        # Next pages are searched concurrently
+                        # with other classes
+                        search_next_pages(tag)
+                        for searched_page, results in searched:
+                            fetched = self.__page_urls(tag, searched_page,
+                                                       results)
+                            if fetched is not None:
+                                yield fetched
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def fetch(self, classes: list, fetched_counts: dict = None) -> dict:
+        classes_pages = {}
         try:
-            for class_info in classes:
-                class_name = class_info['name']
-                class_count = class_info['count']
-
-                classes_urls[class_name] =\
-                    self.__fetch_class(class_name, class_count)
-
-                logging.warning('Fetched {} urls for the {} class'
-                                .format(len(classes_urls[class_name]),
-                                        class_name))
+            for page in self.iter_fetch(classes, fetched_counts):
+                if page.urls is None:
+                    classes_pages[page.class_name] = None
+                    continue
+                classes_pages.setdefault(page.class_name, []).append(page)
         except KeyError as err:
             logging.error(err)
         except TypeError as err:
@@ -136,9 +303,143 @@ class Fetcher:
             logging.warning('Stopped by user')
             sys.exit()
 
+        classes_urls = {}
+        for class_info in classes:
+            class_name = class_info.get('name')
+            if class_name not in classes_pages:
+                continue
+
+            pages = classes_pages[class_name]
+            if pages is None:
+                classes_urls[class_name] = None
+                continue
+
+            classes_urls[class_name] = concatenate_urls(
+                [page.urls for page in sorted(pages, key=lambda x: x.offset)])
+
+            logging.warning('Fetched {} urls for the {} class'
+                            .format(len(classes_urls[class_name]),
+                                    class_name))
+
         return classes_urls
 
 
+def page_to_record(page: fetched_page) -> dict:
+    return {'class': page.class_name,
+            'count': page.count,
+            'offset': page.offset,
+            'urls': page.urls}
+
+
+def record_to_json(record: dict) -> str:
+    """Serializes a url record, photos are written as packed columns."""
+    if isinstance(record['urls'], PhotoColumns):
+        record = dict(record)
+        record['photos'] = record.pop('urls').to_record()
+    return json.dumps(record)
+
+
+def write_pages(pages, f):
+    """Writes fetched pages to a JSON Lines file as they come.
+
+    The last line is an end marker, so readers following
+    the file know that fetching is complete.
+    """
+    for page in pages:
+        f.write(record_to_json(page_to_record(page)) + '\n')
+        f.flush()
+
+    f.write(json.dumps({'done': True}) + '\n')
+
+
+def records_to_urls_data(records) -> dict:
+    """Joins url records of classes into lists of urls.
+
+    Urls after a missing page are left out, so the urls of every
+    class come in the order they were searched in.
+    """
+    classes_pages = OrderedDict()
+    for record in records:
+        classes_pages.setdefault(record['class'], []).append(record)
+
+    urls_data = OrderedDict()
+    for class_name, pages in classes_pages.items():
+        if any(page['urls'] is None for page in pages):
+            urls_data[class_name] = None
+            continue
+
+        pages_urls = []
+        count = 0
+        for page in sorted(pages, key=lambda x: x['offset']):
+            if page['offset'] != count:
+                logging.warning('Missing urls of the {} class starting at {}'
+                                .format(class_name, count))
+                break
+            pages_urls.append(page['urls'])
+            count += len(page['urls'])
+        urls_data[class_name] = concatenate_urls(pages_urls)
+
+    return urls_data
+
+
+def merge_urls_data(urls_data: dict, fetched_urls: dict,
+                    classes: list) -> dict:
+    """Appends newly fetched urls of classes to the existing ones.
+
+    Classes follow the config, urls fetched before are kept in their
+    positions and repeated urls are skipped.
+    """
+    merged = OrderedDict()
+    for class_info in classes:
+        class_name = class_info['name']
+        urls = (urls_data.get(class_name) or [])[:class_info['count']]
+        new_urls = fetched_urls.get(class_name)
+        if not urls and new_urls is None and class_name in fetched_urls:
+            merged[class_name] = None
+            continue
+
+        new_urls = new_urls or []
+        packed = isinstance(new_urls, PhotoColumns) and \
+            (isinstance(urls, PhotoColumns) or not urls)
+        # Packed photos are told apart by their ids
+        keys = (lambda photos: photos.ids.tolist() if photos else []) \
+            if packed else list
+        known = set(keys(urls))
+        positions = []
+        for position, key in enumerate(keys(new_urls)):
+            if len(urls) + len(positions) == class_info['count']:
+                break
+            if key not in known:
+                known.add(key)
+                positions.append(position)
+
+        logging.warning('Added {} urls to the {} class'
+                        .format(len(positions), class_name))
+        merged[class_name] = \
+            concatenate_urls([urls, new_urls.take(positions)]) if packed \
+            else list(urls) + [new_urls[position] for position in positions]
+
+    return merged
+
+
+def load_urls_data(path) -> dict:
+    return records_to_urls_data(load_urls_records(path))
+
+
+def write_urls_data(urls_data: dict, path):
+    """Writes urls of classes at once, replacing the file atomically."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        if path.endswith('.jsonl'):
+            write_pages((fetched_page(class_name,
+                                      None if urls is None else len(urls),
+                                      0, urls)
+                         for class_name, urls in urls_data.items()), f)
+        else:
+            json.dump(urls_data, f, default=list)
+    os.replace(temp_path, path)
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', required=True,
@@ -146,6 +447,29 @@ def parse_arguments():
     parser.add_argument('--output_dir', required=True,
                         help="Path to the directory for storing results")
     parser.add_argument('--output_file_name', required=True)
+    parser.add_argument('--workers', type=int, default=4,
+                        help="Number of concurrent search requests")
+    parser.add_argument('--requests_per_second', type=float, default=0.5,
+                        help="Search requests rate shared by all workers")
+    parser.add_argument('--prefetch', type=int, default=None,
+                        help="Pages of a class searched at once, "
+                             "defaults to the number of search workers")
+    parser.add_argument('--cache_file_name', default=None,
+                        help="SQLite cache of search responses")
+    parser.add_argument('--cache_ttl', type=float, default=7 * 24 * 3600.,
+                        help="Seconds after which cached responses expire")
+    parser.add_argument('--cache_max_size', type=int, default=256 << 20,
+                        help="Size of cached responses in bytes")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Search again and replace cached responses")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Fetch only urls missing from the existing "
+                             "output file and merge them into it")
+    parser.add_argument('--metrics_file_name', default=None,
+                        help="JSON report of metrics shared by all scripts")
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help="Port serving metrics in Prometheus text "
+                             "format while running")
 
     return parser.parse_args()
 
@@ -168,11 +492,40 @@ def main():
     flickr = flickrapi.FlickrAPI(os.environ.get('API_KEY'),
                                  os.environ.get('API_SECRET'),
                                  format='parsed-json')
-    fetcher = Fetcher(flickr)
-    fetched_urls = fetcher.fetch(config['classes'])
-
-    with open(os.path.join(args.output_dir, args.output_file_name), 'w') as f:
-        json.dump(fetched_urls, f)
+    cache = SearchCache(os.path.join(args.output_dir, args.cache_file_name),
+                        args.cache_ttl, args.cache_max_size, args.refresh) \
+        if args.cache_file_name else None
+    metrics = open_metrics('fetch', args.metrics_file_name,
+                           args.metrics_port)
+    fetcher = Fetcher(flickr, args.workers, args.requests_per_second,
+                      cache=cache, metrics=metrics, prefetch=args.prefetch)
+
+    # JSON Lines output is written page by page,
+    # plain JSON only when all classes are fetched
+    output_path = os.path.join(args.output_dir, args.output_file_name)
+    try:
+        if args.incremental and os.path.exists(output_path):
+            urls_data = load_urls_data(output_path)
+            fetched_counts = {class_name: len(urls)
+                              for class_name, urls in urls_data.items()
+                              if urls is not None}
+            fetched_urls = fetcher.fetch(config['classes'], fetched_counts)
+            write_urls_data(merge_urls_data(urls_data, fetched_urls,
+                                            config['classes']), output_path)
+            return
+
+        if output_path.endswith('.jsonl'):
+            with open(output_path, 'w') as f:
+                write_pages(fetcher.iter_fetch(config['classes']), f)
+            return
+
+        fetched_urls = fetcher.fetch(config['classes'])
+        with open(output_path, 'w') as f:
+            json.dump(fetched_urls, f, default=list)
+    finally:
+        if cache is not None:
+            cache.close()
+        close_metrics(metrics, args.output_dir, args.metrics_file_name)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+import threading
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+from urllib.request import urlopen
+
+
+class ConnectionPool:
+    """Keeps idle keep-alive connections per (scheme, host, port).
+
+    At most `pool_size` idle connections are kept for every host.
+    Connections are created on demand when none is idle,
+    so the pool never blocks a caller.
+    """
+
+    __connection_classes = {'http': HTTPConnection,
+                            'https': HTTPSConnection}
+    __redirect_statuses = (301, 302, 303, 307, 308)
+    max_redirects = 5
+
+    def __init__(self, pool_size=10, timeout=10.):
+        self.__pool_size = pool_size
+        self.__timeout = timeout
+        self.__idle = defaultdict(list)
+        self.__lock = threading.Lock()
+
+    def __new_connection(self, key):
+        scheme, host, port = key
+        connection_class = self.__connection_classes[scheme]
+        return connection_class(host, port, timeout=self.__timeout)
+
+    def __get_connection(self, key):
+        with self.__lock:
+            if self.__idle[key]:
+                return self.__idle[key].pop(), True
+
+        return self.__new_connection(key), False
+
+    def __put_connection(self, key, connection, resp):
+        # Connection can be reused only if the body was consumed
+        if not resp.isclosed() or resp.will_close:
+            connection.close()
+            return
+
+        with self.__lock:
+            if len(self.__idle[key]) < self.__pool_size:
+                self.__idle[key].append(connection)
+                return
+        connection.close()
+
+    @staticmethod
+    def __send(connection, parts, headers):
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+
+        try:
+            connection.request('GET', target, headers=headers)
+            return connection.getresponse()
+        except Exception:
+            connection.close()
+            raise
+
+    def __open(self, parts, headers):
+        key = (parts.scheme.lower(), parts.hostname, parts.port)
+        connection, reused = self.__get_connection(key)
+        try:
+            return key, connection, self.__send(connection, parts, headers)
+        except (HTTPException, ConnectionError):
+            if not reused:
+                raise
+
+        # Idle connection was dropped by the server, retry on a fresh one
+        connection = self.__new_connection(key)
+        return key, connection, self.__send(connection, parts, headers)
+
+    @contextmanager
+    def request(self, url, headers=None):
+        """Yields a file-like response for the given url.
+
+        Non-HTTP urls (e.g. file://) fall back to `urlopen`.
+        Redirects are followed and error statuses raise `HTTPError`.
+        """
+        parts = urlsplit(url)
+        if parts.scheme.lower() not in self.__connection_classes:
+            with urlopen(url, timeout=self.__timeout) as resp:
+                yield resp
+            return
+
+        for _ in range(self.max_redirects + 1):
+            key, connection, resp = self.__open(parts, headers or {})
+            location = resp.getheader('Location')
+            if resp.status not in self.__redirect_statuses or not location:
+                break
+
+            resp.read()
+            self.__put_connection(key, connection, resp)
+            url = urljoin(url, location)
+            parts = urlsplit(url)
+
+        try:
+            if resp.status >= 300:
+                raise HTTPError(url, resp.status, resp.reason,
+                                resp.headers, None)
+            yield resp
+        except BaseException:
+            connection.close()
+            raise
+
+        self.__put_connection(key, connection, resp)
+
+    def close(self):
+        with self.__lock:
+            for connections in self.__idle.values():
+                for connection in connections:
+                    connection.close()
+            self.__idle.clear()
+
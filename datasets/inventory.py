@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import threading
+
+# Outputs stored next to the class directories: tar shards of images,
+# tar parts of the dataset and directories of sharded download workers
+NON_CLASS_DIR_NAMES = ('shards', 'package', 'workers')
+
+
+class Inventory:
+    """Cached listing of class directories with sizes and mtimes of files.
+
+    Directories are scanned with `os.scandir` once and the listing is
+    stored in a JSON file next to the outputs. A directory is scanned
+    again only when its mtime differs from the stored one, so checking
+    a class costs a single `stat`. Files added by the downloader are
+    recorded as they are written, without rescanning.
+    """
+
+    def __init__(self, root_dir, path=None):
+        self.__root = root_dir
+        self.__path = path
+        self.__classes = {}
+        self.__root_mtime = None
+        self.__class_names = []
+        self.__lock = threading.RLock()
+        self.__load()
+
+    def __load(self):
+        if self.__path is None or not os.path.exists(self.__path):
+            return
+
+        try:
+            with open(self.__path, 'r') as f:
+                data = json.load(f)
+            self.__root_mtime = data['root_mtime']
+            self.__class_names = data['class_names']
+            self.__classes = data['classes']
+        except (ValueError, KeyError):
+            logging.warning('Ignoring invalid inventory {}'
+                            .format(self.__path))
+
+    @staticmethod
+    def __mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def __scan_class(self, class_name):
+        class_dir = os.path.join(self.__root, class_name)
+        mtime = self.__mtime(class_dir)
+        files = {}
+        if mtime is not None:
+            with os.scandir(class_dir) as entries:
+                for entry in entries:
+                    # Hidden files are partial downloads
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        stat = entry.stat()
+                        files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+
+        self.__classes[class_name] = {'mtime': mtime, 'files': files}
+        return self.__classes[class_name]
+
+    def __class_entry(self, class_name):
+        with self.__lock:
+            entry = self.__classes.get(class_name)
+            class_dir = os.path.join(self.__root, class_name)
+            if entry is None or entry['mtime'] != self.__mtime(class_dir):
+                entry = self.__scan_class(class_name)
+            return entry
+
+    def class_names(self) -> list:
+        """Returns sorted names of directories in the root directory."""
+        with self.__lock:
+            mtime = self.__mtime(self.__root)
+            if mtime != self.__root_mtime:
+                with os.scandir(self.__root) as entries:
+                    self.__class_names = sorted(
+                        entry.name for entry in entries if entry.is_dir())
+                self.__root_mtime = mtime
+            return list(self.__class_names)
+
+    def dataset_class_names(self, manifest=None,
+                            excluded=NON_CLASS_DIR_NAMES) -> list:
+        """Returns sorted names of directories holding images of classes.
+
+        With a download `manifest` recording any images, classes are
+        the directories of its images. Otherwise all directories but
+        the `excluded` outputs of other steps are classes.
+        """
+        class_names = [class_name for class_name in self.class_names()
+                       if class_name not in excluded]
+        if manifest is None or not manifest.records():
+            return class_names
+
+        root = os.path.abspath(self.__root)
+        manifest_class_names = set()
+        for record in manifest.records():
+            manifest_class_names.add(os.path.dirname(os.path.relpath(
+                os.path.abspath(manifest.path(record['url'])), root)))
+        return [class_name for class_name in class_names
+                if class_name in manifest_class_names]
+
+    def file_names(self, class_name) -> list:
+        return sorted(self.__class_entry(class_name)['files'])
+
+    def class_file_names(self, class_names: list = None) -> dict:
+        if class_names is None:
+            class_names = self.class_names()
+        return {class_name: self.file_names(class_name)
+                for class_name in class_names}
+
+    def count(self, class_name) -> int:
+        return len(self.__class_entry(class_name)['files'])
+
+    def size(self, class_name) -> int:
+        return sum(size for size, _ in
+                   self.__class_entry(class_name)['files'].values())
+
+    def add(self, path):
+        """Records a file written to a class directory."""
+        class_dir, file_name = os.path.split(
+            os.path.relpath(path, self.__root))
+        stat = os.stat(path)
+        with self.__lock:
+            # Cached listings stay valid, the change is the file itself
+            entry = self.__classes.get(class_dir)
+            if entry is None:
+                entry = self.__scan_class(class_dir)
+            entry['files'][file_name] = [stat.st_size, stat.st_mtime_ns]
+            entry['mtime'] = self.__mtime(os.path.join(self.__root,
+                                                       class_dir))
+
+    def save(self):
+        if self.__path is None:
+            return
+
+        with self.__lock:
+            data = {'root_mtime': self.__root_mtime,
+                    'class_names': self.__class_names,
+                    'classes': self.__classes}
+            # Replaced at once, readers never see a partial inventory
+            temp_path = self.__path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.__path)
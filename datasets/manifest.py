@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import threading
+
+DONE = 'done'
+FAILED = 'failed'
+DUPLICATE = 'duplicate'
+# Downloaded, but removed as corrupt or a placeholder
+INVALID = 'invalid'
+
+
+class Manifest:
+    """Append-only JSON Lines log of download states keyed by url.
+
+    Every state change is appended as a single line and flushed,
+    so a crashed run loses at most the downloads in flight.
+    The last line recorded for a url wins when the log is replayed.
+    Paths are stored relative to the manifest's directory.
+    Without `check_files`, completed downloads are trusted without
+    looking for their files, e.g. when images are packed into shards.
+    """
+
+    def __init__(self, path, check_files=True):
+        self.__path = path
+        self.__check_files = check_files
+        self.__root = os.path.dirname(os.path.abspath(path))
+        self.__records = {}
+        self.__lock = threading.Lock()
+        self.__load()
+        self.__file = open(path, 'a')
+
+    def __load(self):
+        if not os.path.exists(self.__path):
+            return
+
+        with open(self.__path, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                    self.__records[record['url']] = record
+                except (ValueError, KeyError):
+                    # Last line may be truncated by a crash
+                    logging.warning('Skipping invalid manifest line {}'
+                                    .format(line_number))
+
+        logging.info('Loaded {} manifest records'
+                     .format(len(self.__records)))
+
+    def get(self, url):
+        return self.__records.get(url)
+
+    def path(self, url):
+        record = self.get(url)
+        if record is None:
+            return None
+        return os.path.join(self.__root, record['path'])
+
+    def is_done(self, url):
+        record = self.get(url)
+        if record is None:
+            return False
+        if record['state'] in (DUPLICATE, INVALID):
+            return True
+        return record['state'] == DONE and (
+            not self.__check_files or
+            os.path.exists(os.path.join(self.__root, record['path'])))
+
+    def paths(self) -> set:
+        return {os.path.join(self.__root, record['path'])
+                for record in self.__records.values()}
+
+    def record(self, url, path, state, size=None, checksum=None):
+        record = {'url': url,
+                  'path': os.path.relpath(path, self.__root),
+                  'state': state,
+                  'size': size,
+                  'checksum': checksum}
+        with self.__lock:
+            self.__records[url] = record
+            self.__file.write(json.dumps(record) + '\n')
+            self.__file.flush()
+
+    def records(self) -> list:
+        return list(self.__records.values())
+
+    def close(self):
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,155 @@
+import argparse
+from collections import OrderedDict, defaultdict
+import logging
+import os
+import shutil
+
+from download_dataset import load_urls_records
+from inventory import Inventory
+import manifest as mf
+from work_queue import DONE, WorkQueue
+
+
+def __append_lines(source_path, target_path):
+    if not os.path.exists(source_path):
+        return
+
+    with open(source_path, 'r') as source, open(target_path, 'a') as target:
+        for line in source:
+            # Last line may be truncated by a crash
+            if line.endswith('\n'):
+                target.write(line)
+
+
+def __move_images(worker_dir, output_dir) -> set:
+    class_names = set()
+    with os.scandir(worker_dir) as entries:
+        class_dirs = [entry.name for entry in entries if entry.is_dir()]
+
+    for class_name in class_dirs:
+        class_dir = os.path.join(output_dir, class_name)
+        if not os.path.exists(class_dir):
+            os.makedirs(class_dir)
+        with os.scandir(os.path.join(worker_dir, class_name)) as entries:
+            for entry in entries:
+                # Hidden files are partial downloads
+                if entry.is_file() and not entry.name.startswith('.'):
+                    os.replace(entry.path,
+                               os.path.join(class_dir, entry.name))
+        class_names.add(class_name)
+
+    return class_names
+
+
+def merge_workers(output_dir, records, workers_dir_name='workers',
+                  manifest_file_name='download_manifest.jsonl',
+                  dedup_index_file_name='dedup_index.jsonl',
+                  inventory_file_name='inventory.json',
+                  report_file_names=()) -> list:
+    """Combines outputs of sharded download workers.
+
+    Images of every worker directory are moved into class directories
+    of the output directory and their manifest and dedup index lines
+    are appended to the shared ones. Paths in them are relative to the
+    worker directory, which mirrors the output directory, so they stay
+    valid. Reports of workers, e.g. summaries and metrics, are kept as
+    `<worker name>-<file name>` in the output directory. Merged worker
+    directories are removed. Returns summary lines of classes of url
+    `records`, counted by the inventory.
+    """
+    workers_dir = os.path.join(output_dir, workers_dir_name)
+    worker_names = sorted(os.listdir(workers_dir)) \
+        if os.path.exists(workers_dir) else []
+    for worker_name in worker_names:
+        worker_dir = os.path.join(workers_dir, worker_name)
+        class_names = __move_images(worker_dir, output_dir)
+        for file_name in (manifest_file_name, dedup_index_file_name):
+            __append_lines(os.path.join(worker_dir, file_name),
+                           os.path.join(output_dir, file_name))
+        for file_name in report_file_names:
+            report_path = os.path.join(worker_dir, file_name)
+            if os.path.exists(report_path):
+                os.replace(report_path, os.path.join(
+                    output_dir, '{}-{}'.format(worker_name, file_name)))
+        shutil.rmtree(worker_dir)
+        logging.info('Merged {} classes of the {} worker'
+                     .format(len(class_names), worker_name))
+    if os.path.exists(workers_dir) and not os.listdir(workers_dir):
+        os.rmdir(workers_dir)
+
+    expected_counts = OrderedDict()
+    for record in records:
+        expected_counts.setdefault(record['class'], record['count'])
+
+    duplicate_counts = defaultdict(int)
+    manifest_path = os.path.join(output_dir, manifest_file_name)
+    if os.path.exists(manifest_path):
+        with mf.Manifest(manifest_path, check_files=False) as manifest:
+            for record in manifest.records():
+                if record['state'] == mf.DUPLICATE:
+                    class_name = os.path.dirname(record['path'])
+                    duplicate_counts[class_name] += 1
+
+    inventory = Inventory(output_dir,
+                          os.path.join(output_dir, inventory_file_name))
+    summary = []
+    for class_name, expected in expected_counts.items():
+        summary.append(
+            'Class {}: Downloaded: {} Expected: {} Duplicates: {}\n'.format(
+                class_name, inventory.count(class_name), expected,
+                duplicate_counts[class_name]))
+    inventory.save()
+
+    return summary
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', required=True,
+                        help="Path to the directory with results")
+    parser.add_argument('--input_file_name', required=True,
+                        help="Urls downloaded by the workers")
+    parser.add_argument('--output_file_name', required=True,
+                        help="Summary of the combined downloads")
+    parser.add_argument('--workers_dir_name', default='workers')
+    parser.add_argument('--queue_file_name', default=None,
+                        help="Queue of the workers, checked for units "
+                             "not done yet")
+    parser.add_argument('--manifest_file_name',
+                        default='download_manifest.jsonl')
+    parser.add_argument('--dedup_index_file_name',
+                        default='dedup_index.jsonl')
+    parser.add_argument('--inventory_file_name', default='inventory.json')
+    parser.add_argument('--report_file_names', nargs='*', default=[],
+                        help="Reports of workers to keep, e.g. summaries "
+                             "and metrics")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.queue_file_name:
+        with WorkQueue(os.path.join(args.output_dir, args.queue_file_name),
+                       'merge') as queue:
+            counts = queue.counts()
+        left = sum(count for state, count in counts.items() if state != DONE)
+        if left:
+            logging.warning('{} work units are not done, run workers '
+                            'again to download them'.format(left))
+
+    summary = merge_workers(
+        args.output_dir,
+        load_urls_records(os.path.join(args.output_dir,
+                                       args.input_file_name)),
+        args.workers_dir_name, args.manifest_file_name,
+        args.dedup_index_file_name, args.inventory_file_name,
+        args.report_file_names)
+    with open(os.path.join(args.output_dir, args.output_file_name), 'w') as f:
+        f.writelines(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import os
+import threading
+import time
+
+# Upper bounds in seconds, from a cached page to a stalled download
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.,
+                   30., 60.)
+# Whole stages of a build take minutes to hours
+STAGE_BUCKETS = (1., 10., 60., 300., 900., 3600., 4 * 3600., 12 * 3600.)
+
+
+class Metrics:
+    """Counters and histograms of a script, labelled by stage, host etc.
+
+    The JSON report holds every counter with its rate per second
+    since the start, and every histogram with its count, sum and
+    cumulative buckets. Reports of all scripts are merged into one
+    file under their names. While running, the metrics can be served
+    in Prometheus text format.
+    """
+
+    __prefix = 'datasets_'
+
+    def __init__(self, name, clock=time.time):
+        self.name = name
+        self.__clock = clock
+        self.__started = clock()
+        self.__counters = {}
+        self.__histograms = {}
+        self.__buckets = {}
+        self.__lock = threading.Lock()
+        self.__server = None
+
+    @staticmethod
+    def __labels(labels: dict) -> tuple:
+        return tuple(sorted((key, str(value))
+                            for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.__labels(labels)
+        with self.__lock:
+            counter = self.__counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self.__labels(labels)
+        with self.__lock:
+            # Buckets are fixed by the first observation
+            buckets = self.__buckets.setdefault(name, tuple(buckets))
+            histogram = self.__histograms.setdefault(name, {})
+            counts = histogram.setdefault(key, [0] * (len(buckets) + 2))
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes the time spent in the block, also when it fails."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def value(self, name, **labels):
+        """Returns a counter, or the count of a histogram."""
+        key = self.__labels(labels)
+        with self.__lock:
+            if name in self.__histograms:
+                return self.__histograms[name].get(key, [0])[-1]
+            return self.__counters.get(name, {}).get(key, 0)
+
+    def report(self) -> dict:
+        elapsed = self.__clock() - self.__started
+        with self.__lock:
+            counters = {
+                name: [{'labels': dict(key), 'value': value,
+                        'rate': value / elapsed if elapsed > 0 else 0.}
+                       for key, value in sorted(counter.items())]
+                for name, counter in self.__counters.items()}
+            histograms = {
+                name: [{'labels': dict(key), 'count': counts[-1],
+                        'sum': counts[-2],
+                        'mean': counts[-2] / counts[-1]
+                        if counts[-1] else 0.,
+                        'buckets': dict(zip(map(str, self.__buckets[name]),
+                                            counts[:-2]))}
+                       for key, counts in sorted(histogram.items())]
+                for name, histogram in self.__histograms.items()}
+
+        return {'elapsed': elapsed,
+                'counters': counters,
+                'histograms': histograms}
+
+    @staticmethod
+    def __format_labels(key, extra=()):
+        labels = list(key) + list(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(label, value.replace('\\', r'\\')
+                             .replace('"', r'\"').replace('\n', r'\n'))
+            for label, value in labels) + '}'
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self.__lock:
+            for name, counter in sorted(self.__counters.items()):
+                metric = self.__prefix + name + '_total'
+                lines.append('# TYPE {} counter'.format(metric))
+                for key, value in sorted(counter.items()):
+                    lines.append('{}{} {}'.format(
+                        metric, self.__format_labels(key), value))
+
+            for name, histogram in sorted(self.__histograms.items()):
+                metric = self.__prefix + name
+                lines.append('# TYPE {} histogram'.format(metric))
+                bounds = [repr(float(bound)) for bound in
+                          self.__buckets[name]] + ['+Inf']
+                for key, counts in sorted(histogram.items()):
+                    for bound, count in zip(bounds,
+                                            counts[:-2] + [counts[-1]]):
+                        lines.append('{}_bucket{} {}'.format(
+                            metric,
+                            self.__format_labels(key, [('le', bound)]),
+                            count))
+                    lines.append('{}_sum{} {}'.format(
+                        metric, self.__format_labels(key), counts[-2]))
+                    lines.append('{}_count{} {}'.format(
+                        metric, self.__format_labels(key), counts[-1]))
+
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path):
+        """Stores the report in `path` next to reports of other scripts."""
+        reports = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    reports = json.load(f)
+            except ValueError:
+                logging.warning('Replacing invalid metrics report {}'
+                                .format(path))
+        reports[self.name] = self.report()
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(reports, f, indent=4, sort_keys=True)
+        os.replace(temp_path, path)
+
+    def serve(self, port, host='0.0.0.0'):
+        """Serves metrics in Prometheus text format from a thread.
+
+        All interfaces are listened on by default, so the port
+        published by `make dev` reaches the container.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = HTTPServer((host, port), Handler)
+        threading.Thread(target=self.__server.serve_forever,
+                         daemon=True).start()
+        logging.info('Serving metrics on port {}'
+                     .format(self.__server.server_address[1]))
+        return self.__server.server_address[1]
+
+    def close(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_metrics(name, file_name=None, port=None) -> Metrics:
+    """Creates metrics of a script from its command line arguments.
+
+    Returns None when neither a report file nor a port is given.
+    """
+    if file_name is None and port is None:
+        return None
+
+    metrics = Metrics(name)
+    if port is not None:
+        metrics.serve(port)
+    return metrics
+
+
+def close_metrics(metrics: Metrics, output_dir, file_name=None):
+    if metrics is None:
+        return
+
+    metrics.close()
+    if file_name is not None:
+        metrics.save(os.path.join(output_dir, file_name))
+
+
+@contextmanager
+def stage_timer(metrics: Metrics, stage):
+    """Observes the time of a pipeline stage, when there are metrics."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics.observe('stage_seconds', time.monotonic() - started,
+                            buckets=STAGE_BUCKETS, stage=stage)
+
+
+def count_images(metrics: Metrics, stage, train_test_split: dict, **labels):
+    """Counts images in every set of a split."""
+    if metrics is None:
+        return
+
+    for key, entries in train_test_split.items():
+        metrics.inc('images', len(entries), stage=stage, set=key, **labels)
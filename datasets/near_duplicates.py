@@ -0,0 +1,267 @@
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import json
+import logging
+import os
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from inventory import NON_CLASS_DIR_NAMES, Inventory
+import manifest as mf
+
+# Sizes of grayscale thumbnails each hash is computed from
+__thumbnail_sizes = {'ahash': (8, 8), 'dhash': (9, 8), 'phash': (32, 32)}
+
+__popcount16 = np.array([bin(i).count('1') for i in range(1 << 16)],
+                        dtype=np.uint8)
+
+
+def __dct_matrix(size):
+    k = np.arange(size)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2. / size)
+
+
+def __load_thumbnail(path, size):
+    with Image.open(path) as image:
+        # Let the JPEG decoder downscale, it's much faster than resizing
+        image.draft('L', (size[0] * 4, size[1] * 4))
+        thumbnail = image.convert('L').resize(size, Image.BILINEAR)
+        return np.asarray(thumbnail, dtype=np.float32)
+
+
+def __pack_bits(bits):
+    packed = np.packbits(bits.reshape(len(bits), 64), axis=1)
+    return packed.view('>u8').ravel().astype(np.uint64)
+
+
+def hash_thumbnails(thumbnails, method='dhash'):
+    """Computes 64-bit hashes of a (n, height, width) thumbnails batch."""
+    if method == 'ahash':
+        mean = thumbnails.mean(axis=(1, 2), keepdims=True)
+        return __pack_bits(thumbnails > mean)
+
+    if method == 'dhash':
+        return __pack_bits(thumbnails[:, :, 1:] > thumbnails[:, :, :-1])
+
+    if method == 'phash':
+        dct = __dct_matrix(thumbnails.shape[1])
+        coefficients = np.einsum('ij,njk,lk->nil', dct, thumbnails, dct)
+        low = coefficients[:, :8, :8].reshape(len(thumbnails), 64)
+        median = np.median(low[:, 1:], axis=1, keepdims=True)
+        return __pack_bits(low > median)
+
+    raise ValueError('Unknown hash method: {}'.format(method))
+
+
+def __hash_chunk(args):
+    paths, method = args
+    size = __thumbnail_sizes[method]
+    thumbnails = np.zeros((len(paths), size[1], size[0]), dtype=np.float32)
+    valid = np.ones(len(paths), dtype=bool)
+    for i, path in enumerate(paths):
+        try:
+            thumbnails[i] = __load_thumbnail(path, size)
+        except (IOError, OSError, ValueError) as err:
+            logging.error('Could not decode {}: {}'.format(path, err))
+            valid[i] = False
+
+    return hash_thumbnails(thumbnails, method), valid
+
+
+def compute_hashes(paths: list, method='dhash', workers=None,
+                   chunk_size=256):
+    """Returns hashes of images and a mask of successfully decoded ones.
+
+    Images are decoded and hashed in chunks on a pool of processes.
+    """
+    if method not in __thumbnail_sizes:
+        raise ValueError('Unknown hash method: {}'.format(method))
+
+    chunks = [(paths[i:i + chunk_size], method)
+              for i in range(0, len(paths), chunk_size)]
+    hashes = np.zeros(len(paths), dtype=np.uint64)
+    valid = np.zeros(len(paths), dtype=bool)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(__hash_chunk, chunks)
+        for i, (chunk_hashes, chunk_valid) in \
+                enumerate(tqdm(results, total=len(chunks))):
+            start = i * chunk_size
+            hashes[start:start + len(chunk_hashes)] = chunk_hashes
+            valid[start:start + len(chunk_valid)] = chunk_valid
+
+    return hashes, valid
+
+
+def hamming_distance(a, b):
+    x = np.bitwise_xor(a, b)
+    distance = np.zeros(x.shape, dtype=np.uint8)
+    for shift in (0, 16, 32, 48):
+        distance += __popcount16[(x >> np.uint64(shift)) &
+                                 np.uint64(0xffff)]
+    return distance
+
+
+class HashIndex:
+    """Array-backed index of image hashes for near-duplicate search.
+
+    Near-duplicates are found with multi-index hashing: hashes are cut
+    into `threshold + 1` bit ranges and, by the pigeonhole principle,
+    any two hashes within `threshold` bits are equal on at least one of
+    them. Only hashes sharing a bucket are compared, never all pairs.
+    """
+
+    def __init__(self, hashes, paths: list):
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.paths = list(paths)
+
+    @staticmethod
+    def __bit_ranges(threshold):
+        bounds = np.linspace(0, 64, threshold + 2).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def __candidate_buckets(self, start, stop):
+        width = stop - start
+        mask = np.uint64((1 << width) - 1)
+        keys = (self.hashes >> np.uint64(64 - stop)) & mask
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        bounds = np.flatnonzero(np.diff(sorted_keys)) + 1
+        for bucket in np.split(order, bounds):
+            if len(bucket) > 1:
+                yield bucket
+
+    def find_groups(self, threshold=4) -> list:
+        """Returns lists of indices of images within `threshold` bits."""
+        parents = np.arange(len(self.hashes))
+
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for start, stop in self.__bit_ranges(threshold):
+            for bucket in self.__candidate_buckets(start, stop):
+                bucket_hashes = self.hashes[bucket]
+                distances = hamming_distance(bucket_hashes[:, None],
+                                             bucket_hashes[None, :])
+                for i, j in zip(*np.nonzero(np.triu(distances <= threshold,
+                                                    k=1))):
+                    root_i, root_j = find(bucket[i]), find(bucket[j])
+                    if root_i != root_j:
+                        parents[max(root_i, root_j)] = min(root_i, root_j)
+
+        groups = defaultdict(list)
+        for i in range(len(self.hashes)):
+            groups[find(i)].append(i)
+
+        return [group for group in groups.values() if len(group) > 1]
+
+    def find_path_groups(self, threshold=4) -> list:
+        return [[self.paths[i] for i in group]
+                for group in self.find_groups(threshold)]
+
+    def save(self, path):
+        np.savez(path, hashes=self.hashes, paths=np.array(self.paths))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['hashes'], data['paths'].tolist())
+
+
+def build_index(parent_dir_name, class_dir_names: list = None,
+                method='dhash', workers=None, inventory: Inventory = None,
+                manifest: mf.Manifest = None,
+                excluded_dir_names=NON_CLASS_DIR_NAMES) -> HashIndex:
+    """Hashes images of classes, paths are relative to the parent.
+
+    Classes default to those of the `manifest`, or to directories but
+    the `excluded_dir_names` of other outputs, e.g. shards.
+    """
+    if inventory is None:
+        inventory = Inventory(parent_dir_name)
+    if class_dir_names is None:
+        class_dir_names = inventory.dataset_class_names(manifest,
+                                                        excluded_dir_names)
+
+    paths = []
+    for class_dir_name in class_dir_names:
+        paths.extend(os.path.join(class_dir_name, file_name)
+                     for file_name in inventory.file_names(class_dir_name))
+
+    hashes, valid = compute_hashes(
+        [os.path.join(parent_dir_name, path) for path in paths],
+        method, workers)
+    if not valid.all():
+        logging.warning('Skipping {} images that could not be decoded'
+                        .format(np.count_nonzero(~valid)))
+
+    return HashIndex(hashes[valid],
+                     [path for path, ok in zip(paths, valid) if ok])
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', required=True,
+                        help="Path to the directory with downloaded classes")
+    parser.add_argument('--output_file_name', required=True,
+                        help="JSON file with groups of near-duplicates")
+    parser.add_argument('--index_file_name', default=None,
+                        help="Optional .npz file to store computed hashes")
+    parser.add_argument('--method', default='dhash',
+                        choices=sorted(__thumbnail_sizes))
+    parser.add_argument('--threshold', type=int, default=4,
+                        help="Max Hamming distance between near-duplicates")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of processes, defaults to CPU count")
+    parser.add_argument('--inventory_file_name', default='inventory.json',
+                        help="Cached listing of class directories")
+    parser.add_argument('--manifest_file_name', default=None,
+                        help="Download manifest, its images define "
+                             "the classes")
+    parser.add_argument('--exclude_dir_names', nargs='*',
+                        default=list(NON_CLASS_DIR_NAMES),
+                        help="Directories of other outputs, never taken "
+                             "for classes")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+
+    inventory = Inventory(args.output_dir,
+                          os.path.join(args.output_dir,
+                                       args.inventory_file_name))
+    if args.manifest_file_name:
+        with mf.Manifest(os.path.join(args.output_dir,
+                                      args.manifest_file_name),
+                         check_files=False) as manifest:
+            class_dir_names = inventory.dataset_class_names(
+                manifest, args.exclude_dir_names)
+    else:
+        class_dir_names = inventory.dataset_class_names(
+            excluded=args.exclude_dir_names)
+    index = build_index(args.output_dir, class_dir_names,
+                        args.method, args.workers, inventory)
+    inventory.save()
+    if args.index_file_name:
+        index.save(os.path.join(args.output_dir, args.index_file_name))
+
+    groups = index.find_path_groups(args.threshold)
+    logging.info('Found {} groups of near-duplicates'.format(len(groups)))
+
+    with open(os.path.join(args.output_dir, args.output_file_name), 'w') as f:
+        json.dump(groups, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
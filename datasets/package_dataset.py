@@ -0,0 +1,244 @@
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+from queue import Queue
+import tarfile
+import threading
+
+from inventory import Inventory
+
+package_member = namedtuple('package_member', 'path part offset size mtime')
+
+
+class Packager:
+    """Packs outputs into size-bounded tar parts on a pool of threads.
+
+    Every added directory, e.g. a class whose downloads are complete,
+    is archived right away by one of `workers` streams writing parts of
+    their own, so classes are packed in parallel and alongside other
+    stages. A part holds members of at most `max_part_size` bytes and
+    a member never spans parts. Images are compressed already and
+    stored as they are, gzip `compression` is applied to every part
+    in parallel. The location of every member is appended to a JSON
+    Lines index, offsets are those in the uncompressed tar. A packager
+    reopened on the same directory skips files in the index whose size
+    and mtime are unchanged, changed files, e.g. a new train test split,
+    are packed again and their last entry in the index wins.
+    """
+
+    def __init__(self, root_dir, package_dir_name='package', name='dataset',
+                 max_part_size=1 << 30, compression=None, workers=4,
+                 index_file_name='index.jsonl'):
+        if compression not in (None, 'gz'):
+            raise ValueError('Unknown compression {}'.format(compression))
+
+        self.__root = root_dir
+        self.__package_dir = os.path.join(root_dir, package_dir_name)
+        self.__name = name
+        self.__max_part_size = max_part_size
+        self.__compression = compression
+        self.__index_path = os.path.join(self.__package_dir, index_file_name)
+        self.__lock = threading.Lock()
+        self.__futures = []
+
+        if not os.path.exists(self.__package_dir):
+            os.makedirs(self.__package_dir)
+
+        # Sizes and mtimes of packed files by their paths
+        self.__packed = {}
+        if os.path.exists(self.__index_path):
+            with open(self.__index_path, 'r') as f:
+                for line in f:
+                    try:
+                        member = json.loads(line)
+                        self.__packed[member['path']] = \
+                            [member['size'], member.get('mtime')]
+                    except (ValueError, KeyError):
+                        # Last line may be truncated by a crash
+                        pass
+        self.__part_number = len([
+            file_name for file_name in os.listdir(self.__package_dir)
+            if file_name.startswith(self.__name + '-')])
+        self.__index_file = open(self.__index_path, 'a')
+
+        # A stream is the open part of one worker, taken for a whole task
+        self.__streams = Queue()
+        for _ in range(workers):
+            self.__streams.put({'tar': None, 'part': None})
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+
+    @property
+    def package_dir(self):
+        return self.__package_dir
+
+    @property
+    def index_path(self):
+        return self.__index_path
+
+    def __open_part(self, stream):
+        if stream['tar'] is not None:
+            stream['tar'].close()
+
+        with self.__lock:
+            part_number = self.__part_number
+            self.__part_number += 1
+        extension = '.tar.gz' if self.__compression else '.tar'
+        stream['part'] = '{}-{:06d}{}'.format(self.__name, part_number,
+                                              extension)
+        mode = 'w:' + self.__compression if self.__compression else 'w'
+        stream['tar'] = tarfile.open(
+            os.path.join(self.__package_dir, stream['part']), mode)
+
+    def __add_member(self, stream, member_name):
+        path = os.path.join(self.__root, member_name)
+        stat = os.stat(path)
+        size = stat.st_size
+        if stream['tar'] is None or \
+                stream['tar'].offset > 0 and \
+                stream['tar'].offset + size > self.__max_part_size:
+            self.__open_part(stream)
+
+        info = stream['tar'].gettarinfo(path, member_name)
+        with open(path, 'rb') as f:
+            stream['tar'].addfile(info, f)
+        padded_size = -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        member = package_member(path=member_name, part=stream['part'],
+                                offset=stream['tar'].offset - padded_size,
+                                size=size, mtime=stat.st_mtime_ns)
+        with self.__lock:
+            self.__index_file.write(json.dumps(member._asdict()) + '\n')
+            self.__index_file.flush()
+
+    def __pack(self, member_names):
+        stream = self.__streams.get()
+        try:
+            for member_name in member_names:
+                self.__add_member(stream, member_name)
+        finally:
+            self.__streams.put(stream)
+
+    def __submit(self, member_names):
+        stats = {}
+        for member_name in member_names:
+            stat = os.stat(os.path.join(self.__root, member_name))
+            stats[member_name] = [stat.st_size, stat.st_mtime_ns]
+        with self.__lock:
+            member_names = [member_name for member_name in member_names
+                            if self.__packed.get(member_name) !=
+                            stats[member_name]]
+            self.__packed.update((member_name, stats[member_name])
+                                 for member_name in member_names)
+        future = self.__executor.submit(self.__pack, member_names)
+        self.__futures.append(future)
+        return future
+
+    def add_directory(self, dir_name):
+        """Packs files of a directory relative to the root.
+
+        Hidden files are partial downloads and left out.
+        Returns the future of the task.
+        """
+        member_names = []
+        for parent, dir_names, file_names in \
+                os.walk(os.path.join(self.__root, dir_name)):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if not file_name.startswith('.'):
+                    member_names.append(os.path.relpath(
+                        os.path.join(parent, file_name), self.__root))
+        return self.__submit(member_names)
+
+    def add_files(self, file_names: list):
+        """Packs files relative to the root, e.g. train test splits."""
+        return self.__submit(list(file_names))
+
+    def close(self):
+        """Waits for all tasks and closes the parts.
+
+        The first error of a task is raised once all of them finished.
+        """
+        self.__executor.shutdown(wait=True)
+        while not self.__streams.empty():
+            stream = self.__streams.get()
+            if stream['tar'] is not None:
+                stream['tar'].close()
+        self.__index_file.close()
+
+        for future in self.__futures:
+            future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def package_dataset(output_dir, dir_names: list, file_names: list,
+                    package_dir_name='package', max_part_size=1 << 30,
+                    compression=None, workers=4) -> str:
+    """Packs directories and files of the output directory.
+
+    Returns the path to the member index.
+    """
+    with Packager(output_dir, package_dir_name,
+                  max_part_size=max_part_size, compression=compression,
+                  workers=workers) as packager:
+        for dir_name in dir_names:
+            packager.add_directory(dir_name)
+        packager.add_files(file_names)
+
+    return packager.index_path
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', required=True,
+                        help="Path to the directory with results")
+    parser.add_argument('--package_dir_name', default='package',
+                        help="Directory of the parts and their index")
+    parser.add_argument('--dir_names', nargs='*', default=None,
+                        help="Directories to pack, defaults to all "
+                             "directories but the package")
+    parser.add_argument('--file_names', nargs='*', default=[],
+                        help="Files to pack, e.g. train test splits")
+    parser.add_argument('--max_part_size', type=int, default=1 << 30,
+                        help="Size of members of a part in bytes")
+    parser.add_argument('--compression', default='none',
+                        choices=['none', 'gz'],
+                        help="Images are compressed already, gzip only "
+                             "pays off for other members")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="Number of parts written at once")
+    parser.add_argument('--inventory_file_name', default='inventory.json',
+                        help="Cached listing of class directories")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+
+    dir_names = args.dir_names
+    if dir_names is None:
+        inventory = Inventory(args.output_dir,
+                              os.path.join(args.output_dir,
+                                           args.inventory_file_name))
+        dir_names = [dir_name for dir_name in inventory.class_names()
+                     if dir_name != args.package_dir_name]
+
+    index_path = package_dataset(
+        args.output_dir, dir_names, args.file_names, args.package_dir_name,
+        args.max_part_size,
+        None if args.compression == 'none' else args.compression,
+        args.workers)
+    logging.info('Packed {} directories, member index in {}'
+                 .format(len(dir_names), index_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import base64
+import logging
+import zlib
+
+import numpy as np
+
+URL_TEMPLATE = 'https://farm{}.staticflickr.com/{}/{}_{}_m.jpg'
+
+
+class PhotoColumns:
+    """Photos found by a search, stored as columns of packed fields.
+
+    Farm, server, photo id and secret are kept in numpy arrays and urls
+    are built only when read, so a million photos take tens of
+    megabytes instead of hundreds. Owners are stored once and referred
+    to by index. Photos behave as a read-only sequence of their urls,
+    photos with invalid search results have no secret and None as url.
+    """
+
+    def __init__(self, farms, servers, ids, secrets, owners: list,
+                 owner_ids):
+        self.farms = farms
+        self.servers = servers
+        self.ids = ids
+        self.secrets = secrets
+        self.owners = owners
+        self.owner_ids = owner_ids
+
+    @staticmethod
+    def __pack(array) -> str:
+        return base64.b64encode(zlib.compress(array.tobytes())) \
+            .decode('ascii')
+
+    @staticmethod
+    def __unpack(data, dtype):
+        return np.frombuffer(zlib.decompress(base64.b64decode(data)),
+                             dtype=dtype)
+
+    @classmethod
+    def from_photos(cls, photo_infos: list):
+        """Packs the `photo` list of a Flickr search response."""
+        rows = []
+        owners = {}
+        for photo_info in photo_infos:
+            try:
+                row = (int(photo_info['farm']), int(photo_info['server']),
+                       int(photo_info['id']),
+                       photo_info['secret'].encode('ascii'))
+            except (KeyError, TypeError, ValueError,
+                    AttributeError, UnicodeEncodeError) as err:
+                logging.error('Invalid photo info: {}'.format(err))
+                row = (0, 0, 0, b'')
+            owner = photo_info.get('owner', '') \
+                if isinstance(photo_info, dict) else ''
+            rows.append(row + (owners.setdefault(owner, len(owners)),))
+
+        farms, servers, ids, secrets, owner_ids = \
+            zip(*rows) if rows else ((), (), (), (), ())
+        return cls(np.array(farms, dtype=np.uint16),
+                   np.array(servers, dtype=np.uint32),
+                   np.array(ids, dtype=np.uint64),
+                   np.array(secrets, dtype=bytes),
+                   list(owners), np.array(owner_ids, dtype=np.uint32))
+
+    @classmethod
+    def from_record(cls, record: dict):
+        secret_width = record['secret_width']
+        return cls(cls.__unpack(record['farm'], np.uint16),
+                   cls.__unpack(record['server'], np.uint32),
+                   cls.__unpack(record['id'], np.uint64),
+                   cls.__unpack(record['secret'], 'S{}'.format(secret_width))
+                   if secret_width else np.zeros(0, dtype='S1'),
+                   list(record['owners']),
+                   cls.__unpack(record['owner'], np.uint32))
+
+    @classmethod
+    def concatenate(cls, columns: list):
+        owners = {}
+        owner_ids = []
+        for photos in columns:
+            lookup = np.array([owners.setdefault(owner, len(owners))
+                               for owner in photos.owners], dtype=np.uint32)
+            owner_ids.append(lookup[photos.owner_ids])
+
+        def joined(name, dtype):
+            arrays = [getattr(photos, name) for photos in columns]
+            return np.concatenate(arrays) if arrays \
+                else np.zeros(0, dtype=dtype)
+
+        return cls(joined('farms', np.uint16), joined('servers', np.uint32),
+                   joined('ids', np.uint64), joined('secrets', 'S1'),
+                   list(owners),
+                   np.concatenate(owner_ids) if owner_ids
+                   else np.zeros(0, dtype=np.uint32))
+
+    def to_record(self) -> dict:
+        """Returns the columns packed for a JSON file."""
+        return {'farm': self.__pack(self.farms),
+                'server': self.__pack(self.servers),
+                'id': self.__pack(self.ids),
+                'secret': self.__pack(self.secrets),
+                'secret_width': self.secrets.dtype.itemsize
+                if len(self.secrets) else 0,
+                'owners': self.owners,
+                'owner': self.__pack(self.owner_ids)}
+
+    def take(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        return PhotoColumns(self.farms[positions], self.servers[positions],
+                            self.ids[positions], self.secrets[positions],
+                            self.owners, self.owner_ids[positions])
+
+    def url(self, position):
+        if not self.secrets[position]:
+            return None
+        return URL_TEMPLATE.format(self.farms[position],
+                                   self.servers[position],
+                                   self.ids[position],
+                                   self.secrets[position].decode('ascii'))
+
+    def owner(self, position):
+        return self.owners[self.owner_ids[position]] or None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return PhotoColumns(self.farms[key], self.servers[key],
+                                self.ids[key], self.secrets[key],
+                                self.owners, self.owner_ids[key])
+        return self.url(key)
+
+    def __iter__(self):
+        return (self.url(position) for position in range(len(self)))
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and \
+                all(url == other_url for url, other_url in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({} photos)'.format(type(self).__name__, len(self))
+
+
+def concatenate_urls(pages_urls: list):
+    """Joins urls of pages, keeping photos packed when all of them are."""
+    packed = [urls for urls in pages_urls if isinstance(urls, PhotoColumns)]
+    if packed and all(isinstance(urls, PhotoColumns) or not urls
+                      for urls in pages_urls):
+        return PhotoColumns.concatenate(packed)
+
+    urls = []
+    for page_urls in pages_urls:
+        urls.extend(page_urls)
+    return urls
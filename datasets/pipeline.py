@@ -0,0 +1,367 @@
+import argparse
+from collections import namedtuple
+import json
+import logging
+import os
+from queue import Queue
+import threading
+import time
+
+import flickrapi
+import yaml
+
+from dedup import DedupIndex
+from download_dataset import download_records
+from extract_subset import extract
+from fetch_urls import Fetcher, page_to_record, write_pages
+from http_pool import ConnectionPool
+from inventory import Inventory
+import manifest as mf
+from metrics import Metrics, close_metrics, count_images, open_metrics, \
+    stage_timer
+from package_dataset import Packager
+from rate_limit import Retrier
+from search_cache import SearchCache
+from split_dataset import Splitter
+
+
+class StageStats:
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.count = 0
+        self.__started = None
+        self.__finished = None
+        self.__lock = threading.Lock()
+
+    def start(self):
+        self.__started = time.time()
+
+    def finish(self):
+        self.__finished = time.time()
+
+    def add(self, count=1):
+        with self.__lock:
+            self.count += count
+
+    @property
+    def elapsed(self):
+        if self.__started is None:
+            return 0.
+        return (self.__finished or time.time()) - self.__started
+
+    def report(self):
+        rate = self.count / self.elapsed if self.elapsed else 0.
+        return '{}: {} {} in {:.1f}s ({:.1f} {}/s)'.format(
+            self.name, self.count, self.unit, self.elapsed, rate, self.unit)
+
+
+class Pipeline:
+    """Builds the dataset with all stages running at once.
+
+    Fetched pages of urls are downloaded as they come. Every class is
+    split as soon as its downloads finish, and its subset is extracted
+    right after. Stages are connected with bounded queues, so a slow
+    stage holds back the ones before it instead of buffering
+    all the urls in memory. Durations and images of the stages are
+    counted in `metrics`, next to those of the fetcher and downloads.
+    With a `packager`, every split class is packed right away.
+    Classes are split like `split_dataset.py` does: images stored by
+    the downloader are listed by the `inventory`, so partial downloads
+    are left out, and near-duplicate `groups` are kept on one side.
+    """
+
+    __end_of_stage = object()
+
+    def __init__(self, fetcher: Fetcher, splitter: Splitter, output_dir,
+                 subset_percentage, subset_seed, workers=16,
+                 queue_size=100, pool: ConnectionPool = None,
+                 manifest: mf.Manifest = None, retrier: Retrier = None,
+                 dedup: DedupIndex = None, metrics: Metrics = None,
+                 packager: Packager = None, inventory: Inventory = None,
+                 groups: list = None):
+        self.__fetcher = fetcher
+        self.__splitter = splitter
+        self.__output_dir = output_dir
+        self.__subset_percentage = subset_percentage
+        self.__subset_seed = subset_seed
+        self.__workers = workers
+        self.__queue_size = queue_size
+        self.__pool = pool
+        self.__manifest = manifest
+        self.__retrier = retrier
+        self.__dedup = dedup
+        self.__metrics = metrics
+        self.__packager = packager
+        self.__inventory = inventory or Inventory(output_dir)
+        self.__groups = groups
+
+    @classmethod
+    def __queue_items(cls, queue: Queue):
+        while True:
+            item = queue.get()
+            if item is cls.__end_of_stage:
+                return
+            yield item
+
+    def __run_stage(self, stats: StageStats, target, input_queue,
+                    output_queue, errors):
+        stats.start()
+        try:
+            with stage_timer(self.__metrics, stats.name):
+                target()
+        except BaseException as err:
+            logging.error('{} stage failed: {}'.format(stats.name, err))
+            errors.append(err)
+            # Keep the previous stage from blocking on a full queue
+            if input_queue is not None:
+                for _ in self.__queue_items(input_queue):
+                    pass
+        finally:
+            stats.finish()
+            if output_queue is not None:
+                output_queue.put(self.__end_of_stage)
+
+    def run(self, classes: list, urls_file=None):
+        """Runs all stages and returns a `pipeline_result`.
+
+        Fetched pages are also written to `urls_file` as JSON Lines.
+        """
+        pipeline_result = namedtuple(
+            'pipeline_result', 'summary train_test_split subset stages')
+
+        urls_queue = Queue(self.__queue_size)
+        classes_queue = Queue()
+        splits_queue = Queue()
+        stages = [StageStats('fetch', 'urls'),
+                  StageStats('download', 'images'),
+                  StageStats('split', 'images'),
+                  StageStats('extract', 'images')]
+        fetch_stats, download_stats, split_stats, extract_stats = stages
+        summary = []
+        subsets = {}
+        errors = []
+
+        def fetched_pages():
+            for page in self.__fetcher.iter_fetch(classes):
+                fetch_stats.add(len(page.urls or []))
+                urls_queue.put(page_to_record(page))
+                yield page
+
+        def fetch():
+            if urls_file is None:
+                for _ in fetched_pages():
+                    pass
+            else:
+                write_pages(fetched_pages(), urls_file)
+
+        def queued_records():
+            for record in self.__queue_items(urls_queue):
+                download_stats.add(len(record['urls'] or []))
+                yield record
+
+        def download():
+            summary.extend(download_records(
+                queued_records(), self.__output_dir, self.__workers,
+                self.__pool, self.__manifest, self.__retrier,
+                on_class_done=classes_queue.put, dedup=self.__dedup,
+                inventory=self.__inventory, metrics=self.__metrics))
+
+        def split():
+            # Shared, so groups spanning classes stay on one side
+            group_sides = {}
+            for class_name in self.__queue_items(classes_queue):
+                class_split = self.__splitter.split_dataset(
+                    self.__output_dir, [class_name], self.__groups,
+                    {class_name: self.__inventory.file_names(class_name)},
+                    group_sides)
+                split_stats.add(sum(map(len, class_split.values())))
+                count_images(self.__metrics, 'split', class_split)
+                if self.__packager is not None:
+                    self.__packager.add_directory(class_name)
+                splits_queue.put((class_name, class_split))
+
+        def extract_subsets():
+            for class_name, class_split in self.__queue_items(splits_queue):
+                subset = extract(class_split, self.__subset_percentage,
+                                 self.__subset_seed)
+                extract_stats.add(sum(map(len, class_split.values())))
+                count_images(self.__metrics, 'extract', subset)
+                subsets[class_name] = (class_split, subset)
+
+        threads = [
+            threading.Thread(target=self.__run_stage, args=args)
+            for args in [(fetch_stats, fetch, None, urls_queue, errors),
+                         (download_stats, download, urls_queue,
+                          classes_queue, errors),
+                         (split_stats, split, classes_queue,
+                          splits_queue, errors),
+                         (extract_stats, extract_subsets, splits_queue,
+                          None, errors)]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        for stats in stages:
+            logging.info(stats.report())
+
+        # Outputs follow the order of classes in the config
+        keys = ['train', 'test']
+        if any('val' in class_split for class_split, _ in subsets.values()):
+            keys.insert(1, 'val')
+        train_test_split = {key: [] for key in keys}
+        subset = {key: [] for key in keys}
+        for class_info in classes:
+            if class_info['name'] not in subsets:
+                continue
+            class_split, class_subset = subsets[class_info['name']]
+            for key in keys:
+                train_test_split[key].extend(class_split.get(key, []))
+                subset[key].extend(class_subset.get(key, []))
+
+        return pipeline_result(summary=summary,
+                               train_test_split=train_test_split,
+                               subset=subset,
+                               stages=stages)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True,
+                        help="Path to the configuration file.")
+    parser.add_argument('--output_dir', required=True,
+                        help="Path to the directory for storing results")
+    parser.add_argument('--urls_file_name', required=True)
+    parser.add_argument('--summary_file_name', required=True)
+    parser.add_argument('--split_file_name', required=True)
+    parser.add_argument('--subset_file_name', required=True)
+    parser.add_argument('--manifest_file_name',
+                        default='download_manifest.jsonl')
+    parser.add_argument('--dedup_index_file_name',
+                        default='dedup_index.jsonl')
+    parser.add_argument('--inventory_file_name', default='inventory.json',
+                        help="Cached listing of class directories")
+    parser.add_argument('--near_duplicates_file_name', default=None,
+                        help="Groups of near-duplicates to keep "
+                             "on one side of the split")
+    parser.add_argument('--prefetch', type=int, default=None,
+                        help="Pages of a class searched at once, "
+                             "defaults to the number of search workers")
+    parser.add_argument('--cache_file_name', default=None,
+                        help="SQLite cache of search responses")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Search again and replace cached responses")
+    parser.add_argument('--search_workers', type=int, default=4,
+                        help="Number of concurrent search requests")
+    parser.add_argument('--requests_per_second', type=float, default=0.5,
+                        help="Search requests rate shared by all workers")
+    parser.add_argument('--workers', type=int, default=16,
+                        help="Number of concurrent downloads")
+    parser.add_argument('--retries', type=int, default=3,
+                        help="Attempts per image on transient errors")
+    parser.add_argument('--queue_size', type=int, default=100,
+                        help="Pages of urls buffered between "
+                             "fetching and downloading")
+    parser.add_argument('--package_dir_name', default=None,
+                        help="Pack classes into tar parts in this "
+                             "directory as soon as they are split")
+    parser.add_argument('--max_part_size', type=int, default=1 << 30,
+                        help="Size of members of a part in bytes")
+    parser.add_argument('--metrics_file_name', default=None,
+                        help="JSON report of metrics shared by all scripts")
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help="Port serving metrics in Prometheus text "
+                             "format while running")
+
+    return parser.parse_args()
+
+
+def load_config(path):
+    with open(path, 'r') as stream:
+        try:
+            return yaml.load(stream)
+        except yaml.YAMLError as exc:
+            logging.error(exc)
+
+        return None
+
+
+def main():
+    args = parse_arguments()
+    config = load_config(args.config)
+    logging.basicConfig(level=logging.INFO)
+
+    flickr = flickrapi.FlickrAPI(os.environ.get('API_KEY'),
+                                 os.environ.get('API_SECRET'),
+                                 format='parsed-json')
+    cache = SearchCache(os.path.join(args.output_dir, args.cache_file_name),
+                        refresh=args.refresh) \
+        if args.cache_file_name else None
+    metrics = open_metrics('pipeline', args.metrics_file_name,
+                           args.metrics_port)
+    fetcher = Fetcher(flickr, args.search_workers, args.requests_per_second,
+                      cache=cache, metrics=metrics, prefetch=args.prefetch)
+    split_config = config['train_test_split']
+    splitter = Splitter(split_config['test_size'], split_config['type'],
+                        split_config['seed'], split_config.get('val_size', 0))
+    inventory = Inventory(args.output_dir,
+                          os.path.join(args.output_dir,
+                                       args.inventory_file_name))
+    groups = None
+    if args.near_duplicates_file_name:
+        with open(os.path.join(args.output_dir,
+                               args.near_duplicates_file_name), 'r') as f:
+            groups = json.load(f)
+    packager = Packager(args.output_dir, args.package_dir_name,
+                        max_part_size=args.max_part_size) \
+        if args.package_dir_name else None
+
+    manifest_path = os.path.join(args.output_dir, args.manifest_file_name)
+    dedup_path = os.path.join(args.output_dir, args.dedup_index_file_name)
+    urls_path = os.path.join(args.output_dir, args.urls_file_name)
+    with mf.Manifest(manifest_path) as manifest, \
+            DedupIndex(dedup_path) as dedup, \
+            open(urls_path, 'w') as urls_file:
+        pipeline = Pipeline(fetcher, splitter, args.output_dir,
+                            config['subset']['percentage'],
+                            config['subset']['seed'],
+                            workers=args.workers,
+                            queue_size=args.queue_size,
+                            pool=ConnectionPool(args.workers),
+                            manifest=manifest,
+                            retrier=Retrier(args.retries, metrics=metrics,
+                                            stage='download'),
+                            dedup=dedup,
+                            metrics=metrics,
+                            packager=packager,
+                            inventory=inventory,
+                            groups=groups)
+        try:
+            result = pipeline.run(config['classes'], urls_file)
+        finally:
+            inventory.save()
+            if cache is not None:
+                cache.close()
+            close_metrics(metrics, args.output_dir, args.metrics_file_name)
+
+    with open(os.path.join(args.output_dir, args.summary_file_name), 'w') as f:
+        f.writelines(result.summary)
+
+    with open(os.path.join(args.output_dir, args.split_file_name), 'w') as f:
+        json.dump(result.train_test_split, f, indent=4)
+
+    with open(os.path.join(args.output_dir, args.subset_file_name), 'w') as f:
+        json.dump(result.subset, f, indent=4)
+
+    if packager is not None:
+        packager.add_files([args.split_file_name, args.subset_file_name])
+        packager.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+from email.utils import parsedate_to_datetime
+import logging
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket shared by all workers.
+
+    Tokens are refilled at `rate` per second up to `capacity`.
+    A caller that finds the bucket empty reserves the next token
+    and sleeps until it becomes available, so waiting callers
+    are served in order and the long-term rate never exceeds `rate`.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.,
+                 clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError('Rate must be positive')
+
+        self.__rate = float(rate)
+        self.__capacity = float(capacity)
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__tokens = self.__capacity
+        self.__updated = clock()
+        self.__lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    def __refill(self):
+        now = self.__clock()
+        self.__tokens = min(self.__capacity,
+                            self.__tokens +
+                            (now - self.__updated) * self.__rate)
+        self.__updated = now
+
+    def reserve(self, tokens: float = 1.) -> float:
+        """Takes tokens and returns the time to wait before using them."""
+        with self.__lock:
+            self.__refill()
+            self.__tokens -= tokens
+            if self.__tokens >= 0:
+                return 0.
+            return -self.__tokens / self.__rate
+
+    def acquire(self, tokens: float = 1.):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            self.__sleep(delay)
+
+    def pause(self, seconds: float):
+        """Holds back all callers for the given time, e.g. after HTTP 429."""
+        with self.__lock:
+            self.__refill()
+            self.__tokens = min(self.__tokens, -seconds * self.__rate)
+
+
+class RetryableError(Exception):
+    """Raised by a retried call when the failure is transient.
+
+    `retry_after` is the delay in seconds requested by the server.
+    """
+
+    def __init__(self, message, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_retryable_status(status: int) -> bool:
+    return status == 429 or 500 <= status < 600
+
+
+def parse_retry_after(value, now=time.time):
+    """Converts a Retry-After header (seconds or HTTP date) to seconds."""
+    if value is None:
+        return None
+
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - now())
+    except (TypeError, ValueError):
+        logging.warning('Invalid Retry-After header: {}'.format(value))
+
+    return None
+
+
+class Backoff:
+    """Exponential backoff with full jitter."""
+
+    def __init__(self, base_delay: float = 1., factor: float = 2.,
+                 max_delay: float = 60., jitter=random.random):
+        self.__base_delay = base_delay
+        self.__factor = factor
+        self.__max_delay = max_delay
+        self.__jitter = jitter
+
+    def delay(self, attempt: int) -> float:
+        ceiling = min(self.__max_delay,
+                      self.__base_delay * self.__factor ** attempt)
+        return ceiling * self.__jitter()
+
+
+class Retrier:
+    """Calls a function under a rate limit and retries transient errors.
+
+    Every attempt takes a token from `rate_limiter`. A `RetryableError`
+    is retried after the backoff delay and the server's Retry-After.
+    A Retry-After pauses the whole rate limiter, so all workers
+    sharing it back off together.
+    The last error is re-raised once all attempts are used.
+    Retries and time spent waiting for tokens are counted in `metrics`
+    under the `stage` label.
+    """
+
+    def __init__(self, attempts: int = 5, backoff: Backoff = None,
+                 rate_limiter: TokenBucket = None, sleep=time.sleep,
+                 metrics=None, stage='call'):
+        self.__attempts = attempts
+        self.__backoff = backoff or Backoff()
+        self.__rate_limiter = rate_limiter
+        self.__sleep = sleep
+        self.__metrics = metrics
+        self.__stage = stage
+
+    def call(self, func, *args, **kwargs):
+        for attempt in range(self.__attempts):
+            if self.__rate_limiter:
+                started = time.monotonic()
+                self.__rate_limiter.acquire()
+                if self.__metrics is not None:
+                    self.__metrics.observe('rate_limit_wait_seconds',
+                                           time.monotonic() - started,
+                                           stage=self.__stage)
+
+            try:
+                return func(*args, **kwargs)
+            except RetryableError as err:
+                if attempt == self.__attempts - 1:
+                    raise
+
+                delay = self.__backoff.delay(attempt)
+                if err.retry_after is not None:
+                    if self.__rate_limiter:
+                        # Next acquire waits out the rest of Retry-After
+                        self.__rate_limiter.pause(err.retry_after)
+                    else:
+                        delay = max(delay, err.retry_after)
+
+                logging.warning('{}, retrying in {:.1f}s'.format(err, delay))
+                if self.__metrics is not None:
+                    self.__metrics.inc('retries', stage=self.__stage)
+                self.__sleep(delay)
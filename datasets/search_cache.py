@@ -0,0 +1,106 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class SearchCache:
+    """On-disk cache of Flickr search responses in a SQLite database.
+
+    Responses are keyed by tags, page size and page number. Entries
+    older than `ttl` seconds are treated as missing, and the least
+    recently used ones are evicted once all responses take more than
+    `max_size` bytes. With `refresh`, cached responses are ignored
+    and replaced by new ones.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600., max_size=256 << 20,
+                 refresh=False, clock=time.time):
+        self.__ttl = ttl
+        self.__max_size = max_size
+        self.__refresh = refresh
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        # Shared by search workers, access is serialized by the lock
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        with self.__connection:
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS pages ('
+                'key TEXT PRIMARY KEY, response TEXT NOT NULL, '
+                'size INTEGER NOT NULL, created REAL NOT NULL, '
+                'accessed REAL NOT NULL)')
+            self.__connection.execute(
+                'CREATE INDEX IF NOT EXISTS pages_accessed '
+                'ON pages (accessed)')
+
+    @staticmethod
+    def key(tags, per_page, page):
+        if isinstance(tags, str):
+            tags = [tags]
+        return json.dumps([sorted(tags), int(per_page), int(page)])
+
+    def get(self, tags, per_page, page):
+        """Returns a cached response or None when missing or expired."""
+        if self.__refresh:
+            return None
+
+        key = self.key(tags, per_page, page)
+        now = self.__clock()
+        with self.__lock, self.__connection:
+            row = self.__connection.execute(
+                'SELECT response, created FROM pages WHERE key = ?',
+                (key,)).fetchone()
+            if row is None or now - row[1] > self.__ttl:
+                return None
+            self.__connection.execute(
+                'UPDATE pages SET accessed = ? WHERE key = ?', (now, key))
+
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            logging.warning('Ignoring invalid cached response of {}'
+                            .format(key))
+            return None
+
+    def put(self, tags, per_page, page, response):
+        key = self.key(tags, per_page, page)
+        data = json.dumps(response)
+        now = self.__clock()
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO pages '
+                '(key, response, size, created, accessed) '
+                'VALUES (?, ?, ?, ?, ?)', (key, data, len(data), now, now))
+            self.__evict()
+
+    def __evict(self):
+        total_size = self.__connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+        if total_size <= self.__max_size:
+            return
+
+        evicted = []
+        for key, size in self.__connection.execute(
+                'SELECT key, size FROM pages ORDER BY accessed'):
+            if total_size <= self.__max_size:
+                break
+            evicted.append((key,))
+            total_size -= size
+        self.__connection.executemany('DELETE FROM pages WHERE key = ?',
+                                      evicted)
+
+    def __len__(self):
+        with self.__lock:
+            return self.__connection.execute(
+                'SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,277 @@
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import logging
+import mmap
+import os
+import random
+import tarfile
+import threading
+import time
+
+from split_index import SplitIndex, is_split_index
+
+shard_entry = namedtuple('shard_entry', 'path shard offset size')
+batch = namedtuple('batch', 'indices items class_names')
+
+
+class ShardIndex:
+    """Locations of images packed into shards, keyed by relative path."""
+
+    def __init__(self, entries):
+        self.__entries = OrderedDict((entry.path, entry) for entry in entries)
+
+    @classmethod
+    def load(cls, path):
+        entries = []
+        with open(path, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    entries.append(shard_entry(**json.loads(line)))
+                except (ValueError, TypeError):
+                    # Last line may be truncated by a crash
+                    logging.warning('Skipping invalid shard index line {}'
+                                    .format(line_number))
+        return cls(entries)
+
+    def __getitem__(self, path) -> shard_entry:
+        return self.__entries[path]
+
+    def __contains__(self, path):
+        return path in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __iter__(self):
+        return iter(self.__entries.values())
+
+    def class_file_names(self) -> dict:
+        """Returns sorted file names of every class directory."""
+        classes = defaultdict(list)
+        for path in self.__entries.keys():
+            classes[os.path.dirname(path)].append(os.path.basename(path))
+        return {class_: sorted(file_names)
+                for class_, file_names in classes.items()}
+
+    def locate(self, paths: list) -> list:
+        """Replaces relative paths with their shard locations."""
+        return [dict(self.__entries[path]._asdict()) for path in paths]
+
+
+class ShardWriter:
+    """Packs images into uncompressed, size-bounded tar shards.
+
+    Shards follow the WebDataset layout, any tar reader can unpack them.
+    The location of every image is appended to a JSON Lines index,
+    so images can be read from a shard at a known offset without
+    scanning it. A writer reopened on the same directory starts a new
+    shard and keeps the existing index.
+    """
+
+    def __init__(self, root_dir, shards_dir_name='shards',
+                 max_shard_size=1 << 30, index_file_name='index.jsonl'):
+        self.__root = root_dir
+        self.__shards_dir = os.path.join(root_dir, shards_dir_name)
+        self.__max_shard_size = max_shard_size
+        self.__index_path = os.path.join(self.__shards_dir, index_file_name)
+        self.__lock = threading.Lock()
+        self.__tar = None
+        self.__shard_name = None
+
+        if not os.path.exists(self.__shards_dir):
+            os.makedirs(self.__shards_dir)
+
+        index = ShardIndex.load(self.__index_path) \
+            if os.path.exists(self.__index_path) else ShardIndex([])
+        self.__class_counts = Counter(os.path.dirname(entry.path)
+                                      for entry in index)
+        self.__shard_number = len([name for name in
+                                   os.listdir(self.__shards_dir)
+                                   if name.endswith('.tar')])
+        self.__index_file = open(self.__index_path, 'a')
+
+    @property
+    def shards_dir(self):
+        return self.__shards_dir
+
+    @property
+    def index_path(self):
+        return self.__index_path
+
+    def __open_next_shard(self):
+        if self.__tar is not None:
+            self.__tar.close()
+
+        self.__shard_name = 'shard-{:06d}.tar'.format(self.__shard_number)
+        self.__shard_number += 1
+        self.__tar = tarfile.open(
+            os.path.join(self.__shards_dir, self.__shard_name), 'w')
+
+    def write(self, path, data: bytes) -> shard_entry:
+        member_name = os.path.relpath(path, self.__root)
+        info = tarfile.TarInfo(member_name)
+        info.size = len(data)
+        info.mtime = time.time()
+        padded_size = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+        with self.__lock:
+            if self.__tar is None or \
+                    self.__tar.offset >= self.__max_shard_size:
+                self.__open_next_shard()
+
+            self.__tar.addfile(info, io.BytesIO(data))
+            # Indexed images must be on disk even if the run crashes
+            self.__tar.fileobj.flush()
+            entry = shard_entry(path=member_name, shard=self.__shard_name,
+                                offset=self.__tar.offset - padded_size,
+                                size=len(data))
+            self.__index_file.write(json.dumps(entry._asdict()) + '\n')
+            self.__index_file.flush()
+            self.__class_counts[os.path.dirname(member_name)] += 1
+
+        return entry
+
+    def class_count(self, class_name) -> int:
+        return self.__class_counts[class_name]
+
+    def close(self):
+        with self.__lock:
+            if self.__tar is not None:
+                self.__tar.close()
+                self.__tar = None
+            self.__index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ShardDataset:
+    """Random access to images listed in a train test split.
+
+    Entries are shard locations written by `split_dataset.py` or plain
+    relative paths of image files. Shards are memory-mapped once and
+    shared by all slices of the dataset, their items are `memoryview`s
+    of the encoded images without copying them. Views have to be
+    released before the dataset is closed. Image files are small and
+    many, each of them is read when its item is accessed, so open files
+    stay bounded by the number of shards.
+    """
+
+    def __init__(self, root_dir, entries: list, shards_dir_name='shards'):
+        self.__root = root_dir
+        self.__entries = list(entries)
+        self.__shards_dir_name = shards_dir_name
+        self.__maps = {}
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def from_split(cls, split_path, key='train', root_dir=None,
+                   shards_dir_name='shards'):
+        """Loads the `key` set of a split JSON file or split index.
+
+        Paths are relative to `root_dir`, by default the split's directory.
+        """
+        if is_split_index(split_path):
+            entries = SplitIndex.load(split_path).entries(key)
+        else:
+            with open(split_path, 'r') as f:
+                entries = json.load(f)[key]
+        if root_dir is None:
+            root_dir = os.path.dirname(os.path.abspath(split_path))
+        return cls(root_dir, entries, shards_dir_name)
+
+    def __map(self, file_name):
+        with self.__lock:
+            if file_name not in self.__maps:
+                with open(os.path.join(self.__root, file_name), 'rb') as f:
+                    self.__maps[file_name] = \
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.__maps[file_name]
+
+    def __view(self, entry) -> memoryview:
+        if isinstance(entry, dict):
+            data = self.__map(os.path.join(self.__shards_dir_name,
+                                           entry['shard']))
+            return memoryview(data)[entry['offset']:
+                                    entry['offset'] + entry['size']]
+        with open(os.path.join(self.__root, entry), 'rb') as f:
+            return memoryview(f.read())
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            sliced = ShardDataset(self.__root, self.__entries[index],
+                                  self.__shards_dir_name)
+            sliced.__maps = self.__maps
+            sliced.__lock = self.__lock
+            return sliced
+        return self.__view(self.__entries[index])
+
+    def path(self, index):
+        entry = self.__entries[index]
+        return entry['path'] if isinstance(entry, dict) else entry
+
+    def class_name(self, index):
+        return os.path.dirname(self.path(index))
+
+    def __load_batch(self, indices, transform):
+        items = []
+        for i in indices:
+            view = self[i]
+            if transform is not None:
+                items.append(transform(view))
+            else:
+                # Touch every page, so it's read from disk in advance
+                view[::mmap.PAGESIZE].tobytes()
+                items.append(view)
+        return batch(indices=indices, items=items,
+                     class_names=[self.class_name(i) for i in indices])
+
+    def iter_batches(self, batch_size, shuffle=False, seed=None,
+                     drop_last=False, transform=None, prefetch=2,
+                     workers=2):
+        """Yields `batch`es of items loaded ahead on `workers` threads.
+
+        Up to `prefetch` batches are loaded in the background while
+        the current one is consumed. `transform`, e.g. decoding,
+        is applied to the view of every item on the worker threads.
+        """
+        indices = list(range(len(self)))
+        if shuffle:
+            random.Random(seed).shuffle(indices)
+        stop = len(indices) - len(indices) % batch_size \
+            if drop_last else len(indices)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            try:
+                for start in range(0, stop, batch_size):
+                    pending.append(executor.submit(
+                        self.__load_batch, indices[start:start + batch_size],
+                        transform))
+                    if len(pending) > prefetch:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def close(self):
+        with self.__lock:
+            for data in self.__maps.values():
+                data.close()
+            self.__maps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
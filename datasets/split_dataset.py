@@ -1,5 +1,6 @@
 import argparse
-from collections import namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 import os
@@ -7,13 +8,28 @@ import random
 
 import yaml
 
+from inventory import Inventory
+import manifest as mf
+from metrics import close_metrics, count_images, open_metrics, stage_timer
+from shards import ShardIndex
+from split_index import SplitIndex, is_split_index
+
 
 class Splitter:
+    """Splits images of every class into train, val and test sets.
+
+    Classes are split independently, each with its own random generator
+    seeded with `seed`, so they are processed on `workers` threads.
+    File names are taken from a given inventory, e.g. the download
+    manifest, or by listing class directories.
+    """
 
-    def __init__(self, test_size, split_type, seed):
+    def __init__(self, test_size, split_type, seed, val_size=0, workers=1):
         self.__split_type = split_type.lower()
         self.__test_size = self.__set_test_size(test_size)
+        self.__val_size = self.__set_test_size(val_size)
         self.__seed = seed
+        self.__workers = workers
 
     def __set_test_size(self, test_size):
         if self.__split_type == 'absolute':
@@ -26,18 +42,79 @@ class Splitter:
 
             return test_size
 
-    def __split_single_class(self, parent_dir_name: str, class_dir_name: str):
-        file_names = os.listdir(os.path.join(parent_dir_name, class_dir_name))
-        random.seed(self.__seed)
-        random.shuffle(file_names)
-        data_split = namedtuple('data_split', 'train test')
+    def __shuffled_file_names(self, parent_dir_name, class_dir_name,
+                              file_names=None):
+        if file_names is None:
+            file_names = os.listdir(
+                os.path.join(parent_dir_name, class_dir_name))
+        # Sorted first, so the split doesn't depend on the inventory order
+        file_names = sorted(file_names)
+        random.Random(self.__seed).shuffle(file_names)
+        return file_names
 
-        test_size = self.__test_size
+    def __sizes(self, count):
         if self.__split_type == 'proportional':
-            test_size = int(len(file_names) * test_size)
+            return int(count * self.__test_size), int(count * self.__val_size)
+        return self.__test_size, self.__val_size
+
+    def __split_single_class(self, parent_dir_name: str, class_dir_name: str,
+                             group_ids=None, group_sides=None,
+                             file_names=None):
+        file_names = self.__shuffled_file_names(parent_dir_name,
+                                                class_dir_name, file_names)
+        data_split = namedtuple('data_split', 'train val test')
+        test_size, val_size = self.__sizes(len(file_names))
+
+        if not group_ids:
+            return data_split(train=file_names[test_size + val_size:],
+                              val=file_names[test_size:test_size + val_size],
+                              test=file_names[:test_size])
+
+        # Near-duplicates are moved together to the side
+        # of their group's first member, also across classes
+        units = OrderedDict()
+        for file_name in file_names:
+            path = os.path.join(class_dir_name, file_name)
+            units.setdefault(group_ids.get(path, path), []).append(file_name)
+
+        sides = {'train': [], 'val': [], 'test': []}
+        for unit_id, unit in units.items():
+            if unit_id not in group_sides:
+                if len(sides['test']) + len(unit) <= test_size:
+                    group_sides[unit_id] = 'test'
+                elif len(sides['val']) + len(unit) <= val_size:
+                    group_sides[unit_id] = 'val'
+                else:
+                    group_sides[unit_id] = 'train'
+            sides[group_sides[unit_id]].extend(unit)
+
+        return data_split(**sides)
 
-        return data_split(train=file_names[test_size:],
-                          test=file_names[:test_size])
+    def __k_fold_single_class(self, parent_dir_name, class_dir_name, folds,
+                              file_names=None, group_ids=None,
+                              group_folds=None):
+        file_names = self.__shuffled_file_names(parent_dir_name,
+                                                class_dir_name, file_names)
+        if not group_ids:
+            bounds = [len(file_names) * fold // folds
+                      for fold in range(folds + 1)]
+            return [file_names[start:stop]
+                    for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        # Near-duplicates go to the fold of their group's first member,
+        # other images to the smallest fold of the class
+        units = OrderedDict()
+        for file_name in file_names:
+            path = os.path.join(class_dir_name, file_name)
+            units.setdefault(group_ids.get(path, path), []).append(file_name)
+
+        parts = [[] for _ in range(folds)]
+        for unit_id, unit in units.items():
+            if unit_id not in group_folds:
+                group_folds[unit_id] = min(range(folds),
+                                           key=lambda fold: len(parts[fold]))
+            parts[group_folds[unit_id]].extend(unit)
+        return parts
 
     @staticmethod
     def __join_paths(class_dir_name, file_names):
@@ -45,17 +122,121 @@ class Splitter:
                         os.path.join(class_dir_name, file_name),
                         file_names))
 
+    def __map_classes(self, function, class_dir_names, file_names=None):
+        """Runs `function` with every class and its file names."""
+        def run(class_dir_name):
+            return function(class_dir_name,
+                            file_names.get(class_dir_name, [])
+                            if file_names is not None else None)
+
+        if self.__workers <= 1:
+            return list(map(run, class_dir_names))
+        with ThreadPoolExecutor(max_workers=self.__workers) as executor:
+            return list(executor.map(run, class_dir_names))
+
     def split_dataset(self, parent_dir_name: str,
-                      class_dir_names: list) -> dict:
+                      class_dir_names: list, groups: list = None,
+                      file_names: dict = None,
+                      group_sides: dict = None) -> dict:
+        """Splits files of every class into train and test sets.
+
+        A val set is split too when `val_size` is set.
+        `groups` are lists of relative paths of near-duplicates,
+        every group is kept on one side of the split.
+        `file_names` of classes are used instead of listing class
+        directories, e.g. from the manifest or a shards index.
+        Sides of groups are stored in `group_sides`, so classes split
+        by separate calls sharing it keep groups together too.
+        """
+        group_ids = {}
+        for group_id, group in enumerate(groups or []):
+            for path in group:
+                group_ids[path] = group_id
+        if group_sides is None:
+            group_sides = {}
+
+        if group_ids:
+            # Sides of groups are shared, classes are split in order
+            data_splits = [self.__split_single_class(
+                parent_dir_name, class_dir_name, group_ids, group_sides,
+                file_names.get(class_dir_name, [])
+                if file_names is not None else None)
+                for class_dir_name in class_dir_names]
+        else:
+            data_splits = self.__map_classes(
+                lambda class_dir_name, names: self.__split_single_class(
+                    parent_dir_name, class_dir_name, file_names=names),
+                class_dir_names, file_names)
+
+        keys = ['train', 'val', 'test'] if self.__val_size \
+            else ['train', 'test']
+        dataset = OrderedDict((key, []) for key in keys)
+        for class_dir_name, data_split in zip(class_dir_names, data_splits):
+            for key in keys:
+                dataset[key].extend(self.__join_paths(
+                    class_dir_name, getattr(data_split, key)))
 
-        train = []
-        test = []
-        for class_dir_name in class_dir_names:
-            data_split = self.__split_single_class(parent_dir_name, class_dir_name)
-            train.extend(self.__join_paths(class_dir_name, data_split.train))
-            test.extend(self.__join_paths(class_dir_name, data_split.test))
+        return dict(dataset)
 
-        return {'train': train, 'test': test}
+    def k_fold(self, parent_dir_name: str, class_dir_names: list, folds: int,
+               file_names: dict = None, groups: list = None) -> list:
+        """Returns `folds` train and test splits for cross-validation.
+
+        Images of every class are shuffled once and cut into `folds`
+        parts, each of them is the test set of one split. Every group
+        of near-duplicates in `groups` is kept in a single part.
+        """
+        if folds < 2:
+            raise ValueError('At least 2 folds are required')
+
+        group_ids = {}
+        for group_id, group in enumerate(groups or []):
+            for path in group:
+                group_ids[path] = group_id
+        group_folds = {}
+
+        if group_ids:
+            # Folds of groups are shared, classes are split in order
+            class_folds = [self.__k_fold_single_class(
+                parent_dir_name, class_dir_name, folds,
+                file_names.get(class_dir_name, [])
+                if file_names is not None else None,
+                group_ids, group_folds)
+                for class_dir_name in class_dir_names]
+        else:
+            class_folds = self.__map_classes(
+                lambda class_dir_name, names: self.__k_fold_single_class(
+                    parent_dir_name, class_dir_name, folds, names),
+                class_dir_names, file_names)
+
+        splits = [{'train': [], 'test': []} for _ in range(folds)]
+        for class_dir_name, parts in zip(class_dir_names, class_folds):
+            for fold, split in enumerate(splits):
+                for part_number, part in enumerate(parts):
+                    key = 'test' if part_number == fold else 'train'
+                    split[key].extend(self.__join_paths(class_dir_name,
+                                                        part))
+
+        return splits
+
+
+def manifest_file_names(manifest: mf.Manifest, parent_dir_name) -> dict:
+    """Returns file names of downloaded images of every class.
+
+    Duplicates are included when they are hard-linked into their class.
+    """
+    file_names = defaultdict(list)
+    for record in manifest.records():
+        if record['state'] == mf.DUPLICATE:
+            if not os.path.exists(manifest.path(record['url'])):
+                continue
+        elif record['state'] != mf.DONE:
+            continue
+        path = os.path.relpath(manifest.path(record['url']), parent_dir_name)
+        class_dir_name, file_name = os.path.split(path)
+        file_names[class_dir_name].append(file_name)
+
+    return dict(file_names)
 
 
 def parse_arguments():
@@ -64,7 +245,28 @@ def parse_arguments():
                         help="Path to the configuration file.")
     parser.add_argument('--output_dir', required=True,
                         help="Path to the directory for storing results")
-    parser.add_argument('--output_file_name', required=True)
+    parser.add_argument('--output_file_name', required=True,
+                        help="Split index when ending with .idx, "
+                             "JSON split otherwise")
+    parser.add_argument('--near_duplicates_file_name', default=None,
+                        help="Groups of near-duplicates to keep "
+                             "on one side of the split")
+    parser.add_argument('--manifest_file_name', default=None,
+                        help="Download manifest listing images to split "
+                             "instead of class directories")
+    parser.add_argument('--inventory_file_name', default='inventory.json',
+                        help="Cached listing of class directories, used "
+                             "without a manifest or a shards index")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="Number of classes split at once")
+    parser.add_argument('--shards_index_file_name', default=None,
+                        help="Index of images packed into shards, "
+                             "the split then refers to shard offsets")
+    parser.add_argument('--metrics_file_name', default=None,
+                        help="JSON report of metrics shared by all scripts")
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help="Port serving metrics in Prometheus text "
+                             "format while running")
 
     return parser.parse_args()
 
@@ -79,8 +281,9 @@ def load_config(path):
         return None
 
 
-def get_classes_names(output_dir, config):
-    class_dir_names = next(os.walk(output_dir))[1]
+def get_classes_names(output_dir, config, class_dir_names=None):
+    if class_dir_names is None:
+        class_dir_names = Inventory(output_dir).class_names()
     if type(class_dir_names) is not list:
         class_dir_names = [class_dir_names]
     class_config_names = [entry['name'] for entry in config['classes']]
@@ -96,22 +299,78 @@ def get_classes_names(output_dir, config):
     return class_dir_names
 
 
+def __save(train_test_split, output_path, index: ShardIndex = None):
+    if index is not None:
+        train_test_split = {key: index.locate(paths)
+                            for key, paths in train_test_split.items()}
+
+    if is_split_index(output_path):
+        SplitIndex.from_json(train_test_split).save(output_path)
+    else:
+        with open(output_path, 'w') as f:
+            json.dump(train_test_split, f, indent=4)
+
+
 def main():
     args = parse_arguments()
     config = load_config(args.config)
     logging.basicConfig(level=logging.INFO)
 
-    splitter = Splitter(config['train_test_split']['test_size'],
-                        config['train_test_split']['type'],
-                        config['train_test_split']['seed'])
+    split_config = config['train_test_split']
+    splitter = Splitter(split_config['test_size'],
+                        split_config['type'],
+                        split_config['seed'],
+                        split_config.get('val_size', 0),
+                        args.workers)
+    metrics = open_metrics('split', args.metrics_file_name,
+                           args.metrics_port)
+
+    index = None
+    file_names = None
+    if args.shards_index_file_name:
+        index = ShardIndex.load(os.path.join(args.output_dir,
+                                             args.shards_index_file_name))
+        file_names = index.class_file_names()
+    elif args.manifest_file_name:
+        with mf.Manifest(os.path.join(args.output_dir,
+                                      args.manifest_file_name),
+                         check_files=False) as manifest:
+            file_names = manifest_file_names(manifest, args.output_dir)
+    else:
+        inventory = Inventory(args.output_dir,
+                              os.path.join(args.output_dir,
+                                           args.inventory_file_name))
+        file_names = inventory.class_file_names()
+        inventory.save()
+
+    class_dir_names = get_classes_names(
+        args.output_dir, config, sorted(file_names))
 
-    class_dir_names = get_classes_names(args.output_dir, config)
+    groups = None
+    if args.near_duplicates_file_name:
+        with open(os.path.join(args.output_dir,
+                               args.near_duplicates_file_name), 'r') as f:
+            groups = json.load(f)
 
-    train_test_split = splitter.split_dataset(args.output_dir,
-                                              class_dir_names)
+    output_path = os.path.join(args.output_dir, args.output_file_name)
+    folds = split_config.get('folds')
+    if folds:
+        # Every fold goes to its own file, e.g. split_fold0.json
+        root, extension = os.path.splitext(output_path)
+        with stage_timer(metrics, 'k_fold'):
+            for fold, fold_split in enumerate(
+                    splitter.k_fold(args.output_dir, class_dir_names, folds,
+                                    file_names, groups)):
+                __save(fold_split,
+                       '{}_fold{}{}'.format(root, fold, extension), index)
 
-    with open(os.path.join(args.output_dir, args.output_file_name), 'w') as f:
-        json.dump(train_test_split, f, indent=4)
+    with stage_timer(metrics, 'split'):
+        train_test_split = splitter.split_dataset(args.output_dir,
+                                                  class_dir_names, groups,
+                                                  file_names)
+        __save(train_test_split, output_path, index)
+    count_images(metrics, 'split', train_test_split)
+    close_metrics(metrics, args.output_dir, args.metrics_file_name)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,226 @@
+import argparse
+import json
+import logging
+import os
+import random
+
+import numpy as np
+
+
+class SplitIndex:
+    """Train test split stored as packed arrays instead of path lists.
+
+    Every image of the split is stored once in a table of class ids and
+    file names, the sets of the split are arrays of ids into that table.
+    Shard locations, when present, are stored the same way. Saved indices
+    are directories of `.npy` files memory-mapped on load, so only the
+    parts in use are read.
+    """
+
+    __meta_file_name = 'meta.json'
+    __table_columns = ('class_ids', 'file_names', 'shard_ids', 'offsets',
+                       'sizes')
+
+    def __init__(self, classes: list, class_ids, file_names, sets: dict,
+                 shards: list = None, shard_ids=None, offsets=None,
+                 sizes=None):
+        self.classes = list(classes)
+        self.class_ids = class_ids
+        self.file_names = file_names
+        self.sets = sets
+        self.shards = shards
+        self.shard_ids = shard_ids
+        self.offsets = offsets
+        self.sizes = sizes
+
+    @classmethod
+    def from_json(cls, train_test_split: dict):
+        """Converts a split in the JSON schema of `extract_subset.py`."""
+        keys = list(train_test_split.keys())
+        entries = [entry for key in keys for entry in train_test_split[key]]
+        located = any(isinstance(entry, dict) for entry in entries)
+        paths = np.array([entry['path'] if located else entry
+                          for entry in entries], dtype=str)
+
+        table, first, ids = np.unique(paths, return_index=True,
+                                      return_inverse=True)
+        class_names, file_names = zip(*(path.rpartition(os.sep)[::2]
+                                        for path in table)) \
+            if len(table) else ((), ())
+        classes, class_ids = np.unique(np.array(class_names, dtype=str),
+                                       return_inverse=True)
+
+        sets = {}
+        start = 0
+        for key in keys:
+            stop = start + len(train_test_split[key])
+            sets[key] = ids[start:stop].astype(np.int64)
+            start = stop
+
+        # Names are stored as UTF-8 bytes, 4 times smaller than unicode
+        index = cls(classes.tolist(), class_ids.astype(np.int32),
+                    np.char.encode(np.array(file_names, dtype=str),
+                                   'utf-8'), sets)
+        if located:
+            table_entries = [entries[i] for i in first]
+            shards, shard_ids = np.unique(
+                np.array([entry['shard'] for entry in table_entries],
+                         dtype=str), return_inverse=True)
+            index.shards = shards.tolist()
+            index.shard_ids = shard_ids.astype(np.int32)
+            index.offsets = np.array([entry['offset']
+                                      for entry in table_entries],
+                                     dtype=np.int64)
+            index.sizes = np.array([entry['size'] for entry in table_entries],
+                                   dtype=np.int64)
+
+        return index
+
+    def paths(self, ids) -> np.ndarray:
+        """Returns relative paths of images with `ids`."""
+        classes = np.char.encode(
+            np.array([class_ + os.sep for class_ in self.classes],
+                     dtype=str), 'utf-8')
+        return np.char.decode(np.char.add(classes[self.class_ids[ids]],
+                                          self.file_names[ids]), 'utf-8')
+
+    def entries(self, key) -> list:
+        """Returns the `key` set in the JSON schema."""
+        ids = self.sets[key]
+        paths = self.paths(ids).tolist()
+        if self.shards is None:
+            return paths
+
+        shards = np.array(self.shards, dtype=str)[self.shard_ids[ids]]
+        return [{'path': path, 'shard': shard, 'offset': offset,
+                 'size': size}
+                for path, shard, offset, size in
+                zip(paths, shards.tolist(), self.offsets[ids].tolist(),
+                    self.sizes[ids].tolist())]
+
+    def to_json(self) -> dict:
+        return {key: self.entries(key) for key in self.sets.keys()}
+
+    def class_groups(self, ids):
+        """Yields class ids and positions of `ids` from the class.
+
+        Classes come in the order of their first image, positions keep
+        the order of `ids`.
+        """
+        class_ids = self.class_ids[ids]
+        order = np.argsort(class_ids, kind='stable')
+        sorted_ids = class_ids[order]
+        bounds = np.flatnonzero(np.diff(sorted_ids)) + 1
+        groups = np.split(order, bounds) if len(order) else []
+        for group in sorted(groups, key=lambda group: group[0]):
+            yield int(class_ids[group[0]]), group
+
+    def subset(self, percentage, seed=42):
+        """Extracts `percentage` of images of every class and set.
+
+        Gives the same images as `extract_subset.extract` on the JSON
+        split: a permutation of positions is shuffled with the seed
+        instead of the paths.
+        """
+        if percentage > 100 or percentage < 0:
+            raise ValueError('Percentage should be between 0 and 100')
+        elif percentage > 1:
+            percentage /= 100.
+
+        sets = {}
+        for key, ids in self.sets.items():
+            subsets = []
+            for _, positions in self.class_groups(ids):
+                permutation = list(range(len(positions)))
+                random.seed(seed)
+                random.shuffle(permutation)
+                subset_size = int(len(positions) * percentage)
+                subsets.append(positions[permutation[:subset_size]])
+            sets[key] = ids[np.concatenate(subsets)] \
+                if subsets else ids[:0]
+
+        return SplitIndex(self.classes, self.class_ids, self.file_names,
+                          sets, self.shards, self.shard_ids, self.offsets,
+                          self.sizes)
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        with open(os.path.join(path, self.__meta_file_name), 'w') as f:
+            json.dump({'classes': self.classes,
+                       'shards': self.shards,
+                       'sets': list(self.sets.keys())}, f)
+        for column in self.__table_columns:
+            values = getattr(self, column)
+            if values is not None:
+                np.save(os.path.join(path, column + '.npy'), values)
+        for key, ids in self.sets.items():
+            np.save(os.path.join(path, 'set_{}.npy'.format(key)), ids)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, cls.__meta_file_name), 'r') as f:
+            meta = json.load(f)
+
+        def load_array(name):
+            array_path = os.path.join(path, name + '.npy')
+            if not os.path.exists(array_path):
+                return None
+            return np.load(array_path, mmap_mode='r')
+
+        columns = {column: load_array(column)
+                   for column in cls.__table_columns}
+        sets = {key: load_array('set_{}'.format(key))
+                for key in meta['sets']}
+        return cls(meta['classes'], sets=sets, shards=meta['shards'],
+                   **columns)
+
+
+def is_split_index(path):
+    return path.endswith('.idx')
+
+
+def load_split(path):
+    """Loads a JSON split or a `.idx` split index as a `SplitIndex`."""
+    if is_split_index(path):
+        return SplitIndex.load(path)
+
+    with open(path, 'r') as f:
+        return SplitIndex.from_json(json.load(f))
+
+
+def save_split(index: SplitIndex, path):
+    """Saves a `.idx` split index or the JSON split by the extension."""
+    if is_split_index(path):
+        index.save(path)
+        return
+
+    with open(path, 'w') as f:
+        json.dump(index.to_json(), f, indent=4)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', required=True,
+                        help="Path to the directory with splits")
+    parser.add_argument('--input_file_name', required=True)
+    parser.add_argument('--output_file_name', required=True,
+                        help="Split index when ending with .idx, "
+                             "JSON split otherwise")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+
+    index = load_split(os.path.join(args.output_dir, args.input_file_name))
+    logging.info('Converting a split of {} images'
+                 .format(len(index.file_names)))
+    save_split(index, os.path.join(args.output_dir, args.output_file_name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+from benchmark import compare, run_benchmarks
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(images=40, classes=2, workers=4,
+                             image_size=1024)
+
+    assert sorted(results) == ['download', 'extract', 'fetch', 'split']
+    for result in results.values():
+        assert result['items'] == 40
+        assert result['items_per_second'] > 0
+        assert result['peak_rss_mb'] > 0
+    # A page of 20 urls for each class
+    assert results['fetch']['api_calls'] == 2
+    assert results['download']['image_requests_per_item'] == 1.
+    assert results['extract']['extracted'] == 2
+
+
+def test_run_benchmarks_retries_errors():
+    results = run_benchmarks(['download'], images=40, classes=2, workers=4,
+                             error_rate=0.2, image_size=1024, seed=42)
+
+    assert results['download']['image_requests'] > 40
+
+
+def test_compare_finds_regressions():
+    baseline = {'stages': {
+        'split': {'items_per_second': 1000., 'peak_rss_mb': 100.},
+        'extract': {'items_per_second': 1000., 'peak_rss_mb': 100.}}}
+    results = {
+        'split': {'items_per_second': 950., 'peak_rss_mb': 105.},
+        'extract': {'items_per_second': 500., 'peak_rss_mb': 150.},
+        'fetch': {'items_per_second': 1., 'peak_rss_mb': 1.}}
+
+    assert compare(results, baseline, tolerance=0.1) == [
+        'extract: 500.0 items/s, was 1000.0',
+        'extract: 150.0 MB peak RSS, was 100.0']
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import threading
+
+from dedup import DedupIndex
+
+
+def test_photo_id():
+    url = 'https://farm5.staticflickr.com/4865/46944690811_3535fb688d_m.jpg'
+
+    assert DedupIndex.photo_id(url) == '46944690811'
+    assert DedupIndex.photo_id('file:///data/image_1.jpg') is None
+
+
+def test_claims_persisted():
+    url = 'https://farm5.staticflickr.com/4865/46944690811_3535fb688d_m.jpg'
+    repost_url = 'https://farm8.staticflickr.com/1/46944690811_aaaa_m.jpg'
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_path = os.path.join(temp_dir, 'dedup_index.jsonl')
+        first_path = os.path.join(temp_dir, 'cat', '0.jpg')
+        second_path = os.path.join(temp_dir, 'dog', '0.jpg')
+
+        with DedupIndex(index_path) as dedup:
+            assert dedup.claim_photo(url, first_path) is None
+            assert dedup.claim_content('checksum', first_path) is None
+            dedup.add(url, 'checksum', first_path)
+
+        with DedupIndex(index_path) as dedup:
+            assert dedup.claim_photo(repost_url, second_path) == first_path
+            assert dedup.claim_content('checksum', second_path) == first_path
+            assert dedup.claim_content('other', second_path) is None
+            dedup.release_content('other', second_path)
+            assert dedup.claim_content('other', first_path) is None
+
+
+def test_claims_wait_for_downloads_in_flight():
+    url = 'https://farm5.staticflickr.com/4865/46944690811_3535fb688d_m.jpg'
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        first_path, second_path, third_path = [
+            os.path.join(temp_dir, name, '0.jpg')
+            for name in ('cat', 'dog', 'frog')]
+        claims = {}
+
+        def claim(path):
+            claims[path] = dedup.claim_photo(url, path)
+
+        with DedupIndex(os.path.join(temp_dir, 'dedup.jsonl')) as dedup:
+            assert dedup.claim_photo(url, first_path) is None
+            second = threading.Thread(target=claim, args=(second_path,))
+            second.start()
+            second.join(0.1)
+            assert second.is_alive()
+            # A failed download lets the waiting claim download the photo
+            dedup.release_photo(url, first_path)
+            second.join()
+
+            third = threading.Thread(target=claim, args=(third_path,))
+            third.start()
+            third.join(0.1)
+            assert third.is_alive()
+            dedup.add(url, 'checksum', second_path)
+            third.join()
+
+    assert claims == {second_path: None, third_path: second_path}
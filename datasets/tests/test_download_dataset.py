@@ -1,7 +1,25 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
 import os
+import shutil
+from socketserver import ThreadingMixIn
 import tempfile
+import threading
+import time
 
-from download_dataset import download_image
+import pytest
+
+from download_dataset import chunk_records, download_dataset, \
+    download_image, download_limits, download_records, fetch_image, \
+    read_urls_records, record_key, shard_records
+from dedup import DedupIndex
+from http_pool import ConnectionPool
+from inventory import Inventory
+from manifest import Manifest
+from metrics import Metrics
+from rate_limit import Backoff, Retrier
+from shards import ShardIndex, ShardWriter
 
 
 def get_data_url(filename):
@@ -11,6 +29,10 @@ def get_data_url(filename):
     return 'file://' + data_path
 
 
+def get_data_path(filename):
+    return os.path.join(os.path.dirname(__file__), 'data', filename)
+
+
 def test_download_image_valid():
     url = get_data_url('image_1.jpg')
 
@@ -29,3 +51,382 @@ def test_download_image_invalid():
         result = download_image(url, save_path)
 
     assert result is False
+
+
+def test_fetch_image_too_large():
+    url = get_data_url('image_1.jpg')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        save_path = os.path.join(temp_dir, 'image.jpg')
+        result = fetch_image(url, save_path,
+                             limits=download_limits(max_size=1024,
+                                                    chunk_size=256))
+        leftovers = os.listdir(temp_dir)
+
+    assert result is None
+    assert leftovers == []
+
+
+def test_fetch_image_streamed_in_chunks():
+    url = get_data_url('image_1.jpg')
+    with open(os.path.join(os.path.dirname(__file__), 'data',
+                           'image_1.jpg'), 'rb') as f:
+        body = f.read()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        save_path = os.path.join(temp_dir, 'image.jpg')
+        result = fetch_image(url, save_path,
+                             limits=download_limits(chunk_size=100))
+        with open(save_path, 'rb') as f:
+            saved = f.read()
+        leftovers = os.listdir(temp_dir)
+
+    assert result.size == len(body)
+    assert saved == body
+    assert leftovers == ['image.jpg']
+
+
+class SlowImageHandler(BaseHTTPRequestHandler):
+    latency = 0.05
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        with open(os.path.join(os.path.dirname(__file__), 'data',
+                               'image_1.jpg'), 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@contextmanager
+def image_server():
+    server = ThreadingServer(('127.0.0.1', 0), SlowImageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def timed_download(urls_data, workers):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        start = time.time()
+        summary = download_dataset(urls_data, temp_dir, workers)
+        elapsed = time.time() - start
+        file_names = sorted(os.listdir(os.path.join(temp_dir, 'cat')))
+
+    return summary, file_names, elapsed
+
+
+def test_download_dataset_concurrent():
+    with image_server() as base_url:
+        urls_data = {
+            'cat': ['{}/cat/{}.jpg'.format(base_url, i) for i in range(12)],
+            'dog': ['{}/dog/{}.jpg'.format(base_url, i) for i in range(12)]
+        }
+        serial = timed_download(urls_data, workers=1)
+        concurrent = timed_download(urls_data, workers=8)
+
+    assert serial[0] == concurrent[0] == [
+        'Class cat: Downloaded: 12 Expected: 12\n',
+        'Class dog: Downloaded: 12 Expected: 12\n']
+    assert concurrent[1] == ['{}.jpg'.format(str(i).zfill(2))
+                             for i in range(12)]
+    assert concurrent[2] * 2 < serial[2]
+
+
+def test_download_dataset_metrics():
+    metrics = Metrics('download')
+    with image_server() as base_url, \
+            tempfile.TemporaryDirectory() as temp_dir:
+        urls_data = {'cat': ['{}/cat/{}.jpg'.format(base_url, i)
+                             for i in range(3)] + [get_data_url('image.jpg')]}
+        download_dataset(urls_data, temp_dir, workers=2, metrics=metrics)
+
+    image_size = os.path.getsize(os.path.join(os.path.dirname(__file__),
+                                              'data', 'image_1.jpg'))
+    assert metrics.value('images', stage='download', state='done') == 3
+    assert metrics.value('images', stage='download', state='failed') == 1
+    assert metrics.value('bytes', stage='download') == 3 * image_size
+    assert metrics.value('download_seconds', stage='download') == 4
+    assert metrics.value('errors', stage='download', kind='file',
+                         host='local') == 1
+
+
+def test_download_dataset_resumed_from_manifest():
+    valid_url = get_data_url('image_1.jpg')
+    invalid_url = get_data_url('image.jpg')
+    new_url = get_data_url('image_2.jpg')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        manifest_path = os.path.join(temp_dir, 'manifest.jsonl')
+        with Manifest(manifest_path) as manifest:
+            download_dataset({'cat': [valid_url, invalid_url]}, temp_dir,
+                             manifest=manifest)
+            assert manifest.get(valid_url)['state'] == 'done'
+            assert manifest.get(valid_url)['size'] == 22289
+            assert manifest.get(invalid_url)['state'] == 'failed'
+
+        # Completed file must not be downloaded again
+        first_path = os.path.join(temp_dir, 'cat', '0.jpg')
+        os.utime(first_path, (0, 0))
+
+        with Manifest(manifest_path) as manifest:
+            summary = download_dataset(
+                {'cat': [new_url, valid_url, invalid_url]}, temp_dir,
+                manifest=manifest)
+            assert manifest.get(new_url)['path'] == \
+                os.path.join('cat', '0_1.jpg')
+
+        assert os.stat(first_path).st_mtime == 0
+        assert summary == ['Class cat: Downloaded: 2 Expected: 3\n']
+
+
+class FlakyImageHandler(SlowImageHandler):
+    latency = 0
+    requests_count = 0
+
+    def do_GET(self):
+        FlakyImageHandler.requests_count += 1
+        if FlakyImageHandler.requests_count <= 2:
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super().do_GET()
+
+
+def test_download_image_retried():
+    server = ThreadingServer(('127.0.0.1', 0), FlakyImageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:{}/image.jpg'.format(server.server_address[1])
+
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            save_path = os.path.join(temp_dir, 'image.jpg')
+            pool = ConnectionPool()
+            retrier = Retrier(attempts=2, backoff=Backoff(base_delay=0))
+            assert download_image(url, save_path, pool) is False
+            assert download_image(url, save_path, pool, retrier) is True
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert FlakyImageHandler.requests_count == 3
+
+
+def test_download_records_out_of_order_pages():
+    url = get_data_url('image_1.jpg')
+    records = [{'class': 'cat', 'count': 12, 'offset': 10, 'urls': [url] * 2},
+               {'class': 'dog', 'count': 1, 'offset': 0, 'urls': [url]},
+               {'class': 'cat', 'count': 12, 'offset': 0, 'urls': [url] * 10}]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        summary = download_records(iter(records), temp_dir)
+        file_names = sorted(os.listdir(os.path.join(temp_dir, 'cat')))
+
+    assert summary == ['Class cat: Downloaded: 12 Expected: 12\n',
+                       'Class dog: Downloaded: 1 Expected: 1\n']
+    assert file_names == ['{}.jpg'.format(str(i).zfill(2))
+                          for i in range(12)]
+
+
+def test_read_urls_records_follow():
+    records = [{'class': 'cat', 'count': 2, 'offset': i, 'urls': ['url']}
+               for i in range(2)]
+
+    def write_records(path):
+        with open(path, 'a') as f:
+            for record in records:
+                time.sleep(0.05)
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+            f.write(json.dumps({'done': True}) + '\n')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'urls_data.jsonl')
+        open(path, 'w').close()
+        writer = threading.Thread(target=write_records, args=(path,))
+        writer.start()
+        read = list(read_urls_records(path, follow=True, poll_interval=0.01))
+        writer.join()
+
+    assert read == records
+
+
+def test_read_urls_records_follow_times_out():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'urls_data.jsonl')
+        # Fetching failed after the first record
+        with open(path, 'w') as f:
+            f.write(json.dumps({'class': 'cat', 'count': 2, 'offset': 0,
+                                'urls': ['url']}) + '\n')
+        records = read_urls_records(path, follow=True, poll_interval=0.01,
+                                    idle_timeout=0.1)
+
+        assert next(records)['class'] == 'cat'
+        with pytest.raises(TimeoutError):
+            next(records)
+
+
+def test_download_dataset_skips_duplicates():
+    urls_data = {'cat': [get_data_url('image_1.jpg'),
+                         get_data_url('image_2.jpg')],
+                 'dog': [get_data_url('image_1.jpg')]}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_path = os.path.join(temp_dir, 'dedup_index.jsonl')
+        with DedupIndex(index_path) as dedup:
+            summary = download_dataset(urls_data, temp_dir, dedup=dedup)
+
+        with DedupIndex(index_path) as dedup:
+            assert len(dedup) == 2
+            linked = download_dataset({'frog': urls_data['dog']}, temp_dir,
+                                      dedup=dedup, link_duplicates=True)
+
+    assert summary == ['Class cat: Downloaded: 2 Expected: 2 Duplicates: 0\n',
+                       'Class dog: Downloaded: 0 Expected: 1 Duplicates: 1\n']
+    assert linked == ['Class frog: Downloaded: 1 Expected: 1 Duplicates: 1\n']
+
+
+def test_download_records_reports_failed_records():
+    url = get_data_url('image_1.jpg')
+    records = [{'class': 'cat', 'count': 4, 'offset': 0,
+                'urls': [url, get_data_url('missing.jpg')]},
+               {'class': 'cat', 'count': 4, 'offset': 2, 'urls': [url] * 2}]
+    done_records = []
+    failed_records = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        download_records(iter(records), temp_dir,
+                         on_record_done=done_records.append,
+                         on_record_failed=failed_records.append)
+
+    assert done_records == records[1:]
+    assert failed_records == records[:1]
+
+
+def test_download_records_waits_for_photos_in_flight():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Same Flickr photo id on two servers, the first one missing
+        urls = []
+        for server in ('1', '2', '3'):
+            os.makedirs(os.path.join(temp_dir, 'data', server))
+            path = os.path.join(temp_dir, 'data', server, '12345_abc_m.jpg')
+            urls.append('file://' + path)
+        for server in ('2', '3'):
+            shutil.copy(get_data_path('image_1.jpg'), os.path.join(
+                temp_dir, 'data', server, '12345_abc_m.jpg'))
+        records = [{'class': class_name, 'count': 1, 'offset': 0,
+                    'urls': [url]}
+                   for class_name, url in zip(('cat', 'dog', 'frog'), urls)]
+        output_dir = os.path.join(temp_dir, 'output')
+        os.makedirs(output_dir)
+
+        with Manifest(os.path.join(output_dir, 'manifest.jsonl')) as manifest, \
+                DedupIndex(os.path.join(output_dir, 'dedup.jsonl')) as dedup:
+            download_records(iter(records), output_dir, workers=4,
+                             manifest=manifest, dedup=dedup,
+                             link_duplicates=True,
+                             inventory=Inventory(output_dir))
+            states = sorted(manifest.get(url)['state'] for url in urls)
+        file_names = [os.listdir(os.path.join(output_dir, class_name))
+                      for class_name in ('dog', 'frog')]
+
+    assert states in (['done', 'duplicate', 'duplicate'],
+                      ['done', 'duplicate', 'failed'])
+    assert file_names == [['0.jpg'], ['0.jpg']]
+
+
+def test_download_records_skips_missing_links():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        url = 'file://' + os.path.join(temp_dir, '12345_abc_m.jpg')
+        shutil.copy(get_data_path('image_1.jpg'),
+                    os.path.join(temp_dir, '12345_abc_m.jpg'))
+        index_path = os.path.join(temp_dir, 'dedup.jsonl')
+        # The stored copy of the photo was removed since
+        with DedupIndex(index_path) as dedup:
+            dedup.add(url, 'checksum', os.path.join(temp_dir, 'cat', '0.jpg'))
+        inventory = Inventory(temp_dir)
+
+        with DedupIndex(index_path) as dedup:
+            summary = download_records(
+                iter([{'class': 'dog', 'count': 1, 'offset': 0,
+                       'urls': [url]}]),
+                temp_dir, dedup=dedup, link_duplicates=True,
+                inventory=inventory)
+
+    assert summary == ['Class dog: Downloaded: 0 Expected: 1 Duplicates: 1\n']
+
+
+def test_download_dataset_to_shards():
+    urls_data = {'cat': [get_data_url('image_1.jpg'),
+                         get_data_url('image_2.jpg')]}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with ShardWriter(temp_dir) as writer:
+            summary = download_dataset(urls_data, temp_dir, writer=writer)
+        index = ShardIndex.load(writer.index_path)
+        entry = index[os.path.join('cat', '0.jpg')]
+        with open(os.path.join(writer.shards_dir, entry.shard), 'rb') as f:
+            f.seek(entry.offset)
+            data = f.read(entry.size)
+        class_dir_exists = os.path.exists(os.path.join(temp_dir, 'cat'))
+
+    with open(os.path.join(os.path.dirname(__file__), 'data',
+                           'image_1.jpg'), 'rb') as f:
+        assert data == f.read()
+    assert summary == ['Class cat: Downloaded: 2 Expected: 2\n']
+    assert not class_dir_exists
+
+
+def test_download_records_in_shards():
+    url = get_data_url('image_1.jpg')
+    records = [{'class': 'cat', 'count': 25, 'offset': 0, 'urls': [url] * 20},
+               {'class': 'cat', 'count': 25, 'offset': 20, 'urls': [url] * 5},
+               {'class': 'dog', 'count': 0, 'offset': 0, 'urls': []}]
+    chunks = list(chunk_records(records, 4))
+    shards = [list(shard_records(chunks, shard_index, 2))
+              for shard_index in range(2)]
+    done_records = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        summaries = [download_records(iter(shard), temp_dir,
+                                      on_record_done=done_records.append,
+                                      partial=True)
+                     for shard in shards]
+        file_names = sorted(os.listdir(os.path.join(temp_dir, 'cat')))
+
+    # Every worker expects only the urls of its chunks
+    expected = 0
+    for summary in summaries:
+        for line in summary:
+            _, _, downloaded, count = line.split(': ')
+            assert downloaded.split()[0] == count.strip()
+            if line.startswith('Class cat'):
+                expected += int(count)
+    assert expected == 25
+
+    assert [record['offset'] for record in chunks] == \
+        [0, 4, 8, 12, 16, 20, 24, 0]
+    assert sorted(map(record_key, sum(shards, []))) == \
+        sorted(map(record_key, chunks))
+    assert all(shards)
+    assert sorted(map(record_key, done_records)) == \
+        sorted(map(record_key, chunks))
+    assert file_names == ['{}.jpg'.format(str(i).zfill(2))
+                          for i in range(25)]
@@ -0,0 +1,56 @@
+import io
+import json
+import os
+import random
+
+from extract_subset import extract, extract_subsets, iter_split_sets
+
+
+def make_split():
+    paths = [os.path.join(class_name, '{:03d}.jpg'.format(i))
+             for class_name in ('dog', 'cat', 'frog')
+             for i in range(10 + len(class_name))]
+    return {'train': paths[::3] + paths[1::3], 'test': paths[2::3]}
+
+
+def reference_extract(train_test_split, percentage, seed):
+    # Shuffles paths of every class as extract did before streaming
+    subset = {}
+    for key, paths in train_test_split.items():
+        classes = {}
+        for path in paths:
+            classes.setdefault(os.path.dirname(path), []).append(path)
+        subset[key] = []
+        for file_names in classes.values():
+            random.seed(seed)
+            random.shuffle(file_names)
+            subset[key].extend(file_names[:int(len(file_names) *
+                                               percentage / 100.)])
+    return subset
+
+
+def test_extract_matches_shuffled_paths():
+    assert extract(make_split(), 40, 42) == \
+        reference_extract(make_split(), 40, 42)
+
+
+def test_iter_split_sets_small_chunks():
+    split = make_split()
+    split['test'] = []
+    f = io.StringIO(json.dumps(split, indent=4))
+
+    read = {key: list(entries) for key, entries in
+            iter_split_sets(f, chunk_size=7)}
+
+    assert read == split
+
+
+def test_extract_subsets_in_one_pass():
+    split = make_split()
+    f = io.StringIO(json.dumps(split))
+
+    subsets = extract_subsets(iter_split_sets(f), [25, 50, 100], seed=3)
+
+    assert subsets[0] == extract(make_split(), 25, 3)
+    assert subsets[1] == extract(make_split(), 50, 3)
+    assert sorted(subsets[2]['train']) == sorted(split['train'])
@@ -1,4 +1,11 @@
-from fetch_urls import Fetcher
+import os
+import tempfile
+import threading
+import time
+
+from fetch_urls import Fetcher, load_urls_data, merge_urls_data, \
+    records_to_urls_data, write_urls_data
+from search_cache import SearchCache
 
 class CallBuilder:
     """Copied from:
@@ -181,3 +188,164 @@ def test_fetch_invalid_data():
     assert requested_class in fetched_urls.keys()
     assert len(fetched_urls[requested_class]) == 1
     assert fetched_urls[requested_class][0] is None
+
+
+def get_flickr_api_paged(calls):
+
+    class DummyFlickrAPI:
+
+        def do_flickr_call(self, method_name, **kwargs):
+            calls.append((kwargs['tags'][0], kwargs['page']))
+            per_page = int(kwargs['per_page'])
+            first_id = (kwargs['page'] - 1) * per_page
+            return {'photos': {'page': kwargs['page'],
+                               'pages': 10,
+                               'perpage': per_page,
+                               'photo': [{'farm': 1,
+                                          'id': str(first_id + i),
+                                          'secret': 'secret',
+                                          'server': '1'}
+                                         for i in range(per_page)]
+                               }
+                    }
+
+    return CallBuilder(DummyFlickrAPI())
+
+
+def test_fetch_concurrent_pages():
+    calls = []
+    fetcher = Fetcher(get_flickr_api_paged(calls), workers=4,
+                      requests_per_second=1000)
+    fetched_urls = fetcher.fetch([{'name': 'dog', 'count': 1200},
+                                  {'name': 'cat', 'count': 600}])
+
+    assert list(fetched_urls.keys()) == ['dog', 'cat']
+    assert len(fetched_urls['dog']) == 1200
+    assert len(fetched_urls['cat']) == 600
+    assert fetched_urls['dog'][500].endswith('/1/500_secret_m.jpg')
+    assert sorted(calls) == [('cat', 1), ('cat', 2),
+                             ('dog', 1), ('dog', 2), ('dog', 3)]
+
+
+def test_iter_fetch_pages():
+    fetcher = Fetcher(get_flickr_api_paged([]), workers=4,
+                      requests_per_second=1000)
+    pages = list(fetcher.iter_fetch([{'name': 'dog', 'count': 1200}]))
+
+    assert sorted(page.offset for page in pages) == [0, 500, 1000]
+    assert all(page.count == 1200 for page in pages)
+    assert sum(len(page.urls) for page in pages) == 1200
+
+
+def test_fetch_cached_pages():
+    calls = []
+    classes = [{'name': 'dog', 'count': 1200}, {'name': 'cat', 'count': 600}]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with SearchCache(os.path.join(temp_dir, 'cache.sqlite')) as cache:
+            fetcher = Fetcher(get_flickr_api_paged(calls), workers=4,
+                              requests_per_second=1000, cache=cache)
+            fetched_urls = fetcher.fetch(classes)
+            calls.clear()
+            classes[1]['count'] = 1100
+            refetched_urls = fetcher.fetch(classes)
+
+    assert refetched_urls['dog'] == fetched_urls['dog']
+    assert len(refetched_urls['cat']) == 1100
+    assert calls == [('cat', 3)]
+
+
+def test_fetch_incremental_top_up():
+    calls = []
+    fetcher = Fetcher(get_flickr_api_paged(calls), workers=4,
+                      requests_per_second=1000)
+    urls_data = fetcher.fetch([{'name': 'dog', 'count': 700}])
+    full_urls = Fetcher(get_flickr_api_paged([]), requests_per_second=1000)\
+        .fetch([{'name': 'dog', 'count': 1200}])
+    classes = [{'name': 'dog', 'count': 1200}, {'name': 'cat', 'count': 10}]
+
+    calls.clear()
+    fetched_urls = fetcher.fetch(classes, {'dog': len(urls_data['dog'])})
+    merged = merge_urls_data(urls_data, fetched_urls, classes)
+
+    assert sorted(calls) == [('cat', 1), ('dog', 2), ('dog', 3)]
+    assert list(merged.keys()) == ['dog', 'cat']
+    assert merged['dog'] == full_urls['dog']
+    assert len(merged['cat']) == 10
+
+
+def get_flickr_api_slow(calls, pages, first_page_delay=0., delay=0.):
+
+    class DummyFlickrAPI:
+
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+        def do_flickr_call(self, method_name, **kwargs):
+            with self.lock:
+                calls.append((kwargs['tags'][0], kwargs['page']))
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            time.sleep(first_page_delay if kwargs['page'] == 1 else delay)
+            with self.lock:
+                self.in_flight -= 1
+
+            per_page = int(kwargs['per_page'])
+            first_id = (kwargs['page'] - 1) * per_page
+            return {'photos': {'page': kwargs['page'],
+                               'pages': pages,
+                               'perpage': per_page,
+                               'photo': [{'farm': 1,
+                                          'id': str(first_id + i),
+                                          'secret': 'secret',
+                                          'server': '1'}
+                                         for i in range(per_page)]
+                               }
+                    }
+
+    api = DummyFlickrAPI()
+    return CallBuilder(api), api
+
+
+def test_fetch_prefetched_pages_past_available_dropped():
+    calls = []
+    flickr, _ = get_flickr_api_slow(calls, pages=2, first_page_delay=0.2)
+    fetcher = Fetcher(flickr, workers=4, requests_per_second=1000,
+                      prefetch=3)
+    fetched_urls = fetcher.fetch([{'name': 'dog', 'count': 1500}])
+
+    # Pages were requested before the first one said there are only 2
+    assert sorted(calls) == [('dog', 1), ('dog', 2), ('dog', 3)]
+    assert fetched_urls['dog'] == [
+        'https://farm1.staticflickr.com/1/{}_secret_m.jpg'.format(i)
+        for i in range(1000)]
+
+
+def test_fetch_prefetch_window_bounded():
+    calls = []
+    flickr, api = get_flickr_api_slow(calls, pages=20, delay=0.01)
+    fetcher = Fetcher(flickr, workers=8, requests_per_second=1000,
+                      prefetch=2)
+    fetched_urls = fetcher.fetch([{'name': 'dog', 'count': 5000}])
+
+    assert len(fetched_urls['dog']) == 5000
+    assert sorted(calls) == [('dog', page) for page in range(1, 11)]
+    assert api.max_in_flight == 2
+
+
+def test_urls_data_round_trip():
+    urls_data = {'dog': ['a', 'b', 'c'], 'cat': None}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'urls_data.jsonl')
+        write_urls_data(urls_data, path)
+        loaded = load_urls_data(path)
+
+    assert loaded == urls_data
+    assert records_to_urls_data([
+        {'class': 'dog', 'count': 4, 'offset': 0, 'urls': ['a']},
+        {'class': 'dog', 'count': 4, 'offset': 3, 'urls': ['d']},
+        {'class': 'dog', 'count': 4, 'offset': 1, 'urls': ['b']}]) == \
+        {'dog': ['a', 'b']}
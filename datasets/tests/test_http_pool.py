@@ -0,0 +1,85 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+from urllib.error import HTTPError
+
+import pytest
+
+from http_pool import ConnectionPool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = []
+
+    def setup(self):
+        super().setup()
+        self.connections.append(self.client_address)
+
+    def do_GET(self):
+        if self.path == '/missing':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path == '/moved':
+            self.send_response(302)
+            self.send_header('Location', '/image')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = b'x' * 1024
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@contextmanager
+def keep_alive_server():
+    KeepAliveHandler.connections = []
+    server = ThreadingServer(('127.0.0.1', 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_connection_reused():
+    pool = ConnectionPool(pool_size=2)
+    with keep_alive_server() as base_url:
+        for _ in range(10):
+            with pool.request(base_url + '/image') as resp:
+                assert len(resp.read()) == 1024
+        pool.close()
+
+    assert len(KeepAliveHandler.connections) == 1
+
+
+def test_redirect_followed():
+    pool = ConnectionPool()
+    with keep_alive_server() as base_url:
+        with pool.request(base_url + '/moved') as resp:
+            assert len(resp.read()) == 1024
+        pool.close()
+
+
+def test_error_status_raises():
+    pool = ConnectionPool()
+    with keep_alive_server() as base_url:
+        with pytest.raises(HTTPError):
+            with pool.request(base_url + '/missing'):
+                pass
+        pool.close()
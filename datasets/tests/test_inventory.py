@@ -0,0 +1,61 @@
+import os
+import tempfile
+
+import inventory as inv
+from inventory import Inventory
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+
+def test_inventory_cached_until_directory_changes(monkeypatch):
+    scans = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        scans.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(inv.os, 'scandir', counting_scandir)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.makedirs(os.path.join(temp_dir, 'cat'))
+        for i in range(3):
+            write_file(os.path.join(temp_dir, 'cat', '{}.jpg'.format(i)), i)
+        path = os.path.join(temp_dir, 'inventory.json')
+
+        inventory = Inventory(temp_dir, path)
+        assert inventory.class_names() == ['cat']
+        assert inventory.count('cat') == 3
+        assert inventory.size('cat') == 3
+        inventory.save()
+        scans.clear()
+
+        reloaded = Inventory(temp_dir, path)
+        assert reloaded.file_names('cat') == ['0.jpg', '1.jpg', '2.jpg']
+        assert scans == []
+
+        # Bump the mtime, it may not change within the clock resolution
+        write_file(os.path.join(temp_dir, 'cat', 'new.jpg'), 5)
+        stat = os.stat(os.path.join(temp_dir, 'cat'))
+        os.utime(os.path.join(temp_dir, 'cat'),
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert reloaded.count('cat') == 4
+        assert len(scans) == 1
+
+
+def test_inventory_records_added_files():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.makedirs(os.path.join(temp_dir, 'dog'))
+        inventory = Inventory(temp_dir)
+        assert inventory.count('dog') == 0
+
+        for i in range(2):
+            path = os.path.join(temp_dir, 'dog', '{}.jpg'.format(i))
+            write_file(path, 10)
+            inventory.add(path)
+
+        assert inventory.count('dog') == 2
+        assert inventory.size('dog') == 20
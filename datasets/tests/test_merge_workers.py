@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+
+from download_dataset import chunk_records, download_records, shard_records
+from manifest import Manifest
+from merge_workers import merge_workers
+
+
+def write_images(images_dir, count):
+    image_path = os.path.join(os.path.dirname(__file__), 'data',
+                              'image_1.jpg')
+    urls = []
+    for i in range(count):
+        path = os.path.join(images_dir, '{}.jpg'.format(i))
+        shutil.copy(image_path, path)
+        urls.append('file://' + path)
+    return urls
+
+
+def test_merge_workers():
+    with tempfile.TemporaryDirectory() as images_dir, \
+            tempfile.TemporaryDirectory() as temp_dir:
+        urls = write_images(images_dir, 11) + ['file:///missing.jpg']
+        records = [{'class': 'cat', 'count': 10, 'offset': 0,
+                    'urls': urls[:9] + urls[-1:]},
+                   {'class': 'dog', 'count': 2, 'offset': 0,
+                    'urls': urls[9:11]}]
+        for shard_index in range(2):
+            worker_dir = os.path.join(temp_dir, 'workers',
+                                      'shard-{}'.format(shard_index))
+            os.makedirs(worker_dir)
+            with Manifest(os.path.join(worker_dir, 'manifest.jsonl')) \
+                    as manifest:
+                summary = download_records(
+                    shard_records(chunk_records(records, 3), shard_index, 2),
+                    worker_dir, manifest=manifest, partial=True)
+            with open(os.path.join(worker_dir, 'summary.txt'), 'w') as f:
+                f.writelines(summary)
+
+        summary = merge_workers(temp_dir, records,
+                                manifest_file_name='manifest.jsonl',
+                                report_file_names=['summary.txt'])
+        file_names = sorted(os.listdir(os.path.join(temp_dir, 'cat')))
+        with Manifest(os.path.join(temp_dir, 'manifest.jsonl')) as manifest:
+            done = [manifest.is_done(url) for url in urls]
+        leftovers = sorted(os.listdir(temp_dir))
+
+    assert summary == ['Class cat: Downloaded: 9 Expected: 10 '
+                       'Duplicates: 0\n',
+                       'Class dog: Downloaded: 2 Expected: 2 '
+                       'Duplicates: 0\n']
+    assert file_names == ['{}.jpg'.format(str(i).zfill(2)) for i in range(9)]
+    assert done == [True] * 11 + [False]
+    assert leftovers == ['cat', 'dog', 'inventory.json', 'manifest.jsonl',
+                         'shard-0-summary.txt', 'shard-1-summary.txt']
@@ -0,0 +1,92 @@
+import json
+import os
+import tempfile
+from urllib.request import urlopen
+
+from metrics import Metrics, stage_timer
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def test_metrics_report():
+    clock = FakeClock()
+    metrics = Metrics('download', clock=clock)
+    metrics.inc('images', stage='download', state='done')
+    metrics.inc('images', 3, stage='download', state='done')
+    metrics.inc('errors', stage='download', host='farm1.staticflickr.com')
+    for value in (0.02, 0.2, 2., 100.):
+        metrics.observe('download_seconds', value, stage='download')
+    clock.now = 2.
+
+    report = metrics.report()
+
+    assert report['elapsed'] == 2.
+    assert report['counters']['images'] == [
+        {'labels': {'stage': 'download', 'state': 'done'},
+         'value': 4, 'rate': 2.}]
+    histogram, = report['histograms']['download_seconds']
+    assert histogram['count'] == 4
+    assert histogram['sum'] == 102.22
+    assert histogram['buckets']['0.025'] == 1
+    assert histogram['buckets']['0.25'] == 2
+    assert histogram['buckets']['60.0'] == 3
+    assert metrics.value('images', stage='download', state='done') == 4
+    assert metrics.value('download_seconds', stage='download') == 4
+
+
+def test_metrics_to_prometheus():
+    metrics = Metrics('fetch')
+    metrics.inc('retries', stage='search')
+    metrics.observe('api_call_seconds', 0.3, buckets=(0.1, 1.),
+                    stage='search')
+    metrics.inc('errors', host='a"b')
+
+    lines = metrics.to_prometheus().splitlines()
+
+    assert '# TYPE datasets_retries_total counter' in lines
+    assert 'datasets_retries_total{stage="search"} 1' in lines
+    assert 'datasets_errors_total{host="a\\"b"} 1' in lines
+    assert '# TYPE datasets_api_call_seconds histogram' in lines
+    assert 'datasets_api_call_seconds_bucket{stage="search",le="0.1"} 0' \
+        in lines
+    assert 'datasets_api_call_seconds_bucket{stage="search",le="1.0"} 1' \
+        in lines
+    assert 'datasets_api_call_seconds_bucket{stage="search",le="+Inf"} 1' \
+        in lines
+    assert 'datasets_api_call_seconds_count{stage="search"} 1' in lines
+
+
+def test_metrics_saved_next_to_other_scripts():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'metrics.json')
+        fetch_metrics = Metrics('fetch')
+        fetch_metrics.inc('urls', 10, stage='search')
+        fetch_metrics.save(path)
+        split_metrics = Metrics('split')
+        with stage_timer(split_metrics, 'split'):
+            pass
+        split_metrics.save(path)
+
+        with open(path, 'r') as f:
+            reports = json.load(f)
+
+    assert sorted(reports) == ['fetch', 'split']
+    assert reports['fetch']['counters']['urls'][0]['value'] == 10
+    assert reports['split']['histograms']['stage_seconds'][0]['count'] == 1
+
+
+def test_metrics_served():
+    with Metrics('download') as metrics:
+        metrics.inc('bytes', 1024, stage='download')
+        port = metrics.serve(0, host='127.0.0.1')
+        with urlopen('http://127.0.0.1:{}/metrics'.format(port)) as resp:
+            body = resp.read().decode('utf-8')
+
+    assert 'datasets_bytes_total{stage="download"} 1024' in body
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from near_duplicates import HashIndex, build_index, hamming_distance
+
+
+def get_data_path(filename):
+    return os.path.join(os.path.dirname(__file__), 'data', filename)
+
+
+def test_hamming_distance():
+    a = np.array([0, 0xff], dtype=np.uint64)
+    b = np.array([1, 0xffffffffffffffff], dtype=np.uint64)
+
+    assert hamming_distance(a, b).tolist() == [1, 56]
+
+
+def test_find_groups():
+    hashes = [0b0, 0b11, 0b111 << 40, 0xffffffffffffffff, 0b1 << 63]
+    index = HashIndex(hashes, ['a', 'b', 'c', 'd', 'e'])
+
+    assert index.find_path_groups(threshold=2) == [['a', 'b', 'e']]
+    assert index.find_path_groups(threshold=0) == []
+
+
+def test_build_index_finds_resized_copy():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        class_dir = os.path.join(temp_dir, 'cat')
+        os.makedirs(class_dir)
+        shutil.copy(get_data_path('image_1.jpg'),
+                    os.path.join(class_dir, '0.jpg'))
+        shutil.copy(get_data_path('image_2.jpg'),
+                    os.path.join(class_dir, '1.jpg'))
+        with Image.open(get_data_path('image_1.jpg')) as image:
+            image.resize((image.width // 2, image.height // 2))\
+                .save(os.path.join(class_dir, '2.jpg'), quality=70)
+
+        for method in ('ahash', 'dhash', 'phash'):
+            index = build_index(temp_dir, ['cat'], method, workers=2)
+            assert index.find_path_groups(threshold=6) == \
+                [[os.path.join('cat', '0.jpg'), os.path.join('cat', '2.jpg')]]
+
+
+def test_build_index_skips_other_outputs():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for dir_name in ('cat', 'shards', 'package'):
+            os.makedirs(os.path.join(temp_dir, dir_name))
+            shutil.copy(get_data_path('image_1.jpg'),
+                        os.path.join(temp_dir, dir_name, '0.jpg'))
+
+        index = build_index(temp_dir, workers=1)
+
+    assert index.paths == [os.path.join('cat', '0.jpg')]
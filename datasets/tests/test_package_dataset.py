@@ -0,0 +1,115 @@
+import json
+import os
+import tarfile
+import tempfile
+
+from package_dataset import Packager, package_dataset
+
+
+def write_outputs(temp_dir):
+    files = {}
+    for class_name in ('cat', 'dog'):
+        os.makedirs(os.path.join(temp_dir, class_name))
+        for i in range(4):
+            path = os.path.join(class_name, '{}.jpg'.format(i))
+            files[path] = os.urandom(1000 + 700 * i)
+    files['split.json'] = json.dumps({'train': [], 'test': []}).encode()
+    for path, data in files.items():
+        with open(os.path.join(temp_dir, path), 'wb') as f:
+            f.write(data)
+    # Partial download
+    with open(os.path.join(temp_dir, 'cat', '.4.jpg.part'), 'wb') as f:
+        f.write(b'partial')
+    return files
+
+
+def load_index(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_package_dataset_parts():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        files = write_outputs(temp_dir)
+        index_path = package_dataset(temp_dir, ['cat', 'dog'],
+                                     ['split.json'], max_part_size=5000,
+                                     workers=2)
+        package_dir = os.path.dirname(index_path)
+        members = load_index(index_path)
+        parts = sorted(name for name in os.listdir(package_dir)
+                       if name.endswith('.tar'))
+
+        for member in members:
+            part_path = os.path.join(package_dir, member['part'])
+            with open(part_path, 'rb') as f:
+                f.seek(member['offset'])
+                assert f.read(member['size']) == files[member['path']]
+            with tarfile.open(part_path) as tar:
+                assert tar.extractfile(member['path']).read() == \
+                    files[member['path']]
+        part_sizes = [sum(member['size'] for member in members
+                          if member['part'] == part) for part in parts]
+
+    assert sorted(member['path'] for member in members) == sorted(files)
+    assert len(parts) > 2
+    assert all(size <= 5000 for size in part_sizes)
+
+
+def test_package_dataset_compressed():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        files = write_outputs(temp_dir)
+        index_path = package_dataset(temp_dir, ['cat', 'dog'],
+                                     ['split.json'], compression='gz')
+        package_dir = os.path.dirname(index_path)
+        extracted = {}
+        for part in os.listdir(package_dir):
+            if not part.endswith('.tar.gz'):
+                continue
+            with tarfile.open(os.path.join(package_dir, part)) as tar:
+                for info in tar:
+                    extracted[info.name] = tar.extractfile(info).read()
+
+    assert extracted == files
+
+
+def test_packager_reopened_skips_packed_files():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_outputs(temp_dir)
+        with Packager(temp_dir) as packager:
+            packager.add_directory('cat')
+            packager.add_files(['split.json'])
+        with Packager(temp_dir) as reopened:
+            reopened.add_directory('cat')
+            reopened.add_directory('dog')
+            reopened.add_files(['split.json'])
+
+        paths = [member['path'] for member in
+                 load_index(packager.index_path)]
+
+    assert sorted(paths) == sorted(
+        [os.path.join('cat', '{}.jpg'.format(i)) for i in range(4)] +
+        [os.path.join('dog', '{}.jpg'.format(i)) for i in range(4)] +
+        ['split.json'])
+
+
+def test_packager_reopened_repacks_changed_files():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_outputs(temp_dir)
+        with Packager(temp_dir) as packager:
+            packager.add_files(['split.json'])
+        # A new split of the same size
+        split_path = os.path.join(temp_dir, 'split.json')
+        stat = os.stat(split_path)
+        with open(split_path, 'w') as f:
+            json.dump({'train': [], 'tset': []}, f)
+        os.utime(split_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        with Packager(temp_dir) as reopened:
+            reopened.add_files(['split.json'])
+
+        members = load_index(packager.index_path)
+        with tarfile.open(os.path.join(packager.package_dir,
+                                       members[-1]['part'])) as tar:
+            data = tar.extractfile('split.json').read()
+
+    assert [member['path'] for member in members] == ['split.json'] * 2
+    assert json.loads(data.decode()) == {'train': [], 'tset': []}
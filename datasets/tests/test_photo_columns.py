@@ -0,0 +1,50 @@
+import json
+
+from photo_columns import PhotoColumns, concatenate_urls
+
+
+def get_photo_infos(count, first_id=46944690811, owner='161920781@N04'):
+    return [{'id': str(first_id + i), 'owner': owner,
+             'secret': '{:010x}'.format(0x3535fb688d + i * 7919),
+             'server': str(4865 + i % 3), 'farm': 5, 'title': 'dog'}
+            for i in range(count)]
+
+
+def get_url(photo_info):
+    return 'https://farm{farm}.staticflickr.com/' \
+           '{server}/{id}_{secret}_m.jpg'.format(**photo_info)
+
+
+def test_photo_columns_urls():
+    photo_infos = get_photo_infos(3) + [{'id': '1', 'farm': 'wrong_type'}]
+    photos = PhotoColumns.from_photos(photo_infos)
+
+    assert len(photos) == 4
+    assert list(photos) == [get_url(x) for x in photo_infos[:3]] + [None]
+    assert photos[1] == get_url(photo_infos[1])
+    assert photos[1:3] == [get_url(x) for x in photo_infos[1:3]]
+    assert photos.owner(0) == '161920781@N04'
+    assert photos.ids[2] == 46944690813
+
+
+def test_photo_columns_record_round_trip():
+    photos = PhotoColumns.from_photos(get_photo_infos(1000))
+    line = json.dumps(photos.to_record())
+    restored = PhotoColumns.from_record(json.loads(line))
+    urls_line = json.dumps(list(photos))
+
+    assert restored == photos
+    assert restored.owner(999) == photos.owner(999)
+    assert len(line) * 3 < len(urls_line)
+
+
+def test_concatenate_urls_keeps_owners():
+    cats = PhotoColumns.from_photos(get_photo_infos(2, 10, 'cat@N01'))
+    dogs = PhotoColumns.from_photos(get_photo_infos(2, 20, 'dog@N01'))
+    photos = concatenate_urls([[], cats, dogs])
+
+    assert isinstance(photos, PhotoColumns)
+    assert [photos.owner(i) for i in range(4)] == \
+        ['cat@N01'] * 2 + ['dog@N01'] * 2
+    assert concatenate_urls([['a'], dogs]) == ['a'] + list(dogs)
+    assert concatenate_urls([]) == []
@@ -0,0 +1,68 @@
+import io
+import json
+import os
+import tempfile
+
+from extract_subset import extract
+from fetch_urls import fetched_page
+from pipeline import Pipeline
+from split_dataset import Splitter
+
+
+def get_data_url(filename):
+    dirname = os.path.dirname(__file__)
+    return 'file://' + os.path.join(dirname, 'data', filename)
+
+
+class DummyFetcher:
+
+    def iter_fetch(self, classes):
+        url = get_data_url('image_1.jpg')
+        for class_info in classes:
+            count = class_info['count']
+            for offset in range(0, count, 4):
+                yield fetched_page(class_info['name'], count, offset,
+                                   [url] * min(4, count - offset))
+
+
+def test_pipeline_matches_separate_steps():
+    classes = [{'name': 'cat', 'count': 10}, {'name': 'dog', 'count': 6}]
+    splitter = Splitter(2, 'absolute', 42)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        urls_file = io.StringIO()
+        pipeline = Pipeline(DummyFetcher(), splitter, temp_dir,
+                            subset_percentage=50, subset_seed=42,
+                            workers=4, queue_size=1)
+        result = pipeline.run(classes, urls_file)
+
+        train_test_split = splitter.split_dataset(temp_dir, ['cat', 'dog'])
+        subset = extract(train_test_split, 50, 42)
+
+    assert result.summary == ['Class cat: Downloaded: 10 Expected: 10\n',
+                              'Class dog: Downloaded: 6 Expected: 6\n']
+    assert result.train_test_split == train_test_split
+    assert result.subset == subset
+    assert [stats.count for stats in result.stages] == [16, 16, 16, 16]
+    assert json.loads(urls_file.getvalue().splitlines()[-1]) == {'done': True}
+
+
+def test_pipeline_skips_partial_files_and_keeps_val():
+    classes = [{'name': 'cat', 'count': 10}, {'name': 'dog', 'count': 6}]
+    splitter = Splitter(2, 'absolute', 42, 2)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Left over by an interrupted download
+        os.makedirs(os.path.join(temp_dir, 'cat'))
+        open(os.path.join(temp_dir, 'cat', '.0.jpg.part'), 'w').close()
+        pipeline = Pipeline(DummyFetcher(), splitter, temp_dir,
+                            subset_percentage=50, subset_seed=42,
+                            workers=4, queue_size=1)
+        result = pipeline.run(classes, io.StringIO())
+
+    assert sorted(result.train_test_split) == ['test', 'train', 'val']
+    paths = [path for paths in result.train_test_split.values()
+             for path in paths]
+    assert len(paths) == 16
+    assert not any(os.path.basename(path).startswith('.') for path in paths)
+    assert len(result.train_test_split['val']) == 4
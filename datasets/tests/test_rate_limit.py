@@ -0,0 +1,88 @@
+import pytest
+
+from rate_limit import Backoff, Retrier, RetryableError, TokenBucket, \
+    parse_retry_after
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=1, clock=clock, sleep=clock.sleep)
+
+    for _ in range(11):
+        bucket.acquire()
+
+    assert clock.now == 5.
+
+
+def test_token_bucket_burst():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1, capacity=3, clock=clock, sleep=clock.sleep)
+
+    assert [bucket.reserve() for _ in range(4)] == [0., 0., 0., 1.]
+
+
+def test_retrier_backoff():
+    clock = FakeClock()
+    attempts = []
+
+    def flaky():
+        attempts.append(clock.now)
+        if len(attempts) < 3:
+            raise RetryableError('Service unavailable')
+        return 'result'
+
+    retrier = Retrier(attempts=5,
+                      backoff=Backoff(base_delay=1, jitter=lambda: 1.),
+                      sleep=clock.sleep)
+
+    assert retrier.call(flaky) == 'result'
+    assert attempts == [0., 1., 3.]
+
+
+def test_retrier_gives_up():
+    clock = FakeClock()
+
+    def failing():
+        raise RetryableError('Service unavailable')
+
+    retrier = Retrier(attempts=3, sleep=clock.sleep)
+
+    with pytest.raises(RetryableError):
+        retrier.call(failing)
+
+
+def test_retrier_retry_after_pauses_rate_limiter():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1, capacity=1, clock=clock, sleep=clock.sleep)
+    attempts = []
+
+    def throttled():
+        attempts.append(clock.now)
+        if len(attempts) == 1:
+            raise RetryableError('Too many requests', retry_after=10)
+        return 'result'
+
+    retrier = Retrier(attempts=2, backoff=Backoff(jitter=lambda: 0.),
+                      rate_limiter=bucket, sleep=clock.sleep)
+
+    assert retrier.call(throttled) == 'result'
+    assert attempts == [0., 11.]
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('120') == 120.
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:10 GMT',
+                             now=lambda: 1445412480.) == 10.
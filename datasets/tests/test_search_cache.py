@@ -0,0 +1,54 @@
+import json
+import os
+import tempfile
+
+from search_cache import SearchCache
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def test_search_cache_expires_entries():
+    clock = FakeClock()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'cache.sqlite')
+        with SearchCache(path, ttl=10, clock=clock) as cache:
+            cache.put(['cat'], 500, 1, {'photos': {'page': 1}})
+            clock.now = 5
+            assert cache.get('cat', '500', 1) == {'photos': {'page': 1}}
+            assert cache.get('cat', 500, 2) is None
+            clock.now = 11
+            assert cache.get('cat', 500, 1) is None
+
+        with SearchCache(path, ttl=100, clock=clock) as reopened:
+            assert reopened.get('cat', 500, 1) == {'photos': {'page': 1}}
+        with SearchCache(path, refresh=True, clock=clock) as refreshed:
+            assert refreshed.get('cat', 500, 1) is None
+
+
+def test_search_cache_evicts_least_recently_used():
+    clock = FakeClock()
+    response = {'photos': {'photo': ['x' * 100]}}
+    size = len(json.dumps(response))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with SearchCache(os.path.join(temp_dir, 'cache.sqlite'),
+                         max_size=3 * size, clock=clock) as cache:
+            for page in range(1, 4):
+                clock.now += 1
+                cache.put('cat', 1, page, response)
+            clock.now += 1
+            cache.get('cat', 1, 1)
+            clock.now += 1
+            cache.put('cat', 1, 4, response)
+
+            assert len(cache) == 3
+            assert cache.get('cat', 1, 2) is None
+            assert cache.get('cat', 1, 1) == response
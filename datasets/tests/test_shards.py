@@ -0,0 +1,111 @@
+import json
+import os
+import resource
+import tarfile
+import tempfile
+
+from shards import ShardDataset, ShardIndex, ShardWriter
+
+
+def test_shard_writer_offsets():
+    images = {os.path.join('cat', '{}.jpg'.format(i)): os.urandom(700 * i)
+              for i in range(1, 6)}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with ShardWriter(temp_dir, max_shard_size=2048) as writer:
+            for path, data in images.items():
+                writer.write(os.path.join(temp_dir, path), data)
+            assert writer.class_count('cat') == 5
+
+        index = ShardIndex.load(writer.index_path)
+        for path, data in images.items():
+            entry = index[path]
+            shard_path = os.path.join(writer.shards_dir, entry.shard)
+            with open(shard_path, 'rb') as f:
+                f.seek(entry.offset)
+                assert f.read(entry.size) == data
+            with tarfile.open(shard_path) as tar:
+                assert tar.extractfile(path).read() == data
+
+        shards = sorted(name for name in os.listdir(writer.shards_dir)
+                        if name.endswith('.tar'))
+        with ShardWriter(temp_dir) as reopened:
+            assert reopened.class_count('cat') == 5
+
+    assert len(shards) > 1
+    assert index.class_file_names() == \
+        {'cat': sorted(os.path.basename(path) for path in images)}
+
+
+def write_split(temp_dir, images):
+    with ShardWriter(temp_dir, max_shard_size=4096) as writer:
+        for path, data in images.items():
+            writer.write(os.path.join(temp_dir, path), data)
+    index = ShardIndex.load(writer.index_path)
+    split_path = os.path.join(temp_dir, 'split.json')
+    with open(split_path, 'w') as f:
+        json.dump({'train': index.locate(list(images)), 'test': []}, f)
+    return split_path
+
+
+def test_shard_dataset_random_access():
+    images = {os.path.join(class_name, '{}.jpg'.format(i)):
+              os.urandom(100 * i + 1)
+              for class_name in ('cat', 'dog') for i in range(10)}
+    paths = list(images)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        split_path = write_split(temp_dir, images)
+        with ShardDataset.from_split(split_path) as dataset:
+            assert len(dataset) == 20
+            assert bytes(dataset[3]) == images[paths[3]]
+            assert bytes(dataset[-1]) == images[paths[-1]]
+            sliced = dataset[5:15:2]
+            assert len(sliced) == 5
+            assert [bytes(sliced[i]) for i in range(5)] == \
+                [images[path] for path in paths[5:15:2]]
+            assert sliced.class_name(4) == 'dog'
+
+
+def test_shard_dataset_batches():
+    images = {os.path.join('cat', '{}.jpg'.format(i)): os.urandom(i + 1)
+              for i in range(10)}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        split_path = write_split(temp_dir, images)
+        with ShardDataset.from_split(split_path) as dataset:
+            batches = list(dataset.iter_batches(4, transform=bytes))
+            shuffled = list(dataset.iter_batches(4, shuffle=True, seed=1,
+                                                 drop_last=True))
+            indices = [i for batch in shuffled for i in batch.indices]
+            del shuffled
+
+    assert [len(batch.items) for batch in batches] == [4, 4, 2]
+    assert [item for batch in batches for item in batch.items] == \
+        list(images.values())
+    assert batches[0].class_names == ['cat'] * 4
+    assert len(indices) == 8 and len(set(indices)) == 8
+
+
+def test_shard_dataset_files_beyond_open_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    limit = min(256, soft)
+    paths = [os.path.join('cat', '{}.jpg'.format(i))
+             for i in range(limit + 50)]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.makedirs(os.path.join(temp_dir, 'cat'))
+        for path in paths:
+            with open(os.path.join(temp_dir, path), 'wb') as f:
+                f.write(path.encode())
+
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        try:
+            with ShardDataset(temp_dir, paths) as dataset:
+                items = [bytes(item) for batch in
+                         dataset[::2].iter_batches(32) for item in batch.items]
+                items += [bytes(dataset[i]) for i in range(1, len(paths), 2)]
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    assert sorted(items) == sorted(path.encode() for path in paths)
@@ -0,0 +1,129 @@
+import os
+import tempfile
+
+from manifest import DONE, DUPLICATE, FAILED, Manifest
+from split_dataset import Splitter, manifest_file_names
+
+
+def create_class_dirs(parent_dir, classes):
+    for class_name, count in classes.items():
+        os.makedirs(os.path.join(parent_dir, class_name))
+        for i in range(count):
+            open(os.path.join(parent_dir, class_name,
+                              '{}.jpg'.format(i)), 'w').close()
+
+
+def test_split_dataset_absolute():
+    splitter = Splitter(3, 'absolute', 42)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        create_class_dirs(temp_dir, {'cat': 10, 'dog': 5})
+        train_test_split = splitter.split_dataset(temp_dir, ['cat', 'dog'])
+
+    assert len(train_test_split['train']) == 9
+    assert len(train_test_split['test']) == 6
+
+
+def test_split_dataset_keeps_groups_together():
+    splitter = Splitter(5, 'absolute', 42)
+    groups = [[os.path.join('cat', '{}.jpg'.format(i)) for i in range(4)] +
+              [os.path.join('dog', '0.jpg')]]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        create_class_dirs(temp_dir, {'cat': 20, 'dog': 20})
+        train_test_split = splitter.split_dataset(temp_dir, ['cat', 'dog'],
+                                                  groups)
+
+    sides = {'train' if path in train_test_split['train'] else 'test'
+             for path in groups[0]}
+    assert len(sides) == 1
+    assert len(train_test_split['train']) + \
+        len(train_test_split['test']) == 40
+
+
+def test_split_dataset_from_file_names():
+    splitter = Splitter(3, 'absolute', 42)
+    file_names = {'cat': ['{}.jpg'.format(i) for i in range(10)]}
+
+    # Class directories don't have to exist
+    train_test_split = splitter.split_dataset('missing', ['cat'],
+                                              file_names=file_names)
+
+    assert len(train_test_split['test']) == 3
+    assert sorted(train_test_split['train'] + train_test_split['test']) == \
+        sorted(os.path.join('cat', name) for name in file_names['cat'])
+
+
+def test_split_dataset_with_val_set():
+    splitter = Splitter(20, 'proportional', 42, val_size=10, workers=2)
+    file_names = {class_name: ['{}.jpg'.format(i) for i in range(50)]
+                  for class_name in ('cat', 'dog')}
+
+    train_test_split = splitter.split_dataset('missing', ['cat', 'dog'],
+                                              file_names=file_names)
+
+    assert [len(train_test_split[key]) for key in ('train', 'val', 'test')] \
+        == [70, 10, 20]
+    assert len(set(sum(train_test_split.values(), []))) == 100
+
+
+def test_k_fold_splits():
+    splitter = Splitter(0, 'absolute', 42, workers=2)
+    file_names = {'cat': ['{}.jpg'.format(i) for i in range(10)],
+                  'dog': ['{}.jpg'.format(i) for i in range(7)]}
+
+    folds = splitter.k_fold('missing', ['cat', 'dog'], 3, file_names)
+
+    assert len(folds) == 3
+    test_paths = sum((fold['test'] for fold in folds), [])
+    assert sorted(test_paths) == sorted(folds[0]['train'] + folds[0]['test'])
+    assert [len(fold['test']) for fold in folds] == [5, 5, 7]
+
+
+def test_manifest_file_names():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with Manifest(os.path.join(temp_dir, 'manifest.jsonl')) as manifest:
+            manifest.record('a', os.path.join(temp_dir, 'cat', '0.jpg'),
+                            DONE)
+            manifest.record('b', os.path.join(temp_dir, 'cat', '1.jpg'),
+                            FAILED)
+            manifest.record('c', os.path.join(temp_dir, 'dog', '0.jpg'),
+                            DONE)
+            file_names = manifest_file_names(manifest, temp_dir)
+
+    assert file_names == {'cat': ['0.jpg'], 'dog': ['0.jpg']}
+
+
+def test_manifest_file_names_linked_duplicates():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        create_class_dirs(temp_dir, {'cat': 2})
+        with Manifest(os.path.join(temp_dir, 'manifest.jsonl')) as manifest:
+            manifest.record('a', os.path.join(temp_dir, 'cat', '0.jpg'),
+                            DONE)
+            # Hard-linked duplicate
+            manifest.record('b', os.path.join(temp_dir, 'cat', '1.jpg'),
+                            DUPLICATE)
+            # Skipped duplicate, no file
+            manifest.record('c', os.path.join(temp_dir, 'cat', '2.jpg'),
+                            DUPLICATE)
+            file_names = manifest_file_names(manifest, temp_dir)
+
+    assert file_names == {'cat': ['0.jpg', '1.jpg']}
+
+
+def test_k_fold_keeps_groups_together():
+    splitter = Splitter(0, 'absolute', 42)
+    file_names = {class_name: ['{}.jpg'.format(i) for i in range(12)]
+                  for class_name in ('cat', 'dog')}
+    groups = [[os.path.join('cat', '{}.jpg'.format(i)) for i in range(4)] +
+              [os.path.join('dog', '0.jpg')],
+              [os.path.join('dog', '5.jpg'), os.path.join('dog', '6.jpg')]]
+
+    folds = splitter.k_fold('missing', ['cat', 'dog'], 3, file_names, groups)
+
+    for group in groups:
+        assert len({i for i, fold in enumerate(folds)
+                    for path in group if path in fold['test']}) == 1
+    assert sorted(sum((fold['test'] for fold in folds), [])) == \
+        sorted(folds[0]['train'] + folds[0]['test'])
+    assert all(len(fold['test']) >= 6 for fold in folds)
@@ -0,0 +1,47 @@
+import os
+import tempfile
+
+import numpy as np
+
+from extract_subset import extract
+from split_index import SplitIndex, load_split, save_split
+
+
+def make_split():
+    paths = [os.path.join(class_name, '{:03d}.jpg'.format(i))
+             for class_name in ('dog', 'cat', 'frog') for i in range(30)]
+    return {'train': paths[::3] + paths[1::3], 'test': paths[2::3]}
+
+
+def test_split_index_round_trip():
+    split = make_split()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'split.idx')
+        SplitIndex.from_json(split).save(path)
+        index = load_split(path)
+        assert isinstance(index.file_names, np.memmap)
+        assert index.to_json() == split
+
+        json_path = os.path.join(temp_dir, 'split.json')
+        save_split(index, json_path)
+        assert load_split(json_path).to_json() == split
+
+
+def test_split_index_with_shard_locations():
+    split = {'train': [{'path': os.path.join('cat', '0.jpg'),
+                        'shard': 'shard-000001.tar', 'offset': 512,
+                        'size': 10}],
+             'test': [{'path': os.path.join('dog', '0.jpg'),
+                       'shard': 'shard-000000.tar', 'offset': 1024,
+                       'size': 20}]}
+
+    assert SplitIndex.from_json(split).to_json() == split
+
+
+def test_split_index_subset_matches_extract():
+    split = make_split()
+
+    subset = SplitIndex.from_json(split).subset(30, seed=7).to_json()
+
+    assert subset == extract(make_split(), 30, 7)
@@ -0,0 +1,114 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from PIL import Image
+
+from dedup import DedupIndex
+from manifest import DONE, INVALID, Manifest
+from validate_images import validate_classes
+
+
+def get_data_path(filename):
+    return os.path.join(os.path.dirname(__file__), 'data', filename)
+
+
+def test_validate_classes():
+    with open(get_data_path('image_2.jpg'), 'rb') as f:
+        placeholder = hashlib.sha1(f.read()).hexdigest()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        class_dir = os.path.join(temp_dir, 'cat')
+        os.makedirs(class_dir)
+        shutil.copy(get_data_path('image_1.jpg'),
+                    os.path.join(class_dir, 'valid.jpg'))
+        shutil.copy(get_data_path('image_2.jpg'),
+                    os.path.join(class_dir, 'placeholder.jpg'))
+        Image.new('RGB', (400, 200)).save(os.path.join(class_dir,
+                                                       'large.jpg'))
+        with open(get_data_path('image_1.jpg'), 'rb') as f:
+            truncated = f.read()[:2000]
+        with open(os.path.join(class_dir, 'truncated.jpg'), 'wb') as f:
+            f.write(truncated)
+
+        with Manifest(os.path.join(temp_dir, 'manifest.jsonl')) as manifest:
+            manifest.record('http://truncated',
+                            os.path.join(class_dir, 'truncated.jpg'), DONE)
+            summary = validate_classes(temp_dir, ['cat'], [placeholder],
+                                       max_size=240, workers=2,
+                                       manifest=manifest)
+            assert manifest.get('http://truncated')['state'] == INVALID
+            assert manifest.is_done('http://truncated')
+
+        file_names = sorted(os.listdir(class_dir))
+        with Image.open(os.path.join(class_dir, 'large.jpg')) as image:
+            size = image.size
+
+    assert summary == ['Class cat: Valid: 1 Resized: 1 Corrupt: 1 '
+                       'Placeholders: 1\n']
+    assert file_names == ['large.jpg', 'valid.jpg']
+    assert size == (240, 120)
+
+
+def test_validate_classes_skips_other_outputs():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for dir_name in ('cat', 'shards', 'package'):
+            os.makedirs(os.path.join(temp_dir, dir_name))
+        shutil.copy(get_data_path('image_1.jpg'),
+                    os.path.join(temp_dir, 'cat', '0.jpg'))
+        with open(os.path.join(temp_dir, 'cat', 'notes.txt'), 'w') as f:
+            f.write('not an image')
+        other_outputs = [os.path.join('shards', 'shard-000000.tar'),
+                         os.path.join('shards', 'index.jsonl'),
+                         os.path.join('package', 'dataset-000000.tar')]
+        for path in other_outputs:
+            with open(os.path.join(temp_dir, path), 'wb') as f:
+                f.write(b'tar')
+
+        summary = validate_classes(temp_dir, workers=1)
+        without_manifest = sorted(
+            os.path.relpath(os.path.join(parent, file_name), temp_dir)
+            for parent, _, file_names in os.walk(temp_dir)
+            for file_name in file_names)
+        with Manifest(os.path.join(temp_dir, 'manifest.jsonl')) as manifest:
+            manifest.record('http://cat', os.path.join(temp_dir, 'cat',
+                                                       '0.jpg'), DONE)
+            os.makedirs(os.path.join(temp_dir, 'dog'))
+            with_manifest = validate_classes(temp_dir, workers=1,
+                                             manifest=manifest)
+
+    assert summary == ['Class cat: Valid: 1 Resized: 0 Corrupt: 0 '
+                       'Placeholders: 0\n']
+    assert without_manifest == sorted(
+        other_outputs + [os.path.join('cat', '0.jpg'),
+                         os.path.join('cat', 'notes.txt')])
+    assert with_manifest == summary
+
+
+def test_validate_classes_updates_resized_checksums():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        class_dir = os.path.join(temp_dir, 'cat')
+        os.makedirs(class_dir)
+        path = os.path.join(class_dir, '0.jpg')
+        Image.new('RGB', (400, 200)).save(path)
+        with open(path, 'rb') as f:
+            original = hashlib.sha1(f.read()).hexdigest()
+
+        with Manifest(os.path.join(temp_dir, 'manifest.jsonl')) as manifest, \
+                DedupIndex(os.path.join(temp_dir, 'dedup.jsonl')) as dedup:
+            manifest.record('http://cat', path, DONE, 1, original)
+            validate_classes(temp_dir, ['cat'], max_size=100, workers=1,
+                             manifest=manifest, dedup=dedup)
+            record = manifest.get('http://cat')
+        with open(path, 'rb') as f:
+            data = f.read()
+        with DedupIndex(os.path.join(temp_dir, 'dedup.jsonl')) as reopened:
+            resized_duplicate = reopened.claim_content(
+                hashlib.sha1(data).hexdigest(), 'other.jpg')
+        file_names = os.listdir(class_dir)
+
+    assert record['checksum'] == hashlib.sha1(data).hexdigest() != original
+    assert record['size'] == len(data)
+    assert resized_duplicate == path
+    assert file_names == ['0.jpg']
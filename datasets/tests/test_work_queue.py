@@ -0,0 +1,65 @@
+import os
+import tempfile
+
+from work_queue import WorkQueue
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def test_work_queue_leases_units_once():
+    clock = FakeClock()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'queue.sqlite')
+        with WorkQueue(path, 'a', lease_seconds=60, clock=clock) as a, \
+                WorkQueue(path, 'b', lease_seconds=60, clock=clock) as b:
+            a.add(['cat/0', 'cat/10'])
+            b.add(['cat/10', 'dog/0'])
+            leased = [a.lease(), b.lease(), a.lease(), b.lease()]
+            a.complete('cat/0')
+            counts = b.counts()
+
+    assert leased == ['cat/0', 'cat/10', 'dog/0', None]
+    assert counts == {'done': 1, 'leased': 2}
+
+
+def test_work_queue_expired_leases_taken_over():
+    clock = FakeClock()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'queue.sqlite')
+        with WorkQueue(path, 'a', lease_seconds=60, clock=clock) as a, \
+                WorkQueue(path, 'b', lease_seconds=60, clock=clock) as b:
+            a.add(['cat/0', 'cat/10'])
+            assert a.lease() == 'cat/0'
+            assert b.lease() == 'cat/10'
+            clock.now = 50
+            b.renew()
+            clock.now = 61
+            # Worker a stopped renewing its lease
+            assert b.lease() == 'cat/0'
+            assert a.lease() is None
+
+
+def test_work_queue_leased_records():
+    records = {'cat/{}'.format(i): {'class': 'cat', 'offset': i}
+               for i in range(0, 30, 10)}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'queue.sqlite')
+        with WorkQueue(path, 'a') as a, WorkQueue(path, 'b') as b:
+            a.add(['cat/0', 'other/0'])
+            assert a.lease() == 'cat/0'
+            offsets = [record['offset'] for record in
+                       b.leased_records(records)]
+            # Unknown units are given back
+            assert a.lease() == 'other/0'
+
+    assert offsets == [10, 20]
@@ -0,0 +1,223 @@
+import argparse
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from PIL import Image
+from tqdm import tqdm
+
+from dedup import DedupIndex
+from inventory import NON_CLASS_DIR_NAMES, Inventory
+import manifest as mf
+
+VALID = 'valid'
+RESIZED = 'resized'
+CORRUPT = 'corrupt'
+PLACEHOLDER = 'placeholder'
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+
+
+def is_image_name(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def __check_image(path, placeholders, max_size, quality):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError as err:
+        logging.error('File error: {}'.format(err))
+        return CORRUPT
+
+    if hashlib.sha1(data).hexdigest() in placeholders:
+        os.remove(path)
+        return PLACEHOLDER
+
+    try:
+        with Image.open(path) as image:
+            # Truncated images fail only when fully decoded
+            image.load()
+            if max_size is None or max(image.size) <= max_size:
+                return VALID
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+            resized = image.convert('RGB')
+    except (IOError, OSError, SyntaxError, ValueError) as err:
+        logging.error('Could not decode {}: {}'.format(path, err))
+        # Other files are never removed, e.g. shards next to classes
+        if is_image_name(path):
+            os.remove(path)
+        return CORRUPT
+
+    # Replaced at once, a failed write keeps the original. The temporary
+    # file is hidden like partial downloads, so listings skip it
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                     prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            resized.save(f, 'JPEG', quality=quality)
+        os.replace(temp_path, path)
+    except (IOError, OSError) as err:
+        logging.error('Could not resize {}: {}'.format(path, err))
+        return VALID
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return RESIZED
+
+
+def __check_chunk(args):
+    paths, placeholders, max_size, quality = args
+    return [__check_image(path, placeholders, max_size, quality)
+            for path in paths]
+
+
+def validate_images(paths: list, placeholders=(), max_size=None, quality=90,
+                    workers=None, chunk_size=64) -> list:
+    """Checks images on a pool of processes and returns their states.
+
+    Images that can't be decoded and placeholders, given by sha1
+    checksums, are removed. With `max_size`, larger images are
+    resized to fit it and re-encoded as JPEG.
+    """
+    placeholders = frozenset(placeholders)
+    chunks = [(paths[i:i + chunk_size], placeholders, max_size, quality)
+              for i in range(0, len(paths), chunk_size)]
+
+    states = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk_states in tqdm(executor.map(__check_chunk, chunks),
+                                 total=len(chunks)):
+            states.extend(chunk_states)
+
+    return states
+
+
+def validate_classes(parent_dir_name, class_dir_names: list = None,
+                     placeholders=(), max_size=None, quality=90,
+                     workers=None, inventory: Inventory = None,
+                     manifest: mf.Manifest = None,
+                     excluded_dir_names=NON_CLASS_DIR_NAMES,
+                     dedup: DedupIndex = None) -> list:
+    """Validates images of every class and returns summary lines.
+
+    Classes default to those of the `manifest`, or to directories but
+    the `excluded_dir_names` of other outputs, e.g. shards. Only files
+    named as images are checked. Removed images are recorded as invalid
+    in the `manifest`, so they are not downloaded again. Sizes and
+    checksums of resized images are updated in the `manifest` and
+    the `dedup` index.
+    """
+    if inventory is None:
+        inventory = Inventory(parent_dir_name)
+    if class_dir_names is None:
+        class_dir_names = inventory.dataset_class_names(manifest,
+                                                        excluded_dir_names)
+
+    paths = OrderedDict()
+    for class_dir_name in class_dir_names:
+        for file_name in inventory.file_names(class_dir_name):
+            if is_image_name(file_name):
+                paths[os.path.join(parent_dir_name, class_dir_name,
+                                   file_name)] = class_dir_name
+
+    states = validate_images(list(paths), placeholders, max_size, quality,
+                             workers)
+
+    urls = {}
+    if manifest is not None:
+        urls = {os.path.abspath(manifest.path(record['url'])): record['url']
+                for record in manifest.records()}
+
+    class_states = OrderedDict((class_dir_name, Counter())
+                               for class_dir_name in class_dir_names)
+    for (path, class_dir_name), state in zip(paths.items(), states):
+        class_states[class_dir_name][state] += 1
+        url = urls.get(os.path.abspath(path))
+        if url is None:
+            continue
+        if state in (CORRUPT, PLACEHOLDER):
+            manifest.record(url, path, mf.INVALID)
+        elif state == RESIZED:
+            with open(path, 'rb') as f:
+                data = f.read()
+            checksum = hashlib.sha1(data).hexdigest()
+            manifest.record(url, path, mf.DONE, len(data), checksum)
+            if dedup is not None:
+                dedup.add(url, checksum, path)
+
+    summary = []
+    for class_dir_name, counts in class_states.items():
+        summary.append('Class {}: Valid: {} Resized: {} Corrupt: {} '
+                       'Placeholders: {}\n'
+                       .format(class_dir_name, counts[VALID],
+                               counts[RESIZED], counts[CORRUPT],
+                               counts[PLACEHOLDER]))
+
+    return summary
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', required=True,
+                        help="Path to the directory with downloaded classes")
+    parser.add_argument('--output_file_name', required=True,
+                        help="Summary file the results are appended to")
+    parser.add_argument('--placeholders_file_name', default=None,
+                        help="JSON list of sha1 checksums of placeholder "
+                             "images to drop")
+    parser.add_argument('--max_size', type=int, default=None,
+                        help="Resize images larger than this many pixels "
+                             "on the longest side")
+    parser.add_argument('--quality', type=int, default=90,
+                        help="JPEG quality of resized images")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of processes, defaults to CPU count")
+    parser.add_argument('--manifest_file_name',
+                        default='download_manifest.jsonl')
+    parser.add_argument('--dedup_index_file_name',
+                        default='dedup_index.jsonl',
+                        help="Index of stored images, updated with "
+                             "checksums of resized images")
+    parser.add_argument('--inventory_file_name', default='inventory.json',
+                        help="Cached listing of class directories")
+    parser.add_argument('--exclude_dir_names', nargs='*',
+                        default=list(NON_CLASS_DIR_NAMES),
+                        help="Directories of other outputs, never taken "
+                             "for classes")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+
+    placeholders = []
+    if args.placeholders_file_name:
+        with open(args.placeholders_file_name, 'r') as f:
+            placeholders = json.load(f)
+
+    inventory = Inventory(args.output_dir,
+                          os.path.join(args.output_dir,
+                                       args.inventory_file_name))
+    with mf.Manifest(os.path.join(args.output_dir,
+                                  args.manifest_file_name)) as manifest, \
+            DedupIndex(os.path.join(args.output_dir,
+                                    args.dedup_index_file_name)) as dedup:
+        summary = validate_classes(args.output_dir, None, placeholders,
+                                   args.max_size, args.quality,
+                                   args.workers, inventory, manifest,
+                                   args.exclude_dir_names, dedup)
+    inventory.save()
+
+    with open(os.path.join(args.output_dir, args.output_file_name), 'a') as f:
+        f.writelines(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+from contextlib import contextmanager
+import logging
+import sqlite3
+import threading
+import time
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+
+
+class WorkQueue:
+    """Queue of work units leased to workers from a shared SQLite file.
+
+    Units are identified by string keys and added by every worker, so
+    workers may start in any order. A unit is leased to one worker at
+    a time for `lease_seconds`, leases of a worker are renewed in the
+    background while it is alive. Units of a worker that crashed are
+    leased again once their leases expire. Workers on several hosts
+    need the file on a file system with working locks.
+    """
+
+    def __init__(self, path, worker_name, lease_seconds=300.,
+                 clock=time.time, timeout=60.):
+        self.__worker_name = worker_name
+        self.__lease_seconds = lease_seconds
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__heartbeat = None
+        # Transactions are begun explicitly, leases need write locks
+        self.__connection = sqlite3.connect(path, timeout=timeout,
+                                            isolation_level=None,
+                                            check_same_thread=False)
+        with self.__transaction() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS units ('
+                'key TEXT PRIMARY KEY, state TEXT NOT NULL, owner TEXT, '
+                'expires REAL, attempts INTEGER NOT NULL DEFAULT 0)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS units_state ON units (state)')
+
+    @contextmanager
+    def __transaction(self):
+        with self.__lock:
+            self.__connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.__connection
+            except BaseException:
+                self.__connection.execute('ROLLBACK')
+                raise
+            self.__connection.execute('COMMIT')
+
+    def add(self, keys):
+        """Adds units, those known already keep their state."""
+        with self.__transaction() as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO units (key, state) VALUES (?, ?)',
+                ((key, PENDING) for key in keys))
+
+    def lease(self):
+        """Returns the key of a leased unit or None when none is left.
+
+        Units leased by live workers are not waited for.
+        """
+        now = self.__clock()
+        with self.__transaction() as connection:
+            row = connection.execute(
+                'SELECT key FROM units WHERE state = ? '
+                'OR state = ? AND expires < ? ORDER BY rowid LIMIT 1',
+                (PENDING, LEASED, now)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                'UPDATE units SET state = ?, owner = ?, expires = ?, '
+                'attempts = attempts + 1 WHERE key = ?',
+                (LEASED, self.__worker_name, now + self.__lease_seconds,
+                 row[0]))
+
+        if self.__heartbeat is None:
+            self.__heartbeat = threading.Thread(target=self.__renew_leases,
+                                                daemon=True)
+            self.__heartbeat.start()
+        return row[0]
+
+    def renew(self):
+        """Extends all leases of the worker."""
+        with self.__transaction() as connection:
+            connection.execute(
+                'UPDATE units SET expires = ? WHERE state = ? AND owner = ?',
+                (self.__clock() + self.__lease_seconds, LEASED,
+                 self.__worker_name))
+
+    def __renew_leases(self):
+        while not self.__stopped.wait(self.__lease_seconds / 3):
+            try:
+                self.renew()
+            except sqlite3.Error as err:
+                logging.error('Could not renew leases: {}'.format(err))
+
+    def complete(self, key):
+        # Done even if the lease expired, the unit needs no other worker
+        with self.__transaction() as connection:
+            connection.execute(
+                'UPDATE units SET state = ?, expires = NULL WHERE key = ?',
+                (DONE, key))
+
+    def release(self, key):
+        """Returns a leased unit to the queue for other workers."""
+        with self.__transaction() as connection:
+            connection.execute(
+                'UPDATE units SET state = ?, owner = NULL, expires = NULL '
+                'WHERE key = ? AND owner = ?',
+                (PENDING, key, self.__worker_name))
+
+    def counts(self) -> dict:
+        """Returns numbers of units by state."""
+        with self.__lock:
+            return dict(self.__connection.execute(
+                'SELECT state, COUNT(*) FROM units GROUP BY state'))
+
+    def leased_records(self, records: dict):
+        """Yields records keyed by unit keys as their units are leased.
+
+        All keys are added first, records of units leased by other
+        workers or done already are left out.
+        """
+        self.add(records)
+        unknown_keys = []
+        try:
+            while True:
+                key = self.lease()
+                if key is None:
+                    return
+                if key not in records:
+                    # Held until the end, so it is not leased again
+                    logging.warning('Unknown work unit {}, is the input '
+                                    'of workers the same?'.format(key))
+                    unknown_keys.append(key)
+                    continue
+                yield records[key]
+        finally:
+            for key in unknown_keys:
+                self.release(key)
+
+    def close(self):
+        self.__stopped.set()
+        if self.__heartbeat is not None:
+            self.__heartbeat.join()
+        with self.__lock:
+            self.__connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()